@@ -1,163 +1,89 @@
 from flask import Flask, Response, render_template, jsonify, request
-from picamera2 import Picamera2
-import time
-import cv2
-import io
-import numpy as np
-import boto3
-import json
-import matplotlib.pyplot as plt
-import base64
-import re
-from datetime import datetime
-import pandas as pd
-
-app = Flask(__name__)
-
-# AWS S3 credentials and bucket info
+from camera_registry import DEFAULT_CAMERA, CameraRegistry, cameras_from_env, pi_camera_spec
+from camera_stream import mjpeg_stream
+from lazy import Lazy
+from metrics import instrument
+from serving import role_route, serve_role, serves
+from storage import WEATHER_BUCKET, open_storage
+from weather_routes import DEFAULT_CLOUD_COVER, clamp_cloud_cover, weather_blueprint
+from weather_store import WeatherStore
+from weather_partitions import WeatherPartitions
+from weather_worker import IngestWorker
+
+# AWS S3 credentials and bucket info; STORAGE_URL can point the app at MinIO or a local directory instead
 AWS_ACCESS_KEY = ""
 AWS_SECRET_KEY = ""
-BUCKET_NAME = "weather-data-iot"
+BUCKET_NAME = WEATHER_BUCKET
 
-# Initialize S3 client
-s3 = boto3.client('s3', aws_access_key_id=AWS_ACCESS_KEY, aws_secret_access_key=AWS_SECRET_KEY)
+FPS = 10  # Target FPS
 
-# Initialize Picamera2
-picam2 = Picamera2()
-camera_config = picam2.create_preview_configuration(main={"format": 'RGB888', "size": (1920, 1080)}) # Use main with a larger size
-picam2.configure(camera_config)
-picam2.start()
-time.sleep(1)
 
-FPS = 10  # Target FPS
-SLEEP_DURATION = 1 / FPS
-
-
-def extract_timestamp_from_filename(filename):
-    match = re.match(r"weather_data_(\d{4})-(\d{2})-(\d{2})_(\d{2})-(\d{2})-(\d{2})\.json", filename)
-    if match:
-        year, month, day, hour, minute, second = match.groups()
-        return datetime(int(year), int(month), int(day), int(hour), int(minute), int(second))
-    return None
-
-
-def fetch_data_from_s3():
-    files = s3.list_objects_v2(Bucket=BUCKET_NAME)
-    data = []
-    for file in files.get('Contents', []):
-        file_key = file['Key']
-        timestamp = extract_timestamp_from_filename(file_key)
-        if timestamp:
-            response = s3.get_object(Bucket=BUCKET_NAME, Key=file_key)
-            file_content = response['Body'].read().decode('utf-8')
-            json_data = json.loads(file_content)
-            json_data["timestamp"] = timestamp.strftime('%Y-%m-%d %H:%M:%S')
-            data.append(json_data)
-    return data
-
-
-def low_pass_filter(data, cloud_cover):
-    alpha = cloud_cover / 100
-    filtered_data = []
-    for i in range(len(data)):
-        if i == 0:
-            filtered_data.append(data[i])
-        else:
-            smoothed_value = alpha * data[i] + (1 - alpha) * filtered_data[i - 1]
-            filtered_data.append(smoothed_value)
-    return filtered_data
-
-
-def aggregate_data(weather_data, granularity):
-    df = pd.DataFrame(weather_data)
-    df['timestamp'] = pd.to_datetime(df['timestamp'])
-    df.set_index('timestamp', inplace=True)
-    if granularity == 'hour':
-        df_resampled = df.resample('H').mean()
-    elif granularity == 'day':
-        df_resampled = df.resample('D').mean()
-    else:
-        df_resampled = df
-    return df_resampled
-
-
-def create_plot(weather_data, weather_attribute, granularity):
-    df_resampled = aggregate_data(weather_data, granularity)
-    plt.figure(figsize=(10, 6))
-    plt.plot(df_resampled.index, df_resampled[weather_attribute], label=weather_attribute, marker='o')
-    plt.xlabel('Timestamp')
-    plt.ylabel(weather_attribute.capitalize())
-    plt.title(f'{weather_attribute.capitalize()} Over Time (Granularity: {granularity.capitalize()})')
-
-    if granularity == 'day':
-        plt.xticks(df_resampled.index, df_resampled.index.strftime('%Y-%m-%d'), rotation=45)
-    elif granularity == 'hour':
-        plt.xticks(df_resampled.index, df_resampled.index.strftime('%Y-%m-%d %H:%M'), rotation=45)
-    else:
-        plt.xticks(df_resampled.index, df_resampled.index.strftime('%Y-%m-%d %H:%M:%S'), rotation=45)
-
-    plt.grid(True)
-
-    img_stream = io.BytesIO()
-    plt.savefig(img_stream, format='png')
-    img_stream.seek(0)
-    plot_url = base64.b64encode(img_stream.getvalue()).decode('utf-8')
-    plt.close()
-
-    return plot_url
-
-
-def generate_frames():
-    while True:
-        array = picam2.capture_array()
-        ret, buffer = cv2.imencode('.jpg', array)
-        if not ret:
-            break
-        frame = buffer.tobytes()
-        yield (b'--frame\r\n'
-               b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n')
-        time.sleep(SLEEP_DURATION)  # Adjust sleep time for desired frame rate
-
-
-@app.route('/video_feed')
-def video_feed():
-    return Response(generate_frames(), mimetype='multipart/x-mixed-replace; boundary=frame')
-
-
-@app.route('/')
-def index():
-    granularity = request.args.get('granularity', 'minute')
-    cloud_cover = request.args.get('cloud_cover', 50, type=int)
-
-    # Fetch weather data from S3
-    weather_data = fetch_data_from_s3()
-    
-    # Apply low-pass filter to the temperature data based on cloud cover
-    filtered_temperature = low_pass_filter([data['temperature'] for data in weather_data], cloud_cover)
-    
-    # Generate weather plot
-    plot_url = create_plot(weather_data, 'temperature', granularity)
-
-    return render_template('index.html', plot_url=plot_url, weather_data=weather_data, default_attribute='temperature', granularity=granularity, cloud_cover=cloud_cover)
-
-
-@app.route('/plot/<attribute>')
-def plot(attribute):
-    granularity = request.args.get('granularity', 'minute')
-    cloud_cover = request.args.get('cloud_cover', 50, type=int)
-
-    # Fetch weather data from S3
-    weather_data = fetch_data_from_s3()
-    
-    # Apply low-pass filter to the temperature data based on cloud cover
-    filtered_temperature = low_pass_filter([data['temperature'] for data in weather_data], cloud_cover)
-    
-    # Generate the plot for the selected attribute
-    plot_url = create_plot(weather_data, attribute, granularity)
-    
-    return jsonify({'plot_url': plot_url})
+def create_app(storage=None, camera=None, weather_store=None, partitions=None, cameras=None, role=None):
+    """Builds the app. Storage, cameras and weather cache are set up on first use unless passed in.
+
+    role (SERVE_ROLE by default) limits the process to the api or the stream
+    half of the routes and their background services; see serving.py.
+    """
+    app = Flask(__name__)
+    # Request timings and the hot-path histograms, served on /metrics
+    instrument(app)
+    role = serve_role(role)
+    api_route = role_route(app, role, 'api')
+    stream_route = role_route(app, role, 'stream')
+
+    # Initialize storage: S3 behind the on-disk read-through cache unless STORAGE_URL says otherwise
+    if storage is None:
+        storage = Lazy(lambda: open_storage(AWS_ACCESS_KEY, AWS_SECRET_KEY))
+
+    # Local cache of weather readings, kept in sync with S3 and compacted by a background thread;
+    # the stream role only follows what the api role syncs
+    if weather_store is None:
+        weather_store = Lazy(WeatherStore)
+    if partitions is None:
+        partitions = WeatherPartitions()
+    ingest_worker = IngestWorker(weather_store, storage, BUCKET_NAME, partitions=partitions,
+                                 sync=serves(role, 'api')).start()
+
+    # Plots, weather JSON, the live stream and analytics over the worker's snapshots
+    app.register_blueprint(weather_blueprint(ingest_worker, role=role))
+
+    # Cameras from CAMERAS, by default the Pi camera; each is only opened by its first viewer,
+    # then one capture thread per camera encodes each frame once for every viewer.
+    # The api role never opens them, only links to the stream role's feeds
+    if cameras is None:
+        cameras = CameraRegistry({DEFAULT_CAMERA: camera} if camera is not None else cameras_from_env(pi_camera_spec()),
+                                 size=(1920, 1080), fps=FPS)
+
+    @stream_route('/video_feed')
+    @stream_route('/video_feed/<camera_id>')
+    def video_feed(camera_id=None):
+        if camera_id is not None and camera_id not in cameras:
+            return jsonify({'error': f'Unknown camera {camera_id!r}'}), 404
+        # Optional ?w=<width>&q=<quality> for a smaller or lighter stream
+        width = request.args.get('w', type=int)
+        quality = request.args.get('q', type=int)
+        return Response(mjpeg_stream(cameras.get(camera_id), width, quality),
+                        mimetype='multipart/x-mixed-replace; boundary=frame')
+
+    @stream_route('/cameras')
+    def camera_list():
+        # Configured cameras and the ones currently open
+        return jsonify({'default': cameras.default, 'cameras': cameras.status()})
+
+    @api_route('/')
+    def index():
+        granularity = request.args.get('granularity', 'minute')
+        cloud_cover = clamp_cloud_cover(request.args.get('cloud_cover', DEFAULT_CLOUD_COVER, type=int))
+
+        # The page loads the plot itself from /plot, which is cached and served as PNG
+        return render_template('index.html', default_attribute='temperature', granularity=granularity, cloud_cover=cloud_cover)
+
+    app.extensions['ingest_worker'] = ingest_worker
+    app.extensions['cameras'] = cameras
+    return app
 
 
 if __name__ == '__main__':
+    app = create_app()
     app.run(debug=True)
-
+    app.extensions['cameras'].stop()
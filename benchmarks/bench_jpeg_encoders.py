@@ -0,0 +1,126 @@
+"""Measures JPEG encode time and sustained stream FPS for each encoder backend.
+
+Usage: python benchmarks/bench_jpeg_encoders.py --frames recording.mp4 --fps 30 --seconds 5
+
+Frames come from a video file or a .npy array of BGR frames (--frames), or
+are synthetic 1080p frames when none is given. Each software encoder is
+timed at several widths and qualities, then replayed through a
+FrameBroadcaster at the target frame rate to show what the adaptive stream
+settles on. --picamera2 also measures the hardware MJPEG encoder on a Pi.
+"""
+import argparse
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import camera_stream
+from jpeg_encoders import ENCODERS, resize
+
+
+def load_frames(path, limit):
+    if path is None:
+        # Smooth gradients plus noise compress roughly like a real scene
+        y, x = np.mgrid[0:1080, 0:1920]
+        base = np.stack([x % 256, y % 256, (x + y) % 256], axis=-1).astype(np.uint8)
+        rng = np.random.default_rng(0)
+        return [cv2.add(base, rng.integers(0, 24, base.shape, dtype=np.uint8)) for _ in range(min(limit, 30))]
+    if path.endswith('.npy'):
+        return list(np.load(path)[:limit])
+    capture = cv2.VideoCapture(path)
+    frames = []
+    while len(frames) < limit:
+        ret, frame = capture.read()
+        if not ret:
+            break
+        frames.append(frame)
+    capture.release()
+    return frames
+
+
+class ReplayCamera:
+    """Hands out recorded frames in a loop, as fast as they are asked for."""
+
+    def __init__(self, frames):
+        self.frames = frames
+        self.index = 0
+
+    def read(self):
+        frame = self.frames[self.index % len(self.frames)]
+        self.index += 1
+        return frame
+
+    def close(self):
+        pass
+
+
+def time_encoder(encoder, frames, width, quality):
+    scaled = [resize(frame, width) for frame in frames]
+    sizes = []
+    start = time.perf_counter()
+    for frame in scaled:
+        sizes.append(len(encoder.encode(frame, quality)))
+    elapsed = (time.perf_counter() - start) / len(frames)
+    return elapsed * 1000, sum(sizes) / len(sizes) / 1024
+
+
+def stream_fps(encoder, frames, fps, seconds):
+    broadcaster = camera_stream.FrameBroadcaster(ReplayCamera(frames), fps=fps, encoder=encoder)
+    count = 0
+    deadline = time.time() + seconds
+    for frame in broadcaster.frames():
+        frame.jpeg()
+        count += 1
+        if time.time() >= deadline:
+            break
+    settings = (broadcaster.stream_width or frames[0].shape[1], broadcaster.stream_quality)
+    broadcaster.stop()
+    return count / seconds, settings
+
+
+def hardware_fps(seconds):
+    broadcaster = camera_stream.FrameBroadcaster(camera_stream.Picamera2MJPEGCamera())
+    count = 0
+    deadline = time.time() + seconds
+    for frame in broadcaster.frames():
+        frame.jpeg()
+        count += 1
+        if time.time() >= deadline:
+            break
+    broadcaster.stop()
+    return count / seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--frames', help='video file or .npy array of BGR frames')
+    parser.add_argument('--limit', type=int, default=60, help='frames to load')
+    parser.add_argument('--widths', type=int, nargs='+', default=[1920, 1280, 640])
+    parser.add_argument('--qualities', type=int, nargs='+', default=[95, 80, 60])
+    parser.add_argument('--fps', type=int, default=30, help='target stream frame rate')
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--picamera2', action='store_true', help='also measure the hardware MJPEG encoder')
+    args = parser.parse_args()
+
+    frames = load_frames(args.frames, args.limit)
+    height, width = frames[0].shape[:2]
+    print(f"frames={len(frames)} size={width}x{height}")
+    for name, encoder_class in ENCODERS.items():
+        encoder = encoder_class()
+        for target_width in args.widths:
+            for quality in args.qualities:
+                ms, kb = time_encoder(encoder, frames, target_width, quality)
+                print(f"{name:10} w={target_width:<5} q={quality:<3} {ms:7.2f} ms/frame "
+                      f"{1000 / ms:7.1f} fps {kb:8.1f} KiB")
+        achieved, (stream_width, stream_quality) = stream_fps(encoder, frames, args.fps, args.seconds)
+        print(f"{name:10} stream at {args.fps} fps target: {achieved:5.1f} fps, "
+              f"settled on w={stream_width} q={stream_quality}")
+    if args.picamera2:
+        print(f"picamera2  hardware stream: {hardware_fps(args.seconds):5.1f} fps")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""Compares the original Python low_pass_filter loop with the vectorized smoother.
+
+Usage: python benchmarks/bench_low_pass_filter.py --points 1000000
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import timeseries
+from weather_store import ATTRIBUTES
+
+
+def loop_low_pass_filter(data, cloud_cover):
+    """The loop previously defined in API.py and flask_server/app.py."""
+    alpha = cloud_cover / 100
+    filtered_data = []
+    for i in range(len(data)):
+        if i == 0:
+            filtered_data.append(data[i])
+        else:
+            smoothed_value = alpha * data[i] + (1 - alpha) * filtered_data[i - 1]
+            filtered_data.append(smoothed_value)
+    return filtered_data
+
+
+def best_of(repeats, func, *args):
+    # One untimed call first, so the lazy SciPy import is not counted
+    func(*args)
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = func(*args)
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--points', type=int, default=1_000_000)
+    parser.add_argument('--cloud-cover', type=int, default=50)
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    values = rng.normal(20, 5, size=(args.points, len(ATTRIBUTES)))
+    temperature = values[:, 0].tolist()
+
+    loop_time, expected = best_of(1, loop_low_pass_filter, temperature, args.cloud_cover)
+    vector_time, result = best_of(args.repeats, timeseries.low_pass_filter, values[:, 0], args.cloud_cover)
+    numpy_time, fallback = best_of(args.repeats, timeseries._smooth_numpy, values[:, :1], args.cloud_cover / 100)
+    batch_time, _ = best_of(args.repeats, timeseries.smooth_columns, values, args.cloud_cover / 100)
+
+    assert np.allclose(result, expected) and np.allclose(fallback[:, 0], expected)
+    backend = 'scipy' if timeseries._lfilter() is not None else 'numpy'
+    print(f"points={args.points}")
+    print(f"python loop, 1 column:       {loop_time * 1000:9.1f} ms")
+    print(f"vectorized ({backend}), 1 column: {vector_time * 1000:9.1f} ms  ({loop_time / vector_time:.0f}x)")
+    print(f"numpy fallback, 1 column:    {numpy_time * 1000:9.1f} ms  ({loop_time / numpy_time:.0f}x)")
+    print(f"vectorized, {len(ATTRIBUTES)} columns:      {batch_time * 1000:9.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
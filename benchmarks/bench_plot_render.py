@@ -0,0 +1,85 @@
+"""Measures plots per second under concurrent requests for each rendering path.
+
+Usage: python benchmarks/bench_plot_render.py --points 1000 --concurrency 4 --plots 40
+
+'pyplot' is the original global-state renderer, serialised behind a lock
+because it is not safe to run from several threads. 'agg' is the pooled
+Figure/FigureCanvasAgg renderer on request threads, and 'processes' hands
+the same renderer to a pool of worker processes.
+"""
+import argparse
+import io
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.dates as mdates
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import plotting
+
+_pyplot_lock = threading.Lock()
+
+
+def pyplot_plot(df, weather_attribute, granularity):
+    """The pyplot state-machine renderer that create_plot used before."""
+    with _pyplot_lock:
+        plt.figure(figsize=(10, 6))
+        plt.plot(df.index, df[weather_attribute], label=weather_attribute, marker='o')
+        plt.plot(df.index, df['filtered'], label=f'{weather_attribute} (low-pass)')
+        plt.legend()
+        plt.xlabel('Timestamp')
+        plt.ylabel(weather_attribute.capitalize())
+        plt.title(f'{weather_attribute.capitalize()} Over Time (Granularity: {granularity.capitalize()})')
+        axes = plt.gca()
+        axes.xaxis.set_major_locator(mdates.AutoDateLocator())
+        axes.xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m-%d %H:%M:%S'))
+        plt.xticks(rotation=45)
+        plt.grid(True)
+        img_stream = io.BytesIO()
+        plt.savefig(img_stream, format='png')
+        plt.close()
+        return img_stream.getvalue()
+
+
+def make_frame(points):
+    index = pd.date_range('2024-01-01', periods=points, freq='min', name='timestamp')
+    values = 20 + 5 * np.sin(np.arange(points) / 50)
+    return pd.DataFrame({'temperature': values, 'filtered': values}, index=index)
+
+
+def run(render, df, concurrency, plots):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(lambda _: render(df, 'temperature', 'minute'), range(plots)))
+    return plots / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--points', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--plots', type=int, default=40)
+    parser.add_argument('--processes', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    df = make_frame(args.points)
+    print(f"points={args.points} concurrency={args.concurrency} plots={args.plots}")
+    print(f"pyplot:    {run(pyplot_plot, df, args.concurrency, args.plots):6.1f} plots/s")
+    print(f"agg:       {run(plotting.create_plot, df, args.concurrency, args.plots):6.1f} plots/s")
+
+    plotting.RENDER_PROCESSES = args.processes
+    plotting.create_plot(df, 'temperature', 'minute')  # start the workers before timing
+    print(f"processes: {run(plotting.create_plot, df, args.concurrency, args.plots):6.1f} plots/s "
+          f"({args.processes} workers)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""Compares parsing weather objects with plain json.loads against weather_records.parse_reading.
+
+Usage: python benchmarks/bench_records.py --readings 100000
+
+Reports parse time for the original json.loads-into-dicts path and for
+parse_reading, which also validates each object, with and without orjson.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import weather_records
+from weather_records import ATTRIBUTES, parse_reading
+
+
+def make_objects(count):
+    start = datetime(2024, 1, 1)
+    rng = np.random.default_rng(0)
+    objects = []
+    for i in range(count):
+        record = {name: round(float(value), 1) for name, value in zip(ATTRIBUTES, rng.uniform(0, 100, len(ATTRIBUTES)))}
+        record['timestamp'] = 'Unknown' if i % 1000 == 0 else (start + timedelta(minutes=i)).isoformat()
+        objects.append((f'weather_data_{i}.json', json.dumps(record).encode('utf-8')))
+    return objects
+
+
+def as_dicts(objects):
+    # The original path: decode and json.loads into a dict per object
+    return [json.loads(body.decode('utf-8', errors='ignore')) for key, body in objects]
+
+
+def as_readings(objects):
+    return [parse_reading(body) for key, body in objects]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--readings', type=int, default=100000)
+    args = parser.parse_args()
+
+    objects = make_objects(args.readings)
+    orjson = weather_records.orjson
+    paths = [('dicts', as_dicts), ('records', as_readings)]
+    if orjson is not None:
+        def without_orjson(objects):
+            weather_records.orjson = None
+            try:
+                return as_readings(objects)
+            finally:
+                weather_records.orjson = orjson
+        paths.append(('records-json', without_orjson))
+
+    for name, parse in paths:
+        start = time.perf_counter()
+        parse(objects)
+        elapsed = time.perf_counter() - start
+        print(f"{name:12} {args.readings} readings in {elapsed:6.2f} s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""Benchmarks serial against concurrent S3 ingestion using a local moto server.
+
+Usage: python benchmarks/bench_s3_ingest.py --objects 50000 --latency-ms 20
+
+--latency-ms adds a fixed delay to every GetObject call to stand in for the
+round trip to AWS, which a local server does not have. The last two lines
+read the bucket through the on-disk read-through cache, first cold and then
+warm, with the last --workers value.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from moto.server import ThreadedMotoServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import s3_ingest
+from storage import CachedStorage, S3Storage
+
+BUCKET = 'weather-data-iot'
+
+
+def seed_bucket(s3, count):
+    """Uploads count synthetic minute-level readings."""
+    s3.create_bucket(Bucket=BUCKET)
+    start = datetime(2024, 1, 1)
+
+    def put(i):
+        timestamp = start + timedelta(minutes=i)
+        body = json.dumps({
+            'timestamp': timestamp.isoformat(),
+            'temperature': 20 + i % 10,
+            'humidity': 50 + i % 30,
+            'wind_gust': i % 15,
+            'precipitation': 0.0,
+            'cloud_cover': i % 100,
+        })
+        s3.put_object(Bucket=BUCKET, Key=timestamp.strftime('weather_data_%Y-%m-%d_%H-%M-%S.json'), Body=body)
+
+    with ThreadPoolExecutor(max_workers=32) as pool:
+        list(pool.map(put, range(count)))
+
+
+def add_latency(s3, latency_ms):
+    def sleep(**kwargs):
+        time.sleep(latency_ms / 1000)
+    s3.meta.events.register('after-call.s3.GetObject', sleep)
+
+
+def run(storage, workers):
+    start = time.perf_counter()
+    count = sum(1 for _ in s3_ingest.ingest(storage, BUCKET, max_workers=workers))
+    return count, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--objects', type=int, default=5000)
+    parser.add_argument('--latency-ms', type=float, default=20)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 8, 32])
+    args = parser.parse_args()
+
+    server = ThreadedMotoServer(port=0)
+    server.start()
+    host, port = server.get_host_and_port()
+    endpoint = f'http://{host}:{port}'
+    try:
+        seed = s3_ingest.make_client('testing', 'testing', endpoint_url=endpoint, region_name='us-east-1')
+        seed_bucket(seed, args.objects)
+        for workers in args.workers:
+            s3 = s3_ingest.make_client('testing', 'testing', max_workers=workers,
+                                       endpoint_url=endpoint, region_name='us-east-1')
+            add_latency(s3, args.latency_ms)
+            count, elapsed = run(S3Storage(s3), workers)
+            print(f"workers={workers:3d} objects={count} elapsed={elapsed:.2f}s rate={count / elapsed:.0f} obj/s")
+        # s3 and workers are left from the last --workers value
+        with tempfile.TemporaryDirectory() as directory:
+            cached = CachedStorage(S3Storage(s3), os.path.join(directory, 'cache.db'))
+            for state in ['cold', 'warm']:
+                count, elapsed = run(cached, workers)
+                print(f"cache={state:4} objects={count} elapsed={elapsed:.2f}s rate={count / elapsed:.0f} obj/s")
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""Compares building the startup snapshot from SQLite rows with loading compacted partitions.
+
+Usage: python benchmarks/bench_snapshot_load.py --readings 1000000
+
+Reports load time and peak traced Python memory for each path: every row
+from SQLite, the whole history from the partitions, and the
+WEATHER_SNAPSHOT_DAYS window the ingest worker keeps in memory.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from weather_partitions import WeatherPartitions
+from weather_store import ATTRIBUTES, WeatherStore
+from weather_worker import SNAPSHOT_DAYS, WeatherSnapshot
+
+
+def fill(store, readings):
+    timestamps = np.datetime64('2024-01-01T00:00:00') + np.arange(readings) * np.timedelta64(60, 's')
+    values = np.round(np.random.default_rng(0).uniform(0, 100, (readings, len(ATTRIBUTES))), 1)
+    rows = [[str(ts).replace('T', ' ')] + list(row) for ts, row in zip(timestamps, values.tolist())]
+    for start in range(0, readings, 100000):
+        store.insert(rows[start:start + 100000], 'bench', f'key-{start}')
+
+
+def measure(load):
+    tracemalloc.start()
+    start = time.perf_counter()
+    snapshot = load()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return len(snapshot), elapsed, peak / 1024 / 1024
+
+
+def report(name, load):
+    rows, elapsed, peak = measure(load)
+    print(f"{name:10} {rows} readings in {elapsed:6.2f} s, peak {peak:7.1f} MiB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--readings', type=int, default=1000000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        store = WeatherStore(os.path.join(directory, 'weather.db'))
+        fill(store, args.readings)
+        partitions = WeatherPartitions(os.path.join(directory, 'partitions'))
+
+        def from_sqlite():
+            return WeatherSnapshot.empty().extend(store.rows(), None)
+
+        def from_partitions():
+            timestamps, values = partitions.read()
+            return WeatherSnapshot(timestamps, values, 0).extend(store.rows(partitions.last_timestamp), None)
+
+        def window():
+            timestamps, values, rows = partitions.load(store, np.timedelta64(int(SNAPSHOT_DAYS * 24 * 3600), 's'))
+            return WeatherSnapshot(timestamps, values, 0).extend(rows, None)
+
+        # Compaction prunes the compacted days from SQLite, so the full SQLite load is timed first
+        report('sqlite', from_sqlite)
+        partitions.compact(store)
+        report('partitions', from_partitions)
+        report('window', window)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""Checks that importing each Flask app stays within a time budget and skips heavy modules it does not need.
+
+Usage: python benchmarks/check_import_time.py --budget 1.0
+
+Every app is imported in a fresh interpreter. The check fails if an import
+takes longer than the budget or loads any module on the app's forbidden
+list, e.g. the camera service pulling in pandas or matplotlib. Exits with
+status 1 on failure, so it can run in CI.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules that are only needed once a request asks for them
+DEFERRED = ['picamera2', 'boto3', 'matplotlib', 'scipy']
+
+# App file -> modules it must not import at startup
+APPS = {
+    'API.py': DEFERRED,
+    'flask_server/app.py': DEFERRED,
+    'flask_weather.py': DEFERRED + ['cv2'],
+    'flask_server/camera_livestream.py': DEFERRED + ['pandas'],
+    'labelling_app/app.py': DEFERRED + ['pandas'],
+}
+
+IMPORT_APP = '''
+import importlib.util, json, os, sys, time
+path = sys.argv[1]
+sys.path.insert(0, os.path.dirname(path))
+start = time.perf_counter()
+spec = importlib.util.spec_from_file_location('app_under_test', path)
+spec.loader.exec_module(importlib.util.module_from_spec(spec))
+elapsed = time.perf_counter() - start
+print(json.dumps({'seconds': elapsed, 'modules': sorted({name.split('.')[0] for name in sys.modules})}))
+'''
+
+
+def measure(path):
+    output = subprocess.run([sys.executable, '-c', IMPORT_APP, os.path.join(ROOT, path)],
+                            check=True, capture_output=True, text=True, cwd=ROOT).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--budget', type=float, default=1.0, help='seconds allowed per import')
+    args = parser.parse_args()
+
+    failed = False
+    for path, forbidden in APPS.items():
+        result = measure(path)
+        loaded = sorted(set(forbidden) & set(result['modules']))
+        ok = result['seconds'] <= args.budget and not loaded
+        failed |= not ok
+        note = f" loaded {', '.join(loaded)}" if loaded else ''
+        print(f"{'ok  ' if ok else 'FAIL'} {path:35} {result['seconds']:5.2f} s{note}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
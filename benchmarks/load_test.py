@@ -0,0 +1,108 @@
+"""Measures /plot/<attribute> throughput and latency while video clients are connected.
+
+Usage: python benchmarks/load_test.py --url http://127.0.0.1:8000 --stream-url http://127.0.0.1:8001 \
+           --video-clients 4 --concurrency 8 --requests 400
+
+Start the app first, e.g. under gunicorn.conf.py in both roles. Each video
+client holds a /video_feed connection open and reads frames for the whole
+run, while the plot clients send --requests plot requests between them.
+--vary gives each request its own cloud_cover so the plot cache cannot
+answer it and every request renders. Reports requests per second, p50 and
+p99 latency and the frame rate each video client saw.
+"""
+import argparse
+import http.client
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import numpy as np
+
+
+def connect(url):
+    parts = urlsplit(url)
+    connection_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+    return connection_class(parts.hostname, parts.port, timeout=60)
+
+
+def watch_video(url, stop, frames):
+    """Reads /video_feed until stop is set, counting MJPEG parts."""
+    connection = connect(url)
+    connection.request('GET', '/video_feed')
+    response = connection.getresponse()
+    count = 0
+    while not stop.is_set():
+        chunk = response.read1(65536)
+        if not chunk:
+            break
+        count += chunk.count(b'--frame')
+    frames.append(count)
+    connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', default='http://127.0.0.1:8000', help='server for /plot requests')
+    parser.add_argument('--stream-url', help='server for /video_feed, if it is served separately')
+    parser.add_argument('--attribute', default='temperature')
+    parser.add_argument('--video-clients', type=int, default=4)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=400)
+    parser.add_argument('--vary', action='store_true', help='bypass the plot cache')
+    args = parser.parse_args()
+
+    stop = threading.Event()
+    frames = []
+    viewers = [threading.Thread(target=watch_video, args=(args.stream_url or args.url, stop, frames))
+               for _ in range(args.video_clients)]
+    for viewer in viewers:
+        viewer.start()
+    # Let the camera start and every viewer receive its first frames
+    time.sleep(2)
+
+    local = threading.local()
+
+    def plot(index):
+        if not hasattr(local, 'connection'):
+            local.connection = connect(args.url)
+        path = f'/plot/{args.attribute}'
+        if args.vary:
+            path += f'?cloud_cover={index % 101}&max_points={500 + index}'
+        start = time.perf_counter()
+        try:
+            local.connection.request('GET', path)
+            response = local.connection.getresponse()
+            response.read()
+            ok = response.status == 200
+        except (OSError, http.client.HTTPException):
+            local.connection.close()
+            del local.connection
+            ok = False
+        return time.perf_counter() - start, ok
+
+    video_start = time.perf_counter()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(plot, range(args.requests)))
+    elapsed = time.perf_counter() - start
+
+    stop.set()
+    for viewer in viewers:
+        viewer.join()
+    video_seconds = time.perf_counter() - video_start
+
+    latencies = np.array([latency for latency, ok in results if ok]) * 1000
+    errors = sum(not ok for _, ok in results)
+    print(f'{args.video_clients} video clients, {args.concurrency} concurrent plot clients, '
+          f'{args.requests} requests{" (cache bypassed)" if args.vary else ""}')
+    print(f'{len(latencies) / elapsed:8.1f} req/s   {errors} errors')
+    if len(latencies):
+        print(f'p50 {np.percentile(latencies, 50):8.1f} ms   p99 {np.percentile(latencies, 99):8.1f} ms   '
+              f'max {latencies.max():8.1f} ms')
+    if frames:
+        print(f'video: {min(frames) / video_seconds:.1f}-{max(frames) / video_seconds:.1f} fps per client')
+
+
+if __name__ == '__main__':
+    main()
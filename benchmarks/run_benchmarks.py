@@ -0,0 +1,271 @@
+"""Times the hot paths at several history sizes and writes the results as JSON.
+
+Usage: python benchmarks/run_benchmarks.py --sizes 1000,100000,1000000 --output results.json
+       python benchmarks/run_benchmarks.py --stages filter,aggregate --profile profiles/
+
+Stages:
+  sync       WeatherStore.sync from a local moto S3 server (the successor of fetch_data_from_s3)
+  filter     timeseries.low_pass_filter over one column
+  aggregate  weather_routes.query_data for every granularity, i.e. aggregate_data, filtering and downsampling
+  plot_png   plotting.create_plot, the Matplotlib PNG served by API.py and app.py
+  plot_webgl flask_weather.create_plot with decimated WebGL traces
+  plot_full  flask_weather.create_plot with every point and plotly.js inlined
+  encode     JPEG encoding of recorded or synthetic 1080p frames
+  stream     frames per second through FrameBroadcaster and mjpeg_stream
+
+S3 stages seed at most --s3-objects objects, as moto is slow to fill, so
+their sizes are capped at that count. Other stages get one untimed warm-up
+call so lazy imports are not counted, then each stage runs --repeat times
+and min and median seconds are reported. --profile writes a cProfile .prof
+per stage and size, and --py-spy a flame graph SVG (py-spy must be
+installed and allowed to attach to this process).
+"""
+import argparse
+import cProfile
+import json
+import logging
+import os
+import platform
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import camera_stream
+import flask_weather
+import plotting
+import s3_ingest
+import weather_routes
+from bench_jpeg_encoders import ReplayCamera, load_frames
+from jpeg_encoders import DEFAULT_QUALITY, make_encoder
+from storage import S3Storage
+from timeseries import SmoothingCache, low_pass_filter
+from weather_store import ATTRIBUTES, GRANULARITIES, WeatherStore
+from weather_worker import IngestWorker
+
+BUCKET = 'weather-data-iot'
+
+S3_STAGES = ['sync']
+HISTORY_STAGES = ['filter', 'aggregate', 'plot_png', 'plot_webgl', 'plot_full']
+FRAME_STAGES = ['encode', 'stream']
+STAGES = S3_STAGES + HISTORY_STAGES + FRAME_STAGES
+
+
+def synthetic_readings(count):
+    """Minute-level readings with a daily cycle and noise, as (timestamps, values)."""
+    timestamps = np.datetime64('2024-01-01T00:00:00') + np.arange(count) * np.timedelta64(60, 's')
+    rng = np.random.default_rng(0)
+    day = np.sin(np.arange(count) * 2 * np.pi / 1440)[:, None]
+    values = np.round(50 + 20 * day + rng.normal(0, 5, (count, len(ATTRIBUTES))), 1)
+    return timestamps, values
+
+
+def fill_store(store, timestamps, values):
+    rows = [[str(ts).replace('T', ' ')] + row for ts, row in zip(timestamps, values.tolist())]
+    for start in range(0, len(rows), 100000):
+        store.insert(rows[start:start + 100000], 'bench', f'key-{start}')
+
+
+def seed_bucket(s3, timestamps, values):
+    from concurrent.futures import ThreadPoolExecutor
+
+    s3.create_bucket(Bucket=BUCKET)
+
+    def put(i):
+        timestamp = timestamps[i].astype(datetime)
+        body = json.dumps({'timestamp': timestamp.isoformat(), **dict(zip(ATTRIBUTES, values[i].tolist()))})
+        s3.put_object(Bucket=BUCKET, Key=timestamp.strftime('weather_data_%Y-%m-%d_%H-%M-%S.json'), Body=body)
+
+    with ThreadPoolExecutor(max_workers=32) as pool:
+        list(pool.map(put, range(len(timestamps))))
+
+
+@contextmanager
+def profiled(args, name):
+    """Profiles the block with cProfile and/or py-spy, as the command line asks."""
+    profile = cProfile.Profile() if args.profile else None
+    spy = None
+    if args.py_spy:
+        os.makedirs(args.py_spy, exist_ok=True)
+        spy = subprocess.Popen(['py-spy', 'record', '--pid', str(os.getpid()), '--rate', '250',
+                                '--output', os.path.join(args.py_spy, f'{name}.svg')],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        # Give py-spy time to attach before the stage starts
+        time.sleep(1)
+    if profile:
+        profile.enable()
+    try:
+        yield
+    finally:
+        if profile:
+            profile.disable()
+            os.makedirs(args.profile, exist_ok=True)
+            profile.dump_stats(os.path.join(args.profile, f'{name}.prof'))
+        if spy:
+            # py-spy writes its flame graph when interrupted
+            spy.send_signal(signal.SIGINT)
+            spy.wait()
+
+
+def run_stage(args, results, stage, readings, work, units=None, warmup=True, **extra):
+    """Times work() args.repeat times, records the result and prints a summary line."""
+    if warmup:
+        work()
+    times = []
+    name = f'{stage}-{readings}' if readings is not None else stage
+    with profiled(args, name):
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            work()
+            times.append(time.perf_counter() - start)
+    result = {'stage': stage, 'readings': readings, 'repeat': args.repeat,
+              'min_seconds': min(times), 'median_seconds': statistics.median(times), **extra}
+    if units:
+        result['per_second'] = units / min(times)
+    results.append(result)
+    rate = f"  {result['per_second']:10.1f}/s" if units else ''
+    size = f'{readings:>9}' if readings is not None else ' ' * 9
+    print(f"{stage:10} {size}  min {min(times):8.4f} s  median {statistics.median(times):8.4f} s{rate}")
+
+
+def s3_stages(args, results, stages, count, endpoint):
+    s3 = s3_ingest.make_client('testing', 'testing', endpoint_url=endpoint, region_name='us-east-1')
+    # Start from an empty bucket for every size
+    if s3.list_buckets().get('Buckets'):
+        for key in s3_ingest.list_keys(s3, BUCKET):
+            s3.delete_object(Bucket=BUCKET, Key=key)
+        s3.delete_bucket(Bucket=BUCKET)
+    seed_bucket(s3, *synthetic_readings(count))
+
+    with tempfile.TemporaryDirectory() as directory:
+        if 'sync' in stages:
+            def sync():
+                store = WeatherStore(os.path.join(directory, f'sync-{time.perf_counter_ns()}.db'))
+                store.sync(S3Storage(s3), BUCKET)
+            run_stage(args, results, 'sync', count, sync, count, warmup=False)
+
+
+def history_stages(args, results, stages, size):
+    timestamps, values = synthetic_readings(size)
+    with tempfile.TemporaryDirectory() as directory:
+        store = WeatherStore(os.path.join(directory, 'weather.db'))
+        fill_store(store, timestamps, values)
+        snapshot = IngestWorker(store, None, BUCKET)._load_snapshot()
+
+    if 'filter' in stages:
+        column = snapshot.column('temperature')
+        run_stage(args, results, 'filter', size, lambda: low_pass_filter(column, 50), size)
+    if 'aggregate' in stages:
+        def aggregate():
+            # A fresh cache each time, so smoothing is measured rather than looked up
+            cache = SmoothingCache()
+            for granularity in ['minute'] + GRANULARITIES:
+                weather_routes.query_data(cache, snapshot, 'temperature', granularity, 50)
+        run_stage(args, results, 'aggregate', size, aggregate, size)
+    if 'plot_png' in stages:
+        df = weather_routes.query_data(SmoothingCache(), snapshot, 'temperature', 'minute', 50)
+        run_stage(args, results, 'plot_png', size, lambda: plotting.create_plot(df, 'temperature', 'minute'))
+    if 'plot_webgl' in stages:
+        run_stage(args, results, 'plot_webgl', size, lambda: flask_weather.create_plot(snapshot, 'webgl'))
+    if 'plot_full' in stages:
+        run_stage(args, results, 'plot_full', size, lambda: flask_weather.create_plot(snapshot, 'full'))
+
+
+def frame_stages(args, results, stages):
+    frames = load_frames(args.frames, args.frame_count)
+    height, width = frames[0].shape[:2]
+    if 'encode' in stages:
+        encoder = make_encoder()
+
+        def encode():
+            for frame in frames:
+                encoder.encode(frame, DEFAULT_QUALITY)
+        run_stage(args, results, 'encode', None, encode, len(frames), encoder=encoder.name, width=width,
+                  height=height)
+    if 'stream' in stages:
+        def stream():
+            broadcaster = camera_stream.FrameBroadcaster(ReplayCamera(frames), fps=args.fps)
+            parts = camera_stream.mjpeg_stream(broadcaster)
+            for _ in range(args.stream_frames):
+                next(parts)
+            broadcaster.stop()
+        run_stage(args, results, 'stream', None, stream, args.stream_frames, fps=args.fps, width=width,
+                  height=height)
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'cpus': os.cpu_count(),
+        'time': datetime.now().isoformat(timespec='seconds'),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0],
+                                     formatter_class=argparse.RawDescriptionHelpFormatter, epilog=__doc__)
+    parser.add_argument('--sizes', default='1000,100000,1000000', help='comma-separated history sizes')
+    parser.add_argument('--stages', default=','.join(STAGES), help='comma-separated stages to run')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--s3-objects', type=int, default=5000, help='most objects seeded for the S3 stages')
+    parser.add_argument('--frames', help='video file or .npy array of recorded BGR frames')
+    parser.add_argument('--frame-count', type=int, default=30)
+    parser.add_argument('--fps', type=int, default=30, help='camera rate for the stream stage')
+    parser.add_argument('--stream-frames', type=int, default=90)
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--profile', metavar='DIR', help='write a cProfile .prof per stage and size')
+    parser.add_argument('--py-spy', metavar='DIR', help='write a py-spy flame graph per stage and size')
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    stages = args.stages.split(',')
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        parser.error(f"unknown stages: {', '.join(sorted(unknown))}")
+
+    results = []
+    if set(stages) & set(S3_STAGES):
+        from moto.server import ThreadedMotoServer
+
+        # The moto server logs every request
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        server = ThreadedMotoServer(port=0, verbose=False)
+        server.start()
+        host, port = server.get_host_and_port()
+        try:
+            for count in sorted({min(size, args.s3_objects) for size in sizes}):
+                s3_stages(args, results, stages, count, f'http://{host}:{port}')
+        finally:
+            server.stop()
+    if set(stages) & set(HISTORY_STAGES):
+        for size in sizes:
+            history_stages(args, results, stages, size)
+    if set(stages) & set(FRAME_STAGES):
+        frame_stages(args, results, stages)
+
+    report = {'environment': environment(), 'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report))
+
+
+if __name__ == '__main__':
+    main()
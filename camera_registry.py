@@ -0,0 +1,300 @@
+import multiprocessing
+import os
+import queue
+import re
+import time
+from collections import OrderedDict
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from camera_stream import FrameBroadcaster, open_camera
+from jpeg_encoders import HARDWARE_ENCODER
+from lazy import Lazy
+
+# Camera id used when CAMERAS names a single camera without one, and by the routes without a camera id
+DEFAULT_CAMERA = 'default'
+
+# Camera ids appear in URLs
+CAMERA_ID = re.compile(r'^[A-Za-z0-9_-]+$')
+
+# Frames each worker keeps in shared memory; the reader copies the newest while the worker fills the next
+SHARED_SLOTS = 4
+
+# A worker stops capturing when nobody has read a frame for this long, and polls for demand at this interval
+WORKER_IDLE_SECONDS = 10
+WORKER_POLL_SECONDS = 0.1
+
+# How long to wait for a worker's first frame, and for each frame after that
+START_TIMEOUT = 10
+READ_TIMEOUT = 2
+
+# Seconds between attempts when the device stops delivering frames
+WORKER_RETRY_SECONDS = 1
+
+# Seconds before restarting a worker process that died, doubling while it keeps dying
+WORKER_RESTART_SECONDS = 1
+MAX_WORKER_RESTART_SECONDS = 60
+
+# Cameras whose encoded frames only exist in the process that opened them
+IN_PROCESS_KINDS = ('picamera2-mjpeg',)
+
+
+def parse_cameras(value):
+    """Parses 'id=spec,id=spec' into an ordered {camera id: spec}. A bare spec gets the id DEFAULT_CAMERA."""
+    cameras = OrderedDict()
+    for entry in filter(None, (entry.strip() for entry in value.split(','))):
+        camera_id, _, spec = entry.partition('=') if '=' in entry.split(':', 1)[0] else ('', '', entry)
+        camera_id = camera_id.strip() or (DEFAULT_CAMERA if not cameras else str(len(cameras)))
+        if not CAMERA_ID.match(camera_id):
+            raise ValueError(f"Camera id {camera_id!r} may only contain letters, digits, '_' and '-'")
+        if camera_id in cameras:
+            raise ValueError(f"Camera id {camera_id!r} is listed twice")
+        cameras[camera_id] = spec.strip()
+    if not cameras:
+        raise ValueError("No cameras configured")
+    return cameras
+
+
+def cameras_from_env(default_spec):
+    """Cameras from the CAMERAS environment variable, or the app's usual camera as DEFAULT_CAMERA."""
+    return parse_cameras(os.environ.get('CAMERAS') or default_spec)
+
+
+def pi_camera_spec():
+    """The Pi camera, using its hardware MJPEG encoder when JPEG_ENCODER=picamera2, as make_camera does."""
+    return 'picamera2-mjpeg' if os.environ.get('JPEG_ENCODER') == HARDWARE_ENCODER else 'picamera2'
+
+
+def _capture_worker(spec, size, slots, info, stop, latest, generation, condition, last_read):
+    """Runs in the camera's own process: reads frames and publishes them through shared memory.
+
+    The ring is sized by the first frame. If the device later delivers
+    another shape, e.g. a network camera reconnecting at a new resolution,
+    a new ring is announced and the old one removed.
+    """
+    camera = open_camera(spec, size)
+    shm = frames = None
+    seq = 0
+    try:
+        while not stop.is_set():
+            if time.time() - last_read.value > WORKER_IDLE_SECONDS:
+                # Nobody is watching; keep the device open but stop reading it
+                stop.wait(WORKER_POLL_SECONDS)
+                continue
+            image = camera.read()
+            if image is None:
+                print(f"Failed to capture frame from camera {spec}")
+                stop.wait(WORKER_RETRY_SECONDS)
+                continue
+            replaced = frames is None or image.shape != frames.shape[1:] or image.dtype != frames.dtype
+            if replaced:
+                if frames is not None:
+                    print(f"Camera {spec} now delivers {image.shape} frames instead of {frames.shape[1:]}")
+                previous = shm
+                # Readers attach by name, skipping to the newest announcement
+                shm = shared_memory.SharedMemory(create=True, size=image.nbytes * slots)
+                frames = np.ndarray((slots,) + image.shape, image.dtype, shm.buf)
+                info.put((generation.value + 1, shm.name, image.shape, image.dtype.str))
+                if previous is not None:
+                    # Readers still mapping it keep their pages
+                    previous.close()
+                    previous.unlink()
+            seq += 1
+            frames[seq % slots] = image
+            with condition:
+                # A reader sees the new generation together with the first frame in the new ring
+                if replaced:
+                    generation.value += 1
+                latest.value = seq
+                condition.notify_all()
+    finally:
+        frames = None
+        camera.close()
+        if shm is not None:
+            shm.close()
+            shm.unlink()
+
+
+class WorkerCamera:
+    """Camera read by its own process, whose frames arrive through a shared-memory ring.
+
+    Blocking device reads and colour conversion happen outside the web
+    process, so several cameras do not contend for its GIL; read() copies
+    the newest frame out of the ring. Like OpenCVCamera, read() returns None
+    while the device is not delivering frames. A worker that dies, whether
+    it could not open the device or crashed later, is restarted by read(),
+    waiting longer after each restart that delivers no frame.
+    """
+
+    def __init__(self, spec, size=(1920, 1080), slots=SHARED_SLOTS):
+        self.spec = spec
+        self.size = size
+        self.slots = slots
+        self.restarts = 0
+        # Spawned rather than forked, so the worker inherits none of the web server's threads or sockets
+        self._context = multiprocessing.get_context('spawn')
+        self._shm = None
+        self._frames = None
+        self._backoff = WORKER_RESTART_SECONDS
+        self._restart_at = 0
+        self._start()
+
+    def _start(self):
+        # Fresh queues, values and locks for every worker, as one that died may have held the condition
+        context = self._context
+        self._info = context.Queue()
+        self._stop = context.Event()
+        self._latest = context.Value('q', 0, lock=False)
+        # Incremented each time the worker replaces its ring
+        self._generation = context.Value('q', 0, lock=False)
+        self._condition = context.Condition()
+        self._last_read = context.Value('d', time.time(), lock=False)
+        self._attached = 0
+        self._seq = 0
+        self._process = context.Process(
+            target=_capture_worker, name=f'camera-{self.spec}', daemon=True,
+            args=(self.spec, self.size, self.slots, self._info, self._stop, self._latest, self._generation,
+                  self._condition, self._last_read))
+        self._process.start()
+
+    def _restart(self):
+        """Starts a new worker in place of one that died, unless still backing off; returns whether it did."""
+        if time.time() < self._restart_at:
+            return False
+        print(f"Camera worker for {self.spec} exited with code {self._process.exitcode}; restarting it")
+        if self._shm is not None:
+            # A worker that crashed left its ring behind
+            try:
+                self._shm.unlink()
+            except FileNotFoundError:
+                pass
+        self._detach()
+        self._start()
+        self.restarts += 1
+        self._restart_at = time.time() + self._backoff
+        self._backoff = min(self._backoff * 2, MAX_WORKER_RESTART_SECONDS)
+        return True
+
+    def _attach(self, generation, timeout):
+        """Maps the newest ring the worker announced, waiting up to timeout for one of at least generation."""
+        announced = None
+        while announced is None or announced[0] < generation:
+            try:
+                announced = self._info.get(timeout=timeout)
+            except queue.Empty:
+                return False
+        while True:
+            try:
+                announced = self._info.get_nowait()
+            except queue.Empty:
+                break
+        self._detach()
+        generation, name, shape, dtype = announced
+        try:
+            self._shm = shared_memory.SharedMemory(name=name)
+        except FileNotFoundError:
+            # Already replaced; the next read attaches its successor
+            return False
+        self._frames = np.ndarray((self.slots,) + tuple(shape), np.dtype(dtype), self._shm.buf)
+        self._attached = generation
+        return True
+
+    def _detach(self):
+        if self._shm is not None:
+            self._frames = None
+            self._shm.close()
+            self._shm = None
+
+    @property
+    def alive(self):
+        return self._process.is_alive()
+
+    def read(self):
+        if not self._process.is_alive() and not self._restart():
+            return None
+        self._last_read.value = time.time()
+        while True:
+            with self._condition:
+                # The first frame waits for the device to open; a worker that dies meanwhile sends no notification
+                deadline = time.time() + (READ_TIMEOUT if self._attached else START_TIMEOUT)
+                while not self._condition.wait_for(lambda: self._latest.value > self._seq, WORKER_POLL_SECONDS):
+                    if time.time() > deadline or not self._process.is_alive():
+                        return None
+                self._seq = self._latest.value
+                generation = self._generation.value
+            if generation != self._attached and not self._attach(generation, START_TIMEOUT):
+                return None
+            image = self._frames[self._seq % self.slots].copy()
+            # The worker only starts overwriting this slot after publishing slots - 1 newer frames;
+            # if it has, the copy may be torn, so take the newest frame instead
+            if self._latest.value < self._seq + self.slots - 1:
+                self._backoff = WORKER_RESTART_SECONDS
+                return image
+
+    def close(self):
+        self._stop.set()
+        self._process.join(START_TIMEOUT)
+        if self._process.is_alive():
+            self._process.terminate()
+            self._process.join()
+        self._detach()
+
+
+class CameraRegistry:
+    """Cameras by id, each opened by its first viewer or capture and shared through a FrameBroadcaster.
+
+    Cameras given as spec strings are read by a WorkerCamera process each;
+    camera objects, such as test doubles, are read in this process.
+    """
+
+    def __init__(self, cameras, size=(1920, 1080), fps=None):
+        self.size = size
+        self.fps = fps
+        self._sources = OrderedDict(cameras)
+        self._broadcasters = OrderedDict(
+            (camera_id, Lazy(lambda source=source: self._open(source))) for camera_id, source in self._sources.items())
+
+    def _open(self, source):
+        if not isinstance(source, str):
+            camera = source
+        elif source.partition(':')[0] in IN_PROCESS_KINDS:
+            camera = open_camera(source, self.size)
+        else:
+            camera = WorkerCamera(source, self.size)
+        return FrameBroadcaster(camera, fps=self.fps)
+
+    @property
+    def default(self):
+        """Id of the camera served by the routes without a camera id: DEFAULT_CAMERA, or else the first listed."""
+        return DEFAULT_CAMERA if DEFAULT_CAMERA in self._sources else next(iter(self._sources))
+
+    def ids(self):
+        return list(self._sources)
+
+    def __contains__(self, camera_id):
+        return camera_id in self._broadcasters
+
+    def get(self, camera_id=None):
+        """The camera's broadcaster, opened on first use; KeyError for an unknown id."""
+        return self._broadcasters[camera_id or self.default]
+
+    def status(self):
+        cameras = []
+        for camera_id, source in self._sources.items():
+            broadcaster = self._broadcasters[camera_id]
+            entry = {'id': camera_id, 'source': source if isinstance(source, str) else type(source).__name__,
+                     'open': broadcaster.created}
+            if broadcaster.created:
+                entry['stream_width'] = broadcaster.stream_width or broadcaster.native_width
+                entry['stream_quality'] = broadcaster.stream_quality
+                entry['worker_alive'] = getattr(broadcaster.camera, 'alive', None)
+                entry['worker_restarts'] = getattr(broadcaster.camera, 'restarts', None)
+            cameras.append(entry)
+        return cameras
+
+    def stop(self):
+        """Stops every camera that was opened, and its worker process."""
+        for broadcaster in self._broadcasters.values():
+            if broadcaster.created:
+                broadcaster.stop()
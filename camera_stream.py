@@ -0,0 +1,365 @@
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+import cv2
+
+from jpeg_encoders import CAPTURE_QUALITY, DEFAULT_QUALITY, HARDWARE_ENCODER, decode, make_encoder, resize
+from metrics import JPEG_ENCODE_SECONDS, STREAM_FPS
+
+# Recent frames kept for captures and slow viewers
+RING_SIZE = 8
+
+# Stop capturing once nobody has watched or asked for a frame for this long
+IDLE_SECONDS = 10
+
+# Seconds to wait before reopening a camera that stopped returning frames
+RETRY_SECONDS = 1
+
+# Client-requested sizes and qualities are rounded so that similar requests share an encoding
+WIDTH_STEP = 32
+QUALITY_STEP = 5
+MIN_WIDTH = 160
+
+# Limits for burst captures
+MAX_BURST_COUNT = 20
+MAX_BURST_INTERVAL_MS = 10000
+
+# Adaptive stream settings: back off when encoding takes more than this share of the frame interval
+ENCODE_BUDGET = 0.5
+DEFAULT_INTERVAL = 0.1
+QUALITY_ADAPT_STEP = 10
+MIN_STREAM_QUALITY = 50
+MIN_STREAM_WIDTH = 640
+
+
+class OpenCVCamera:
+    """USB or built-in camera read through cv2.VideoCapture."""
+
+    def __init__(self, index=0):
+        self.index = index
+        self._capture = cv2.VideoCapture(index)
+
+    def read(self):
+        ret, frame = self._capture.read()
+        return frame if ret else None
+
+    def close(self):
+        self._capture.release()
+
+
+class Picamera2Camera:
+    """Raspberry Pi camera module read through Picamera2."""
+
+    def __init__(self, size=(1920, 1080), camera_num=0):
+        from picamera2 import Picamera2
+
+        self._picam2 = Picamera2(camera_num)
+        camera_config = self._picam2.create_preview_configuration(main={"format": 'RGB888', "size": size})
+        self._picam2.configure(camera_config)
+        self._picam2.start()
+        time.sleep(1)
+
+    def read(self):
+        return self._picam2.capture_array()
+
+    def close(self):
+        self._picam2.close()
+
+
+class Picamera2MJPEGCamera:
+    """Raspberry Pi camera whose frames are JPEG encoded by the hardware MJPEG encoder.
+
+    read_encoded() hands out the encoder's output directly, so the default
+    stream costs no CPU for encoding. Other sizes and qualities are decoded
+    and re-encoded in software on demand.
+    """
+
+    def __init__(self, size=(1280, 720), camera_num=0):
+        from picamera2 import Picamera2
+        from picamera2.encoders import MJPEGEncoder
+        from picamera2.outputs import Output
+
+        camera = self
+
+        class LatestFrameOutput(Output):
+            def outputframe(self, frame, *args, **kwargs):
+                with camera._condition:
+                    camera._jpeg = bytes(frame)
+                    camera._condition.notify_all()
+
+        self._jpeg = None
+        self._condition = threading.Condition()
+        self._picam2 = Picamera2(camera_num)
+        self._picam2.configure(self._picam2.create_video_configuration(main={"size": size}))
+        self._picam2.start_recording(MJPEGEncoder(), LatestFrameOutput())
+
+    def read_encoded(self, timeout=2):
+        """Returns (None, jpeg) for the next frame from the hardware encoder."""
+        with self._condition:
+            self._jpeg = None
+            if not self._condition.wait_for(lambda: self._jpeg is not None, timeout):
+                return None, None
+            return None, self._jpeg
+
+    def close(self):
+        self._picam2.stop_recording()
+        self._picam2.close()
+
+
+def _round_down(value, step):
+    return max(step, value - value % step)
+
+
+class Frame:
+    """One captured frame. JPEG variants are encoded on first use and shared by every viewer."""
+
+    def __init__(self, seq, timestamp, image, broadcaster, jpeg=None):
+        self.seq = seq
+        self.timestamp = timestamp
+        self._image = image
+        self._broadcaster = broadcaster
+        # Stream settings in force when the frame was taken
+        self.default_variant = (broadcaster.stream_width, broadcaster.stream_quality)
+        self._variants = {}
+        if jpeg is not None:
+            self._variants[(None, None)] = jpeg
+        self._lock = threading.Lock()
+
+    @property
+    def image(self):
+        if self._image is None:
+            self._image = decode(self._variants[(None, None)])
+        return self._image
+
+    def jpeg(self, width=None, quality=None):
+        """Returns the frame as JPEG, scaled to width pixels wide and at the given quality.
+
+        Leaving both out gives the stream's default, which is the hardware
+        encoder's output when the camera provides one.
+        """
+        if width is None and quality is None:
+            key = (None, None) if (None, None) in self._variants else self.default_variant
+        else:
+            native = self.image.shape[1]
+            width = min(_round_down(width, WIDTH_STEP), native) if width else native
+            width = None if width >= native else max(width, MIN_WIDTH)
+            quality = min(max(_round_down(quality or DEFAULT_QUALITY, QUALITY_STEP), 10), 95)
+            key = (width, quality)
+        with self._lock:
+            if key not in self._variants:
+                started = time.perf_counter()
+                encoder = self._broadcaster.encoder
+                self._variants[key] = encoder.encode(resize(self.image, key[0]), key[1])
+                elapsed = time.perf_counter() - started
+                JPEG_ENCODE_SECONDS.observe(elapsed, encoder=encoder.name)
+                if key == self.default_variant:
+                    self._broadcaster.record_encode_time(elapsed)
+            return self._variants[key]
+
+
+class FrameBroadcaster:
+    """Reads one camera on a single thread and shares each frame with every viewer.
+
+    Frames go into a small ring buffer. Viewers always take the newest frame,
+    so a slow client skips frames instead of holding up the capture thread.
+    Each JPEG variant of a frame is encoded once however many viewers want it.
+    When encoding the default stream takes too long for the target frame
+    rate, its quality and then its width are stepped down, and raised again
+    once there is headroom.
+    """
+
+    def __init__(self, camera, fps=None, ring_size=RING_SIZE, encoder=None,
+                 quality=DEFAULT_QUALITY, width=None):
+        self.camera = camera
+        self.interval = 1 / fps if fps else 0
+        self.encoder = encoder or make_encoder()
+        self.max_quality = self.stream_quality = quality
+        self.max_width = self.stream_width = width
+        self.encode_time = None
+        self.native_width = None
+        self._adapt_lock = threading.Lock()
+        self._ring = deque(maxlen=ring_size)
+        self._seq = 0
+        self._viewers = 0
+        self._last_demand = 0
+        self._running = True
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='camera-capture', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while self._running:
+            with self._condition:
+                # Sleep while nobody is watching
+                while self._running and not self._viewers and time.time() - self._last_demand > IDLE_SECONDS:
+                    self._condition.wait()
+            started = time.time()
+            if hasattr(self.camera, 'read_encoded'):
+                image, jpeg = self.camera.read_encoded()
+            else:
+                image, jpeg = self.camera.read(), None
+            if image is None and jpeg is None:
+                print("Failed to capture frame from camera")
+                time.sleep(RETRY_SECONDS)
+                continue
+            if image is not None:
+                self.native_width = image.shape[1]
+            with self._condition:
+                self._seq += 1
+                self._ring.append(Frame(self._seq, started, image, self, jpeg))
+                self._condition.notify_all()
+            time.sleep(max(0, self.interval - (time.time() - started)))
+
+    def record_encode_time(self, seconds):
+        """Tracks how long the default stream takes to encode and adapts its settings."""
+        with self._adapt_lock:
+            self.encode_time = seconds if self.encode_time is None else 0.8 * self.encode_time + 0.2 * seconds
+            budget = (self.interval or DEFAULT_INTERVAL) * ENCODE_BUDGET
+            if self.encode_time > budget:
+                self._step_down()
+            elif self.encode_time < budget / 3:
+                self._step_up()
+
+    def _step_down(self):
+        if self.stream_quality > MIN_STREAM_QUALITY:
+            self.stream_quality -= QUALITY_ADAPT_STEP
+        elif (self.stream_width or self.native_width) > MIN_STREAM_WIDTH:
+            width = (self.stream_width or self.native_width) * 3 // 4
+            self.stream_width = max(MIN_STREAM_WIDTH, _round_down(width, WIDTH_STEP))
+        else:
+            return
+        # Measure again at the new settings
+        self.encode_time = None
+
+    def _step_up(self):
+        if self.stream_width != self.max_width:
+            width = _round_down(self.stream_width * 4 // 3, WIDTH_STEP)
+            self.stream_width = self.max_width if width >= (self.max_width or self.native_width) else width
+        elif self.stream_quality < self.max_quality:
+            self.stream_quality = min(self.max_quality, self.stream_quality + QUALITY_ADAPT_STEP)
+        else:
+            return
+        self.encode_time = None
+
+    def _demand(self):
+        self._last_demand = time.time()
+        self._condition.notify_all()
+
+    def wait_for_frame(self, after_seq=0, timeout=5):
+        """Returns the newest frame with a sequence number above after_seq, or None on timeout."""
+        deadline = time.time() + timeout
+        with self._condition:
+            self._demand()
+            while not self._ring or self._ring[-1].seq <= after_seq:
+                remaining = deadline - time.time()
+                if remaining <= 0 or not self._running:
+                    return None
+                self._condition.wait(remaining)
+            return self._ring[-1]
+
+    def latest(self, max_age=1.0, timeout=5):
+        """Returns the newest frame, waiting for a fresh one if the buffered frame is older than max_age."""
+        with self._condition:
+            newest = self._ring[-1] if self._ring else None
+        if newest and time.time() - newest.timestamp <= max_age:
+            return newest
+        return self.wait_for_frame(newest.seq if newest else 0, timeout)
+
+    def burst(self, count, interval=0, timeout=5, on_frame=None):
+        """Takes up to count distinct frames at least interval seconds apart.
+
+        Each frame is handed to on_frame(frame, seq) as it arrives and the
+        results are returned, so a caller that encodes and spools it there
+        never holds more than one raw frame; without on_frame the frames
+        themselves are returned. The burst stops early if the camera stops
+        delivering frames.
+        """
+        on_frame = on_frame or (lambda frame, seq: frame)
+        frame = self.latest(timeout=timeout)
+        results = []
+        while frame is not None:
+            results.append(on_frame(frame, len(results)))
+            if len(results) == count:
+                break
+            previous, due = frame, frame.timestamp + interval
+            time.sleep(max(0, due - time.time()))
+            # The newest frame may have been taken just before it was due
+            while frame is not None and (frame is previous or frame.timestamp < due):
+                frame = self.wait_for_frame(frame.seq, timeout)
+        return results
+
+    def frames(self):
+        """Yields frames for one viewer until the broadcaster stops."""
+        with self._condition:
+            self._viewers += 1
+            self._demand()
+        try:
+            seq = 0
+            while self._running:
+                frame = self.wait_for_frame(seq)
+                if frame is not None:
+                    seq = frame.seq
+                    yield frame
+        finally:
+            with self._condition:
+                self._viewers -= 1
+
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify_all()
+        self._thread.join()
+        self.camera.close()
+
+
+def make_camera(size=(1920, 1080)):
+    """Opens the Pi camera, using the hardware MJPEG encoder when JPEG_ENCODER=picamera2."""
+    if os.environ.get('JPEG_ENCODER') == HARDWARE_ENCODER:
+        return Picamera2MJPEGCamera(size)
+    return Picamera2Camera(size)
+
+
+def open_camera(spec, size=(1920, 1080)):
+    """Opens the camera a spec names: 'opencv:<index or URL>', 'picamera2[:<num>]' or 'picamera2-mjpeg[:<num>]'.
+
+    OpenCV sources that are not an index, such as rtsp:// URLs of cameras
+    at another site, are passed to cv2.VideoCapture as they are.
+    """
+    kind, _, source = spec.partition(':')
+    if kind == 'opencv':
+        return OpenCVCamera(int(source) if source.isdigit() else source or 0)
+    if kind == 'picamera2':
+        return Picamera2Camera(size, int(source or 0))
+    if kind == 'picamera2-mjpeg':
+        return Picamera2MJPEGCamera(size, int(source or 0))
+    raise ValueError(f"Unknown camera {spec!r}; expected opencv:<index or URL>, picamera2 or picamera2-mjpeg")
+
+
+def mjpeg_stream(broadcaster, width=None, quality=None):
+    """Wraps a viewer's frames as a multipart/x-mixed-replace MJPEG body at the requested size and quality."""
+    sent = 0
+    window_start = time.monotonic()
+    for frame in broadcaster.frames():
+        yield (b'--frame\r\n'
+               b'Content-Type: image/jpeg\r\n\r\n' + frame.jpeg(width, quality) + b'\r\n')
+        # The rate this viewer actually gets, once a second
+        sent += 1
+        elapsed = time.monotonic() - window_start
+        if elapsed >= 1:
+            STREAM_FPS.observe(sent / elapsed)
+            sent = 0
+            window_start = time.monotonic()
+
+
+def capture_jpeg(frame):
+    """Encodes a frame for the dataset at full resolution."""
+    return frame.jpeg(quality=CAPTURE_QUALITY)
+
+
+def capture_key(label, frame, seq=0):
+    """Object key for a labelled capture, unique per frame time and position in a burst."""
+    taken_at = datetime.fromtimestamp(frame.timestamp).strftime('%Y-%m-%d_%H-%M-%S-%f')
+    return f"{label}_{taken_at}_{seq:03d}.jpg"
@@ -1,179 +1,158 @@
-from flask import Flask, render_template, jsonify, request, Response
-import boto3
-import json
-import matplotlib.pyplot as plt
-import io
-import base64
-import re
-import cv2
-from datetime import datetime
-import pandas as pd
-
-app = Flask(__name__)
-
-# AWS credentials and bucket names
+from flask import Flask, render_template, jsonify, request, Response, session
+import os
+import sys
+
+# Shared modules live in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from camera_registry import DEFAULT_CAMERA, CameraRegistry, cameras_from_env
+from camera_stream import MAX_BURST_COUNT, MAX_BURST_INTERVAL_MS, capture_jpeg, capture_key, mjpeg_stream
+from lazy import Lazy
+from metrics import instrument
+from serving import role_route, serve_role, serves
+from storage import LABEL_BUCKETS, WEATHER_BUCKET, open_storage
+from upload_queue import UploadQueue
+from weather_routes import DEFAULT_CLOUD_COVER, clamp_cloud_cover, weather_blueprint
+from weather_store import WeatherStore
+from weather_partitions import WeatherPartitions
+from weather_worker import IngestWorker
+
+# AWS credentials and bucket names; STORAGE_URL can point the app at MinIO or a local directory instead
 AWS_ACCESS_KEY = ""
 AWS_SECRET_KEY = ""
-WEATHER_BUCKET_NAME = "weather-data-iot"
-SITTING_BUCKET_NAME = "sitting-down-data"
-STANDING_BUCKET_NAME = "standing-up-data"
-
-# Initialize S3 client
-s3 = boto3.client('s3', aws_access_key_id=AWS_ACCESS_KEY, aws_secret_access_key=AWS_SECRET_KEY)
-
-# Camera setup for image capture
-camera = cv2.VideoCapture(0)
-
-# Session state
-session_active = False
-
-# Extract timestamp from S3 file name
-def extract_timestamp_from_filename(filename):
-    match = re.match(r"weather_data_(\d{4})-(\d{2})-(\d{2})_(\d{2})-(\d{2})-(\d{2})\.json", filename)
-    if match:
-        year, month, day, hour, minute, second = match.groups()
-        return datetime(int(year), int(month), int(day), int(hour), int(minute), int(second))
-    return None
-
-# Fetch weather data from S3
-def fetch_data_from_s3():
-    files = s3.list_objects_v2(Bucket=WEATHER_BUCKET_NAME)
-    data = []
-    for file in files.get('Contents', []):
-        file_key = file['Key']
-        timestamp = extract_timestamp_from_filename(file_key)
-        if timestamp:
-            response = s3.get_object(Bucket=WEATHER_BUCKET_NAME, Key=file_key)
-            file_content = response['Body'].read().decode('utf-8')
-            json_data = json.loads(file_content)
-            json_data["timestamp"] = timestamp.strftime('%Y-%m-%d %H:%M:%S')
-            data.append(json_data)
-    return data
-
-# Low-pass filter for smoothing the data
-def low_pass_filter(data, cloud_cover):
-    alpha = cloud_cover / 100
-    filtered_data = []
-    for i in range(len(data)):
-        if i == 0:
-            filtered_data.append(data[i])
-        else:
-            smoothed_value = alpha * data[i] + (1 - alpha) * filtered_data[i-1]
-            filtered_data.append(smoothed_value)
-    return filtered_data
-
-# Aggregate data based on granularity (minute, hour, day)
-def aggregate_data(weather_data, granularity):
-    df = pd.DataFrame(weather_data)
-    df['timestamp'] = pd.to_datetime(df['timestamp'])
-    df.set_index('timestamp', inplace=True)
-    if granularity == 'hour':
-        return df.resample('H').mean()
-    elif granularity == 'day':
-        return df.resample('D').mean()
-    return df
-
-# Create plot for a given weather attribute
-def create_plot(weather_data, weather_attribute, granularity):
-    df_resampled = aggregate_data(weather_data, granularity)
-    plt.figure(figsize=(10, 6))
-    plt.plot(df_resampled.index, df_resampled[weather_attribute], label=weather_attribute, marker='o')
-    plt.xlabel('Timestamp')
-    plt.ylabel(weather_attribute.capitalize())
-    plt.title(f'{weather_attribute.capitalize()} Over Time (Granularity: {granularity.capitalize()})')
-
-    # Customize x-axis tick formatting based on granularity
-    if granularity == 'day':
-        plt.xticks(df_resampled.index, df_resampled.index.strftime('%Y-%m-%d'), rotation=45)
-    elif granularity == 'hour':
-        plt.xticks(df_resampled.index, df_resampled.index.strftime('%Y-%m-%d %H:%M'), rotation=45)
-    else:
-        plt.xticks(df_resampled.index, df_resampled.index.strftime('%Y-%m-%d %H:%M:%S'), rotation=45)
-
-    plt.grid(True)
-
-    img_stream = io.BytesIO()
-    plt.savefig(img_stream, format='png')
-    img_stream.seek(0)
-    plot_url = base64.b64encode(img_stream.getvalue()).decode('utf-8')
-    plt.close()
-
-    return plot_url
-
-# Upload image to the appropriate S3 bucket (sitting or standing)
-def upload_image_to_s3(image, label):
-    timestamp = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
-    filename = f"{label}_{timestamp}.jpg"
-    bucket_name = SITTING_BUCKET_NAME if label == "sitting_down" else STANDING_BUCKET_NAME
-    s3.put_object(Body=image, Bucket=bucket_name, Key=filename)
-
-# Routes
-@app.route('/')
-def index():
-    global session_active
-    granularity = request.args.get('granularity', 'minute')
-    weather_data = fetch_data_from_s3()
-    cloud_cover = weather_data[-1].get('cloud_cover', 50)  # Use latest cloud cover value
-    plot_url = create_plot(weather_data, 'temperature', granularity)
-
-    return render_template('index.html', plot_url=plot_url, weather_data=weather_data, default_attribute='temperature', granularity=granularity, cloud_cover=cloud_cover)
-
-@app.route('/plot/<attribute>')
-def plot(attribute):
-    granularity = request.args.get('granularity', 'minute')
-    weather_data = fetch_data_from_s3()
-    plot_url = create_plot(weather_data, attribute, granularity)
-    return jsonify({'plot_url': plot_url})
-
-# Start session for image capture
-@app.route('/start_session', methods=['POST'])
-def start_session():
-    global session_active
-    session_active = True
-    return jsonify({"message": "Session started!"})
-
-# Stop session for image capture
-@app.route('/stop_session', methods=['POST'])
-def stop_session():
-    global session_active
-    session_active = False
-    return jsonify({"message": "Session stopped!"})
-
-# Capture image for sitting-down or standing-up
-@app.route('/capture/<label>', methods=['POST'])
-def capture(label):
-    global session_active
-    if not session_active:
-        return jsonify({'error': 'Session is not active. Please start the session first.'}), 400
-
-    if label not in ['sitting_down', 'standing_up']:
-        return jsonify({'error': 'Invalid label'}), 400
-
-    ret, frame = camera.read()
-    if not ret:
-        return jsonify({'error': 'Failed to capture image'}), 500
-
-    _, buffer = cv2.imencode('.jpg', frame)
-    image = buffer.tobytes()
-
-    upload_image_to_s3(image, label)
-
-    return jsonify({'message': f"Image labeled as '{label}' and uploaded to S3."})
-
-# Video feed route for live camera stream
-@app.route('/video_feed')
-def video_feed():
-    def generate():
-        while True:
-            ret, frame = camera.read()
-            if not ret:
-                break
-            _, jpeg = cv2.imencode('.jpg', frame)
-            frame = jpeg.tobytes()
-            yield (b'--frame\r\n'
-                   b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n')
-    return Response(generate(), mimetype='multipart/x-mixed-replace; boundary=frame')
+WEATHER_BUCKET_NAME = WEATHER_BUCKET
+
+# Queue image for upload to the appropriate S3 bucket (sitting or standing)
+def upload_image_to_s3(upload_queue, image, label, filename):
+    bucket_name = LABEL_BUCKETS[label]
+    upload_queue.put(image, bucket_name, filename)
+    return {'bucket': bucket_name, 'key': filename}
+
+# Build the app; storage, cameras and weather cache are set up on first use unless passed in.
+# role (SERVE_ROLE by default) limits the process to the api or the stream half; see serving.py
+def create_app(storage=None, camera=None, weather_store=None, partitions=None, cameras=None, role=None):
+    app = Flask(__name__)
+    # Signs the session cookie that tracks each client's capture session; set it when running several workers
+    app.secret_key = os.environ.get('FLASK_SECRET_KEY') or os.urandom(24)
+    # Request timings and the hot-path histograms, served on /metrics
+    instrument(app)
+    role = serve_role(role)
+    api_route = role_route(app, role, 'api')
+    stream_route = role_route(app, role, 'stream')
+
+    # Initialize storage: S3 behind the on-disk read-through cache unless STORAGE_URL says otherwise
+    if storage is None:
+        storage = Lazy(lambda: open_storage(AWS_ACCESS_KEY, AWS_SECRET_KEY))
+
+    # Captures are spooled to disk and uploaded in the background, by the role that captures them
+    upload_queue = UploadQueue(storage).start() if serves(role, 'stream') else None
+
+    # Local cache of weather readings, kept in sync with S3 and compacted by a background thread;
+    # the stream role only follows what the api role syncs
+    if weather_store is None:
+        weather_store = Lazy(WeatherStore)
+    if partitions is None:
+        partitions = WeatherPartitions()
+    ingest_worker = IngestWorker(weather_store, storage, WEATHER_BUCKET_NAME, partitions=partitions,
+                                 sync=serves(role, 'api')).start()
+
+    # Plots, weather JSON, the live stream and analytics; unless the slider overrides it, plots are smoothed
+    # by the latest cloud cover reading
+    app.register_blueprint(weather_blueprint(ingest_worker, follow_cloud_cover=True, role=role))
+
+    # Cameras by id from CAMERAS (default: the USB camera at index 0), each opened by its first viewer or capture
+    # and read by its own worker process; one capture thread per camera then feeds every viewer.
+    # Only the stream role opens them; the api role just lists them on the page
+    if cameras is None:
+        cameras = CameraRegistry({DEFAULT_CAMERA: camera} if camera is not None else cameras_from_env('opencv:0'))
+
+    @api_route('/')
+    def index():
+        granularity = request.args.get('granularity', 'minute')
+        snapshot = ingest_worker.snapshot()
+        # Use latest cloud cover value unless the slider overrides it
+        cloud_cover = request.args.get('cloud_cover', snapshot.latest('cloud_cover', DEFAULT_CLOUD_COVER), type=int)
+        cloud_cover = clamp_cloud_cover(cloud_cover)
+        # The page loads the plot itself from /plot, which is cached and served as PNG
+        return render_template('index.html', default_attribute='temperature', granularity=granularity, cloud_cover=cloud_cover,
+                               cameras=cameras.ids(), default_camera=cameras.default)
+
+    # Captures still waiting to reach S3
+    @stream_route('/upload_queue')
+    def upload_queue_status():
+        return jsonify(upload_queue.status())
+
+    # Configured cameras and the ones currently open
+    @stream_route('/cameras')
+    def camera_list():
+        return jsonify({'default': cameras.default, 'cameras': cameras.status()})
+
+    # Start session for image capture; each client has its own, kept in its session cookie
+    @stream_route('/start_session', methods=['POST'])
+    def start_session():
+        session['capture_session'] = True
+        return jsonify({"message": "Session started!"})
+
+    # Stop session for image capture
+    @stream_route('/stop_session', methods=['POST'])
+    def stop_session():
+        session.pop('capture_session', None)
+        return jsonify({"message": "Session stopped!"})
+
+    # Capture one image or a burst for sitting-down or standing-up, from the default camera or the one named
+    @stream_route('/capture/<label>', methods=['POST'])
+    @stream_route('/capture/<camera_id>/<label>', methods=['POST'])
+    def capture(label, camera_id=None):
+        if not session.get('capture_session'):
+            return jsonify({'error': 'Session is not active. Please start the session first.'}), 400
+
+        if camera_id is not None and camera_id not in cameras:
+            return jsonify({'error': f'Unknown camera {camera_id!r}'}), 404
+
+        if label not in LABEL_BUCKETS:
+            return jsonify({'error': 'Invalid label'}), 400
+
+        # ?count=N&interval_ms=M captures a burst of N frames at least M ms apart
+        count = request.args.get('count', 1, type=int)
+        interval_ms = request.args.get('interval_ms', 0, type=int)
+        if not 1 <= count <= MAX_BURST_COUNT or not 0 <= interval_ms <= MAX_BURST_INTERVAL_MS:
+            return jsonify({'error': f'count must be 1-{MAX_BURST_COUNT} and interval_ms 0-{MAX_BURST_INTERVAL_MS}'}), 400
+
+        # Keys from other cameras are told apart by a camera id prefix
+        prefix = f'{camera_id}_' if camera_id and camera_id != cameras.default else ''
+
+        # Each frame is encoded at full resolution and spooled as it arrives, so a burst holds one raw frame at a time
+        def spool(frame, seq):
+            return upload_image_to_s3(upload_queue, capture_jpeg(frame), label, prefix + capture_key(label, frame, seq))
+
+        manifest = cameras.get(camera_id).burst(count, interval_ms / 1000, on_frame=spool)
+        if not manifest:
+            return jsonify({'error': 'Failed to capture image'}), 500
+
+        return jsonify({'message': f"{len(manifest)} image(s) labeled as '{label}' and queued for upload to S3.",
+                        'images': manifest, 'queue_depth': upload_queue.depth()})
+
+    # Video feed route for live camera stream, from the default camera or the one named
+    @stream_route('/video_feed')
+    @stream_route('/video_feed/<camera_id>')
+    def video_feed(camera_id=None):
+        if camera_id is not None and camera_id not in cameras:
+            return jsonify({'error': f'Unknown camera {camera_id!r}'}), 404
+        # Every viewer of a camera shares the frames encoded by its capture thread
+        # Optional ?w=<width>&q=<quality> for a smaller or lighter stream
+        width = request.args.get('w', type=int)
+        quality = request.args.get('q', type=int)
+        return Response(mjpeg_stream(cameras.get(camera_id), width, quality),
+                        mimetype='multipart/x-mixed-replace; boundary=frame')
+
+    app.extensions['ingest_worker'] = ingest_worker
+    if upload_queue is not None:
+        app.extensions['upload_queue'] = upload_queue
+    app.extensions['cameras'] = cameras
+    return app
 
 if __name__ == '__main__':
+    app = create_app()
     app.run(debug=True)
-
+    if 'upload_queue' in app.extensions:
+        app.extensions['upload_queue'].stop()
+    app.extensions['cameras'].stop()
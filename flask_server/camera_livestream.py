@@ -1,39 +1,46 @@
-from flask import Flask, Response
-from picamera2 import Picamera2
-import time
-import cv2
-import io
-import numpy as np
+from flask import Flask, Response, jsonify, request
+import os
+import sys
 
-app = Flask(__name__)
+# Shared modules live in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from camera_registry import DEFAULT_CAMERA, CameraRegistry, cameras_from_env, pi_camera_spec
+from camera_stream import mjpeg_stream
+from metrics import instrument
 
-# Initialize Picamera2
-picam2 = Picamera2()
-camera_config = picam2.create_preview_configuration(main={"format": 'RGB888', "size": (1920, 1080)}) # Use main with a larger size
-picam2.configure(camera_config)
-picam2.start()
-time.sleep(1)
+FPS = 10 # Target FPS
 
 
-FPS = 10 # Target FPS
-SLEEP_DURATION = 1/FPS
+def create_app(camera=None, cameras=None):
+    app = Flask(__name__)
+    # Request timings and the hot-path histograms, served on /metrics
+    instrument(app)
+
+    # Cameras from CAMERAS, by default the Pi camera, using its hardware encoder when JPEG_ENCODER=picamera2.
+    # Each is opened by its first viewer; one capture thread per camera encodes each frame once for every viewer
+    if cameras is None:
+        cameras = CameraRegistry({DEFAULT_CAMERA: camera} if camera is not None else cameras_from_env(pi_camera_spec()),
+                                 size=(1920, 1080), fps=FPS)
 
+    @app.route('/cameras')
+    def camera_list():
+        return jsonify({'default': cameras.default, 'cameras': cameras.status()})
 
-def generate_frames():
-    while True:
-        array = picam2.capture_array()
-        ret, buffer = cv2.imencode('.jpg', array)
-        if not ret:
-            break
-        frame = buffer.tobytes()
-        yield (b'--frame\r\n'
-               b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n')
-        time.sleep(SLEEP_DURATION) # Adjust sleep time for desired frame rate
+    @app.route('/video_feed')
+    @app.route('/video_feed/<camera_id>')
+    def video_feed(camera_id=None):
+        if camera_id is not None and camera_id not in cameras:
+            return jsonify({'error': f'Unknown camera {camera_id!r}'}), 404
+        # Optional ?w=<width>&q=<quality> for a smaller or lighter stream
+        width = request.args.get('w', type=int)
+        quality = request.args.get('q', type=int)
+        return Response(mjpeg_stream(cameras.get(camera_id), width, quality),
+                        mimetype='multipart/x-mixed-replace; boundary=frame')
 
-@app.route('/video_feed')
-def video_feed():
-    return Response(generate_frames(), mimetype='multipart/x-mixed-replace; boundary=frame')
+    app.extensions['cameras'] = cameras
+    return app
 
 if __name__ == '__main__':
+    app = create_app()
     app.run(host='0.0.0.0', port=5000, debug=False)
-    picam2.close()
+    app.extensions['cameras'].stop()
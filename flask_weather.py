@@ -1,96 +1,91 @@
-import boto3
+import gzip
 import json
-from flask import Flask, render_template
+from functools import lru_cache
+from flask import Flask, Response, jsonify, redirect, render_template, request, url_for
+import numpy as np
+import plotly
 import plotly.graph_objects as go
+import plotly.io as pio
 import plotly.offline as py
-import pandas as pd
-from datetime import datetime
-
-# Configure AWS credentials (replace with your actual credentials)
+from lazy import Lazy
+from metrics import DATAFRAME_SECONDS, PLOT_RENDER_SECONDS, instrument
+from plotting import PlotCache
+from storage import WEATHER_BUCKET, open_storage
+from timeseries import clamp_max_points, downsample, to_json_values
+from weather_routes import query_args, weather_blueprint
+from weather_store import WeatherStore
+from weather_partitions import WeatherPartitions
+from weather_worker import IngestWorker
+
+# Configure AWS credentials (replace with your actual credentials); STORAGE_URL can name MinIO or a directory instead
 aws_access_key_id = ''
 aws_secret_access_key = ''
-bucket_name = 'weather-data-iot'
-
-
-app = Flask(__name__)
-
-# Create an S3 client
-s3_client = boto3.client(
-    's3', 
-    aws_access_key_id=aws_access_key_id, 
-    aws_secret_access_key=aws_secret_access_key
-)
-
-def process_object(object_key):
-    """Downloads an object from S3 and parses its JSON content."""
-    try:
-        response = s3_client.get_object(Bucket=bucket_name, Key=object_key)
-        object_content = response['Body'].read().decode('utf-8', errors='ignore')
-        data = json.loads(object_content)
-
-        # Convert 'timestamp' to datetime, handling "Unknown"
-        timestamp = data.get('timestamp')
-        if timestamp != "Unknown":
-             timestamp = datetime.fromisoformat(timestamp)
-        data['timestamp'] = timestamp
-        
-        return data
-    except Exception as e:
-        print(f"Error processing {object_key}: {e}")
-        return None
-
-def scrape_all_s3_objects():
-    """Scrapes all objects from the specified S3 bucket and returns data."""
-    all_data = []
-    try:
-        paginator = s3_client.get_paginator('list_objects_v2')
-        pages = paginator.paginate(Bucket=bucket_name)
-
-        for page in pages:
-            if 'Contents' in page:
-                for obj in page['Contents']:
-                    object_key = obj['Key']
-                    print(f"Processing object: {object_key}")
-                    object_data = process_object(object_key)
-                    if object_data:
-                         all_data.append(object_data)
-            else:
-                print("Bucket is empty or does not contain any objects")
-    except Exception as e:
-        print(f"Error listing objects from bucket: {e}")
-    return all_data
-
-
-def create_plot(all_data):
-        """Creates a Plotly graph from the scraped data."""
-        if not all_data:
+bucket_name = WEATHER_BUCKET
+
+# Colour of each attribute's trace, in plot order
+TRACE_COLORS = {
+    'temperature': 'red',
+    'humidity': 'blue',
+    'wind_gust': 'green',
+    'precipitation': 'purple',
+    'cloud_cover': 'orange',
+}
+
+# Points per trace sent with the page, and again for each zoomed window
+PAGE_POINTS = 2000
+
+PLOT_DIV_ID = 'weather-plot'
+
+# plotly.js is versioned in its URL, so browsers can keep it for a year
+PLOTLY_JS_MAX_AGE = 365 * 24 * 3600
+
+# Open storage on first use; remote objects are kept in the on-disk read-through cache
+weather_storage = Lazy(lambda: open_storage(aws_access_key_id, aws_secret_access_key))
+
+
+@DATAFRAME_SECONDS.timed(stage='traces')
+def trace_data(snapshot, start=None, end=None, max_points=PAGE_POINTS):
+    """Returns every attribute between start and end, decimated to max_points, as a list of traces in plot order."""
+    timestamps, columns = snapshot.range(start, end, list(TRACE_COLORS))
+    traces = []
+    for index, attribute in enumerate(TRACE_COLORS):
+        values = columns[:, index]
+        keep = downsample(timestamps, values, max_points)
+        traces.append({
+            'name': attribute,
+            'x': np.datetime_as_string(timestamps[keep], unit='s').tolist(),
+            'y': to_json_values(values[keep]),
+        })
+    return traces
+
+
+@PLOT_RENDER_SECONDS.timed(renderer='plotly')
+def create_plot(snapshot, mode='webgl'):
+        """Creates a Plotly graph from a snapshot of the weather data.
+
+        'webgl' draws decimated Scattergl traces and expects the page to load
+        plotly.js itself; 'full' embeds every point and the plotly.js bundle.
+        """
+        if not len(snapshot):
              return "No data to display"
 
-        df = pd.DataFrame(all_data)
-        #Convert timestamp column to datetime
-        df['timestamp'] = pd.to_datetime(df['timestamp'], errors='coerce')
-        
-        #drop na values
-        df.dropna(subset = 'timestamp', inplace=True)
-
-        # Sort values by time.
-        df.sort_values(by='timestamp', inplace=True)
-        
         fig = go.Figure()
 
-        # Function to add a trace to the figure for the given attribute
-        def add_attribute_trace(attribute, color):
-            fig.add_trace(go.Scatter(x=df['timestamp'], y=df[attribute],
-                                    mode='lines',
-                                    name=attribute,
-                                    line=dict(color=color)))
-        
-        add_attribute_trace('temperature', 'red')
-        add_attribute_trace('humidity', 'blue')
-        add_attribute_trace('wind_gust', 'green')
-        add_attribute_trace('precipitation', 'purple')
-        add_attribute_trace('cloud_cover', 'orange')
-
+        if mode == 'full':
+            # Snapshot rows are already sorted by timestamp; history before the in-memory window is read back too
+            timestamps, columns = snapshot.range(attributes=list(TRACE_COLORS))
+            for index, (attribute, color) in enumerate(TRACE_COLORS.items()):
+                fig.add_trace(go.Scatter(x=timestamps, y=columns[:, index],
+                                        mode='lines',
+                                        name=attribute,
+                                        line=dict(color=color)))
+        else:
+            # A few thousand points per trace, whatever the history length; zooming fetches more detail
+            for trace in trace_data(snapshot):
+                fig.add_trace(go.Scattergl(x=trace['x'], y=trace['y'],
+                                          mode='lines',
+                                          name=trace['name'],
+                                          line=dict(color=TRACE_COLORS[trace['name']])))
 
         fig.update_layout(
             title='Weather Attributes over Time',
@@ -98,13 +93,87 @@ def create_plot(all_data):
             yaxis_title='Value',
             hovermode='x unified'
         )
-        return py.plot(fig, output_type='div')
-
-@app.route('/')
-def index():
-    all_data = scrape_all_s3_objects()
-    plot_div = create_plot(all_data)
-    return render_template('index.html', plot_div=plot_div)
+        if mode == 'full':
+            return py.plot(fig, output_type='div')
+        return pio.to_html(fig, include_plotlyjs=False, full_html=False, div_id=PLOT_DIV_ID)
+
+
+@lru_cache(maxsize=None)
+def plotly_js():
+    """Returns the plotly.js bundle shipped with the plotly package, raw and gzip compressed."""
+    source = py.get_plotlyjs().encode('utf-8')
+    return source, gzip.compress(source)
+
+def create_app(storage=None, weather_store=None, partitions=None):
+    """Builds the dashboard app; the weather cache is loaded by the ingest thread, not at startup."""
+    app = Flask(__name__)
+    # Request timings and the hot-path histograms, served on /metrics
+    instrument(app)
+
+    # Local cache of weather readings, kept in sync with S3 and compacted by a background thread
+    if weather_store is None:
+        weather_store = Lazy(WeatherStore)
+    if partitions is None:
+        partitions = WeatherPartitions()
+    ingest_worker = IngestWorker(weather_store, storage or weather_storage, bucket_name, partitions=partitions).start()
+
+    # /ingest_status and the JSON, plot and live routes the other apps serve over the same worker
+    app.register_blueprint(weather_blueprint(ingest_worker))
+
+    # Rendered pages and zoom payloads, cached per data version
+    page_cache = PlotCache()
+
+    @app.route('/')
+    def index():
+        # ?mode=full embeds every point and plotly.js in the page, as before
+        mode = 'full' if request.args.get('mode') == 'full' else 'webgl'
+        snapshot = ingest_worker.snapshot()
+        plot_div = page_cache.get(('page', mode), snapshot.version,
+                                  lambda: create_plot(snapshot, mode).encode('utf-8')).decode('utf-8')
+        return render_template('weather.html', plot_div=plot_div, mode=mode, plot_div_id=PLOT_DIV_ID,
+                               plotly_js_url=url_for('plotly_script', version=plotly.__version__))
+
+    @app.route('/plotly-<version>.min.js')
+    def plotly_script(version):
+        # Only the installed version may be cached as immutable; pages naming another are sent to it
+        if version != plotly.__version__:
+            return redirect(url_for('plotly_script', version=plotly.__version__))
+        source, compressed = plotly_js()
+        etag = f'plotly-{plotly.__version__}'
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        elif 'gzip' in request.accept_encodings:
+            response = Response(compressed, mimetype='application/javascript')
+            response.headers['Content-Encoding'] = 'gzip'
+        else:
+            response = Response(source, mimetype='application/javascript')
+        response.set_etag(etag)
+        response.vary.add('Accept-Encoding')
+        response.cache_control.public = True
+        response.cache_control.max_age = PLOTLY_JS_MAX_AGE
+        response.cache_control.immutable = True
+        return response
+
+    # Decimated traces for the window the user zoomed to
+    @app.route('/api/traces')
+    def traces():
+        try:
+            args = query_args()
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        snapshot = ingest_worker.snapshot()
+        start, end = args['start'], args['end']
+        max_points = clamp_max_points(args['max_points'] or PAGE_POINTS)
+
+        def render():
+            payload = {'version': snapshot.version, 'traces': trace_data(snapshot, start, end, max_points)}
+            return json.dumps(payload).encode('utf-8')
+
+        body = page_cache.get(('traces', str(start), str(end), max_points), snapshot.version, render)
+        return Response(body, mimetype='application/json')
+
+    app.extensions['ingest_worker'] = ingest_worker
+    return app
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    create_app().run(debug=True)
@@ -0,0 +1,74 @@
+"""Gunicorn settings for serving the Flask apps in production.
+
+Usage:
+    gunicorn -c gunicorn.conf.py 'API:create_app()'
+    SERVE_ROLE=stream gunicorn -c gunicorn.conf.py 'API:create_app()'
+
+API.py and flask_server/app.py are run twice behind a reverse proxy, and
+each role builds only its own routes and background services (serving.py).
+The 'api' role serves the short request/response routes (pages, /plot,
+/api/weather) and runs the ingest worker that syncs and compacts the
+weather data. The 'stream' role owns the cameras: the long-lived
+/video_feed, captures and their upload queue, and /api/weather/stream, fed
+by following the weather cache the api role writes. Plot requests never
+queue behind connected viewers, and no camera, sync or upload runs twice.
+The other apps are not split; run them once. Every setting can be
+overridden with the WEB_* environment variables below or gunicorn's own
+command-line flags.
+"""
+import os
+
+# 'api' for request/response routes, 'stream' for MJPEG and Server-Sent Events
+ROLE = os.environ.get('SERVE_ROLE', 'api')
+
+# Defaults per role. Each open stream holds a thread for as long as the client stays connected,
+# while plot rendering is CPU bound and gains nothing from more threads than PLOT_RENDER_PROCESSES can feed
+ROLES = {
+    'api': {'bind': '0.0.0.0:8000', 'workers': 1, 'threads': 8},
+    'stream': {'bind': '0.0.0.0:8001', 'workers': 1, 'threads': 64},
+}
+
+if ROLE not in ROLES:
+    raise ValueError(f"SERVE_ROLE must be one of {', '.join(ROLES)}, not {ROLE!r}")
+
+# Tells create_app in each worker which role's routes and services to build
+raw_env = [f'SERVE_ROLE={ROLE}']
+
+bind = os.environ.get('WEB_BIND', ROLES[ROLE]['bind'])
+
+# gthread serves each request on a thread; gevent (pip install gevent) serves streams on greenlets instead,
+# but turns the capture thread into a greenlet too, so only use it with JPEG_ENCODER=picamera2
+worker_class = os.environ.get('WEB_WORKER_CLASS', 'gthread')
+
+# Only one process can open each camera, so the stream role, which owns them and the upload queue, always has
+# a single worker. Extra api workers each run an ingest thread; they share the weather cache safely but each
+# syncs the bucket, so prefer PLOT_RENDER_PROCESSES for more cores. labelling_app and camera_livestream open a
+# camera too and need WEB_WORKERS=1
+workers = 1 if ROLE == 'stream' else int(os.environ.get('WEB_WORKERS', ROLES[ROLE]['workers']))
+threads = int(os.environ.get('WEB_THREADS', ROLES[ROLE]['threads']))
+worker_connections = threads
+
+# gthread workers report to the arbiter from their main loop, so a long stream does not count towards the timeout
+timeout = int(os.environ.get('WEB_TIMEOUT', 30))
+graceful_timeout = 10
+keepalive = 5
+
+# Build the app in each worker after forking, so its background threads and the camera belong to that process
+preload_app = False
+
+accesslog = os.environ.get('WEB_ACCESS_LOG', '-')
+
+
+def worker_exit(server, worker):
+    """Stops the app's background threads, as each app's __main__ does after app.run()."""
+    app = getattr(worker, 'wsgi', None)
+    extensions = getattr(app, 'extensions', {})
+    if 'motion_capture' in extensions:
+        extensions['motion_capture'].stop()
+    if 'upload_queue' in extensions:
+        extensions['upload_queue'].stop()
+    if 'cameras' in extensions:
+        extensions['cameras'].stop()
+    broadcaster = extensions.get('broadcaster')
+    if broadcaster is not None and getattr(broadcaster, 'created', True):
+        broadcaster.stop()
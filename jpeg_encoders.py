@@ -0,0 +1,71 @@
+import os
+
+import cv2
+import numpy as np
+
+try:
+    import simplejpeg
+except ImportError:
+    simplejpeg = None
+
+# Quality used when neither the client nor the stream asks for one; OpenCV's own default is 95
+DEFAULT_QUALITY = 80
+
+# Dataset captures keep full resolution and OpenCV's default quality
+CAPTURE_QUALITY = 95
+
+
+class OpenCVEncoder:
+    """Software JPEG encoding through cv2.imencode."""
+
+    name = 'opencv'
+
+    def encode(self, image, quality=DEFAULT_QUALITY):
+        ret, buffer = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+        return buffer.tobytes() if ret else None
+
+
+class SimpleJpegEncoder:
+    """libjpeg-turbo through simplejpeg, with 4:2:0 chroma and the fast DCT."""
+
+    name = 'simplejpeg'
+
+    def encode(self, image, quality=DEFAULT_QUALITY):
+        # Both OpenCV and Picamera2's RGB888 format store pixels in BGR order
+        image = np.ascontiguousarray(image)
+        return simplejpeg.encode_jpeg(image, quality=quality, colorspace='BGR', colorsubsampling='420', fastdct=True)
+
+
+# Picamera2's MJPEGEncoder; see camera_stream.Picamera2MJPEGCamera
+HARDWARE_ENCODER = 'picamera2'
+
+ENCODERS = {'opencv': OpenCVEncoder}
+if simplejpeg is not None:
+    ENCODERS['simplejpeg'] = SimpleJpegEncoder
+
+
+def make_encoder(name=None):
+    """Returns the software encoder named by name or JPEG_ENCODER, preferring simplejpeg when it is installed.
+
+    With the hardware encoder selected, software encoding is still needed for
+    resized or re-qualified variants, so the preferred software encoder is used.
+    """
+    name = name or os.environ.get('JPEG_ENCODER')
+    if not name or name == HARDWARE_ENCODER:
+        name = 'simplejpeg' if simplejpeg is not None else 'opencv'
+    if name not in ENCODERS:
+        raise ValueError(f"Unknown or unavailable JPEG encoder: {name}")
+    return ENCODERS[name]()
+
+
+def resize(image, width):
+    """Scales image down to width pixels wide, keeping its aspect ratio."""
+    height, current_width = image.shape[:2]
+    if not width or width >= current_width:
+        return image
+    return cv2.resize(image, (width, round(height * width / current_width)), interpolation=cv2.INTER_AREA)
+
+
+def decode(jpeg):
+    """Decodes JPEG bytes back to a BGR image, for cameras that only hand out encoded frames."""
+    return cv2.imdecode(np.frombuffer(jpeg, dtype=np.uint8), cv2.IMREAD_COLOR)
@@ -1,77 +1,149 @@
-from flask import Flask, render_template, jsonify, request
-import boto3
+from flask import Flask, Response, render_template, jsonify, request
 import json
 import time
-import cv2
 import os
-from datetime import datetime
-
-app = Flask(__name__)
-
-# AWS S3 credentials and bucket info
+import sys
+
+# Shared modules live in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from camera_stream import (MAX_BURST_COUNT, MAX_BURST_INTERVAL_MS, FrameBroadcaster, OpenCVCamera, capture_jpeg,
+                           capture_key)
+from lazy import Lazy
+from metrics import instrument
+from motion_capture import LABELS, MotionCapture
+from storage import LABEL_BUCKETS, open_storage
+from upload_queue import UploadQueue
+
+# AWS S3 credentials; the buckets come from storage.LABEL_BUCKETS and STORAGE_URL can point at MinIO or a directory
 AWS_ACCESS_KEY = ""
 AWS_SECRET_KEY = ""
-BUCKET_NAME = "weather-iot-data"
-
-# Initialize S3 client
-s3 = boto3.client('s3', aws_access_key_id=AWS_ACCESS_KEY, aws_secret_access_key=AWS_SECRET_KEY)
-
-# Track session state
-session_active = False
-
-# Initialize camera for image capture (we'll use a placeholder as we are not streaming)
-camera = cv2.VideoCapture(0)  # Placeholder for actual camera if needed
-
-def upload_image_to_s3(image, label):
-    timestamp = datetime.now().strftime('%Y-%m-%d_%H-%M-%S')
-    filename = f"{label}_{timestamp}.jpg"
-    
-    # Upload image to the respective bucket (either sitting-down or standing-up)
-    bucket_name = f"{label}-data"  # Use sitting-down-data or standing-up-data buckets
-    s3.put_object(Body=image, Bucket=bucket_name, Key=filename)
-    print(f"Uploaded {filename} to {bucket_name}.")
-
-@app.route('/')
-def index():
-    global session_active
-    return render_template('index.html', session_active=session_active)
-
-@app.route('/start_session', methods=['POST'])
-def start_session():
-    global session_active
-    session_active = True
-    return jsonify({"message": "Session started!"})
-
-@app.route('/stop_session', methods=['POST'])
-def stop_session():
-    global session_active
-    session_active = False
-    return jsonify({"message": "Session stopped!"})
 
-@app.route('/capture/<label>', methods=['POST'])
-def capture(label):
-    global session_active
-    if not session_active:
-        return jsonify({'error': 'Session is not active. Please start the session first.'}), 400
+def upload_image_to_s3(upload_queue, image, label, filename):
+    # Queue image for the respective bucket (either sitting-down or standing-up)
+    bucket_name = LABEL_BUCKETS[label]
+    upload_queue.put(image, bucket_name, filename)
+    print(f"Queued {filename} for {bucket_name}.")
+    return {'bucket': bucket_name, 'key': filename}
 
-    # Check if the label is valid
-    if label not in ['sitting_down', 'standing_up']:
-        return jsonify({'error': 'Invalid label'}), 400
+def create_app(storage=None, camera=None):
+    app = Flask(__name__)
+    # Request timings and the hot-path histograms, served on /metrics
+    instrument(app)
 
-    # Capture a snapshot (simulated by grabbing a frame from the camera)
-    ret, frame = camera.read()
-    if not ret:
-        return jsonify({'error': 'Failed to capture image'}), 500
+    # Initialize storage on first upload unless one is passed in
+    if storage is None:
+        storage = Lazy(lambda: open_storage(AWS_ACCESS_KEY, AWS_SECRET_KEY))
 
-    # Encode the image to JPEG
-    _, buffer = cv2.imencode('.jpg', frame)
-    image = buffer.tobytes()
+    # Captures are spooled to disk and uploaded in the background
+    upload_queue = UploadQueue(storage).start()
 
-    # Upload the image to S3
-    upload_image_to_s3(image, label)
+    # Track session state
+    session_active = False
 
-    return jsonify({'message': f"Image labeled as '{label}' and uploaded to S3."})
+    # Camera for image capture, opened by the first capture; frames are buffered by a single capture thread
+    broadcaster = Lazy(lambda: FrameBroadcaster(camera or OpenCVCamera(0)))
+
+    # Automatic capture: frames with motion are kept for review instead of uploading every frame
+    motion_capture = MotionCapture(broadcaster)
+
+    @app.route('/')
+    def index():
+        return render_template('index.html', session_active=session_active)
+
+    @app.route('/start_session', methods=['POST'])
+    def start_session():
+        nonlocal session_active
+        session_active = True
+        return jsonify({"message": "Session started!"})
+
+    @app.route('/stop_session', methods=['POST'])
+    def stop_session():
+        nonlocal session_active
+        session_active = False
+        motion_capture.stop()
+        return jsonify({"message": "Session stopped!"})
+
+    @app.route('/capture/<label>', methods=['POST'])
+    def capture(label):
+        if not session_active:
+            return jsonify({'error': 'Session is not active. Please start the session first.'}), 400
+
+        # Check if the label is valid
+        if label not in LABELS:
+            return jsonify({'error': 'Invalid label'}), 400
+
+        # ?count=N&interval_ms=M captures a burst of N frames at least M ms apart
+        count = request.args.get('count', 1, type=int)
+        interval_ms = request.args.get('interval_ms', 0, type=int)
+        if not 1 <= count <= MAX_BURST_COUNT or not 0 <= interval_ms <= MAX_BURST_INTERVAL_MS:
+            return jsonify({'error': f'count must be 1-{MAX_BURST_COUNT} and interval_ms 0-{MAX_BURST_INTERVAL_MS}'}), 400
+
+        # Encode each frame to JPEG and queue it for upload to S3 as the camera pipeline delivers it
+        def spool(frame, seq):
+            return upload_image_to_s3(upload_queue, capture_jpeg(frame), label, capture_key(label, frame, seq))
+
+        manifest = broadcaster.burst(count, interval_ms / 1000, on_frame=spool)
+        if not manifest:
+            return jsonify({'error': 'Failed to capture image'}), 500
+
+        return jsonify({'message': f"{len(manifest)} image(s) labeled as '{label}' and queued for upload to S3.",
+                        'images': manifest, 'queue_depth': upload_queue.depth()})
+
+    @app.route('/auto/start', methods=['POST'])
+    def start_auto_capture():
+        if not session_active:
+            return jsonify({'error': 'Session is not active. Please start the session first.'}), 400
+        motion_capture.start()
+        return jsonify({'message': 'Automatic capture started.'})
+
+    @app.route('/auto/stop', methods=['POST'])
+    def stop_auto_capture():
+        motion_capture.stop()
+        return jsonify({'message': 'Automatic capture stopped.'})
+
+    # Candidates waiting for review, with their suggested labels
+    @app.route('/auto/pending')
+    def auto_pending():
+        return jsonify({'candidates': motion_capture.pending(), 'status': motion_capture.status()})
+
+    @app.route('/auto/thumbnail/<int:candidate_id>')
+    def auto_thumbnail(candidate_id):
+        thumbnail = motion_capture.thumbnail(candidate_id)
+        if thumbnail is None:
+            return jsonify({'error': 'No such candidate'}), 404
+        return Response(thumbnail, mimetype='image/jpeg')
+
+    # Bulk review: {"labels": {"<id>": "sitting_down" | "standing_up" | null}, "accept_suggested": true}
+    @app.route('/auto/confirm', methods=['POST'])
+    def auto_confirm():
+        body = request.get_json(silent=True) or {}
+        try:
+            labels = {int(candidate_id): label for candidate_id, label in (body.get('labels') or {}).items()}
+        except (AttributeError, ValueError):
+            return jsonify({'error': 'labels must map candidate ids to labels'}), 400
+        if any(label is not None and label not in LABELS for label in labels.values()):
+            return jsonify({'error': 'Invalid label'}), 400
+
+        # Only confirmed frames are queued for upload to S3
+        manifest = [upload_image_to_s3(upload_queue, candidate.jpeg, label, capture_key(label, candidate))
+                    for candidate, label in motion_capture.review(labels, bool(body.get('accept_suggested')))]
+        return jsonify({'message': f"{len(manifest)} image(s) confirmed and queued for upload to S3.",
+                        'images': manifest, 'queue_depth': upload_queue.depth(),
+                        'status': motion_capture.status()})
+
+    @app.route('/upload_queue')
+    def upload_queue_status():
+        return jsonify(upload_queue.status())
+
+    app.extensions['upload_queue'] = upload_queue
+    app.extensions['motion_capture'] = motion_capture
+    app.extensions['broadcaster'] = broadcaster
+    return app
 
 if __name__ == '__main__':
+    app = create_app()
     app.run(debug=True)
-
+    app.extensions['motion_capture'].stop()
+    app.extensions['upload_queue'].stop()
+    if app.extensions['broadcaster'].created:
+        app.extensions['broadcaster'].stop()
@@ -0,0 +1,33 @@
+import threading
+
+
+class Lazy:
+    """Stands in for an object that factory() only builds the first time one of its attributes is used.
+
+    Lets an app start without opening a camera or creating an S3 client it
+    may never need. The object is built once, whichever thread asks first.
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._value = None
+        self._created = False
+        self._lock = threading.Lock()
+
+    @property
+    def created(self):
+        return self._created
+
+    def get(self):
+        if not self._created:
+            with self._lock:
+                if not self._created:
+                    self._value = self._factory()
+                    self._created = True
+        return self._value
+
+    def __getattr__(self, name):
+        # Private names are looked up by copy and pickle before __init__ has run
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.get(), name)
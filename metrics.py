@@ -0,0 +1,149 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+# Upper bounds in seconds, from a fast cache hit to a slow S3 sync
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Objects downloaded by one ingest pass
+COUNT_BUCKETS = (0, 1, 5, 10, 50, 100, 500, 1000, 5000, 10000, 100000)
+
+# Frames per second a stream viewer actually receives
+FPS_BUCKETS = (1, 2, 5, 10, 15, 20, 25, 30, 60)
+
+
+class Histogram:
+    """Cumulative-bucket histogram, optionally split by label values, in the Prometheus model.
+
+    Observing takes one bisect and one short lock, cheap enough for every
+    frame and every request.
+    """
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS, labelnames=()):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.labelnames = tuple(labelnames)
+        # Label values -> [count per bucket plus +Inf, sum]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observes how long the block took, in seconds."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def timed(self, **labels):
+        """Decorator that observes every call of the function."""
+        def decorate(function):
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.time(**labels):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorate
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = sorted((key, list(counts), total) for key, (counts, total) in self._series.items())
+        for key, counts, total in series:
+            labels = [f'{name}="{_escape(value)}"' for name, value in zip(self.labelnames, key)]
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                bucket_labels = _labels(labels + ['le="' + str(bound) + '"'])
+                lines.append(f'{self.name}_bucket{bucket_labels} {cumulative}')
+            lines.append(f'{self.name}_sum{_labels(labels)} {total}')
+            lines.append(f'{self.name}_count{_labels(labels)} {cumulative}')
+        return '\n'.join(lines)
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels):
+    return '{' + ','.join(labels) + '}' if labels else ''
+
+
+class Registry:
+    """The metrics one process exposes on /metrics."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS, labelnames=()):
+        """Returns the histogram called name, creating it on first use, so every app can ask for the same one."""
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = Histogram(name, help, buckets, labelnames)
+            return self._metrics[name]
+
+    def render(self):
+        """Prometheus text exposition format, version 0.0.4."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+REGISTRY = Registry()
+
+# Hot paths, observed by the modules that run them
+S3_REQUEST_SECONDS = REGISTRY.histogram(
+    's3_request_seconds', 'Latency of S3 calls, including retries.', labelnames=('operation',))
+S3_OBJECTS_FETCHED = REGISTRY.histogram(
+    's3_objects_fetched', 'Objects downloaded by one ingest pass.', COUNT_BUCKETS)
+DATAFRAME_SECONDS = REGISTRY.histogram(
+    'dataframe_build_seconds', 'Time to build snapshots, rollup frames and query frames.', labelnames=('stage',))
+PLOT_RENDER_SECONDS = REGISTRY.histogram(
+    'plot_render_seconds', 'Time to render one plot, excluding cache hits.', labelnames=('renderer',))
+JPEG_ENCODE_SECONDS = REGISTRY.histogram(
+    'jpeg_encode_seconds', 'Time to encode one JPEG variant of a frame.', labelnames=('encoder',))
+STREAM_FPS = REGISTRY.histogram(
+    'stream_fps', 'Frames per second sent to one MJPEG viewer, sampled every second.', FPS_BUCKETS)
+UPLOAD_LATENCY_SECONDS = REGISTRY.histogram(
+    'upload_queue_latency_seconds', 'Time from spooling a capture to its upload finishing.')
+HTTP_REQUEST_SECONDS = REGISTRY.histogram(
+    'http_request_seconds', 'Time to produce a response; streams count until their first byte.',
+    labelnames=('endpoint', 'method', 'status'))
+
+
+def instrument(app, registry=REGISTRY):
+    """Times every request to the Flask app and serves the registry on /metrics."""
+    from flask import Response, g, request
+
+    @app.before_request
+    def start_timer():
+        g.metrics_start = time.perf_counter()
+
+    @app.after_request
+    def observe_request(response):
+        start = g.pop('metrics_start', None)
+        if start is not None:
+            HTTP_REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint=request.endpoint or 'unknown',
+                                         method=request.method, status=response.status_code)
+        return response
+
+    @app.route('/metrics')
+    def metrics():
+        return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+    return app
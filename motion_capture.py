@@ -0,0 +1,219 @@
+import itertools
+import threading
+import time
+from collections import OrderedDict, deque
+
+import cv2
+import numpy as np
+
+from camera_stream import capture_jpeg
+
+# Frames are analysed at this width, in grayscale; enough to see a person move
+ANALYSIS_WIDTH = 160
+
+# Frames analysed per second, well below the camera rate
+ANALYSIS_FPS = 5
+
+# How quickly the background model absorbs a scene that has stopped changing
+BACKGROUND_ALPHA = 0.05
+
+# A pixel has changed when it differs by more than this (0-255)
+PIXEL_THRESHOLD = 25
+
+# Fraction of pixels changed since the previous analysed frame that makes a frame worth keeping
+MOTION_FRACTION = 0.02
+
+# Frames whose 64-bit difference hashes differ in fewer bits than this are near-duplicates
+DUPLICATE_DISTANCE = 6
+
+# Kept frames each new candidate is compared against
+RECENT_HASHES = 64
+
+# Minimum gap between kept frames, so one movement does not fill the review list
+MIN_KEEP_SECONDS = 1.0
+
+# Candidates awaiting review; the oldest are dropped beyond this, about 100 MB of 1080p JPEGs
+MAX_PENDING = 300
+
+# Width of the preview shown to the annotator
+THUMBNAIL_WIDTH = 320
+
+# Moving region at least this many times taller than wide is suggested as standing
+STANDING_ASPECT = 1.6
+
+LABELS = ['sitting_down', 'standing_up']
+
+
+def dhash(gray, size=8):
+    """Difference hash: one bit per horizontally adjacent pixel pair of a size+1 by size thumbnail."""
+    small = cv2.resize(gray, (size + 1, size), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+def hamming(a, b):
+    return (a ^ b).bit_count()
+
+
+def suggest_label(foreground, moving):
+    """Guesses sitting or standing from the shape of the largest foreground region that is moving.
+
+    Regions that differ from the background but did not move, such as the
+    ghost of someone who was there when the background was first taken,
+    are ignored.
+    """
+    _, regions, stats, _ = cv2.connectedComponentsWithStats(foreground)
+    moved = np.unique(regions[moving & (regions > 0)])
+    if not len(moved):
+        return None
+    region = moved[np.argmax(stats[moved, cv2.CC_STAT_AREA])]
+    width, height = stats[region, cv2.CC_STAT_WIDTH], stats[region, cv2.CC_STAT_HEIGHT]
+    return 'standing_up' if height >= STANDING_ASPECT * width else 'sitting_down'
+
+
+class Candidate:
+    """A frame kept for review: its capture JPEG, a preview and the suggested label."""
+
+    __slots__ = ('id', 'timestamp', 'jpeg', 'thumbnail', 'suggested_label', 'motion')
+
+    def __init__(self, id, timestamp, jpeg, thumbnail, suggested_label, motion):
+        self.id = id
+        self.timestamp = timestamp
+        self.jpeg = jpeg
+        self.thumbnail = thumbnail
+        self.suggested_label = suggested_label
+        self.motion = motion
+
+    def to_dict(self):
+        return {'id': self.id, 'timestamp': self.timestamp, 'suggested_label': self.suggested_label,
+                'motion': round(self.motion, 4), 'bytes': len(self.jpeg)}
+
+
+class MotionCapture:
+    """Watches a FrameBroadcaster and keeps frames with significant motion for bulk labelling.
+
+    Each analysed frame is scaled down to grayscale and compared with the
+    previous one. Frames where enough pixels changed, and that are not
+    near-duplicates of a recent candidate by difference hash, are
+    encoded once at capture quality and held until the annotator confirms
+    or rejects them; only confirmed frames are uploaded. A running-average
+    background separates the person from the scene for the label suggestion.
+    """
+
+    def __init__(self, broadcaster, fps=ANALYSIS_FPS):
+        self.broadcaster = broadcaster
+        self.interval = 1 / fps
+        self._background = None
+        self._previous = None
+        self._recent = deque(maxlen=RECENT_HASHES)
+        self._last_kept = 0
+        self._ids = itertools.count(1)
+        self._pending = OrderedDict()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.counts = {'analysed': 0, 'motion': 0, 'duplicates': 0, 'kept': 0, 'dropped': 0,
+                       'confirmed': 0, 'rejected': 0, 'bytes_confirmed': 0}
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if not self.running:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='motion-capture', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._background = self._previous = None
+
+    def _run(self):
+        seq = 0
+        while not self._stop.is_set():
+            started = time.time()
+            frame = self.broadcaster.wait_for_frame(seq, timeout=1)
+            if frame is not None:
+                seq = frame.seq
+                self.analyse(frame)
+            self._stop.wait(max(0, self.interval - (time.time() - started)))
+
+    def analyse(self, frame):
+        """Updates the background with frame and keeps it as a candidate if it shows new motion."""
+        image = frame.image
+        height, width = image.shape[:2]
+        small = cv2.resize(image, (ANALYSIS_WIDTH, max(1, round(height * ANALYSIS_WIDTH / width))),
+                           interpolation=cv2.INTER_AREA)
+        gray = cv2.GaussianBlur(cv2.cvtColor(small, cv2.COLOR_BGR2GRAY), (5, 5), 0)
+        self.counts['analysed'] += 1
+        if self._background is None:
+            self._background = gray.astype(np.float32)
+            self._previous = gray
+            return None
+        moving = cv2.absdiff(gray, self._previous) > PIXEL_THRESHOLD
+        foreground = (cv2.absdiff(gray, cv2.convertScaleAbs(self._background)) > PIXEL_THRESHOLD).astype(np.uint8)
+        cv2.accumulateWeighted(gray, self._background, BACKGROUND_ALPHA)
+        self._previous = gray
+        motion = float(moving.mean())
+        if motion < MOTION_FRACTION or frame.timestamp - self._last_kept < MIN_KEEP_SECONDS:
+            return None
+        self.counts['motion'] += 1
+
+        frame_hash = dhash(gray)
+        if any(hamming(frame_hash, recent) < DUPLICATE_DISTANCE for recent in self._recent):
+            self.counts['duplicates'] += 1
+            return None
+        self._recent.append(frame_hash)
+        self._last_kept = frame.timestamp
+
+        candidate = Candidate(next(self._ids), frame.timestamp, capture_jpeg(frame),
+                              frame.jpeg(THUMBNAIL_WIDTH), suggest_label(foreground, moving), motion)
+        with self._lock:
+            self._pending[candidate.id] = candidate
+            self.counts['kept'] += 1
+            while len(self._pending) > MAX_PENDING:
+                self._pending.popitem(last=False)
+                self.counts['dropped'] += 1
+        return candidate
+
+    def pending(self):
+        with self._lock:
+            return [candidate.to_dict() for candidate in self._pending.values()]
+
+    def thumbnail(self, candidate_id):
+        with self._lock:
+            candidate = self._pending.get(candidate_id)
+        return candidate.thumbnail if candidate else None
+
+    def review(self, labels, accept_suggested=False):
+        """Takes the candidates out of the pending list and returns the ones to upload as (candidate, label).
+
+        labels maps candidate ids to a label, or to None to reject the frame.
+        With accept_suggested, every other pending candidate that has a
+        suggestion is accepted with it.
+        """
+        accepted = []
+        with self._lock:
+            ids = list(self._pending) if accept_suggested else [id for id in labels if id in self._pending]
+            for candidate_id in ids:
+                candidate = self._pending[candidate_id]
+                label = labels.get(candidate_id, candidate.suggested_label)
+                if candidate_id not in labels and label is None:
+                    # No suggestion and no decision: leave it for the annotator
+                    continue
+                del self._pending[candidate_id]
+                if label is None:
+                    self.counts['rejected'] += 1
+                else:
+                    accepted.append((candidate, label))
+                    self.counts['confirmed'] += 1
+                    self.counts['bytes_confirmed'] += len(candidate.jpeg)
+        return accepted
+
+    def status(self):
+        with self._lock:
+            return {'running': self.running, 'pending': len(self._pending), **self.counts}
@@ -0,0 +1,152 @@
+import hashlib
+import io
+import multiprocessing
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from flask import Response, request
+
+from metrics import PLOT_RENDER_SECONDS
+
+# Total size of rendered PNGs kept in memory
+PLOT_CACHE_BYTES = int(os.environ.get('PLOT_CACHE_BYTES', 32 * 1024 * 1024))
+
+# Idle figures kept per process for reuse
+FIGURE_POOL_SIZE = 4
+
+# Render plots in this many worker processes instead of the request thread (0 disables)
+RENDER_PROCESSES = int(os.environ.get('PLOT_RENDER_PROCESSES', 0))
+
+# x-axis label format per granularity, anything finer shows seconds
+TICK_FORMATS = {'hour': '%Y-%m-%d %H:%M', 'day': '%Y-%m-%d', 'week': '%Y-%m-%d', 'month': '%Y-%m'}
+
+
+class FigurePool:
+    """Keeps idle Agg figures for reuse; every render holds its own figure until it is done."""
+
+    def __init__(self, max_idle=FIGURE_POOL_SIZE):
+        self.max_idle = max_idle
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        # Matplotlib is only imported once something is actually plotted
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.figure import Figure
+
+        figure = Figure(figsize=(10, 6))
+        FigureCanvasAgg(figure)
+        return figure
+
+    def release(self, figure):
+        figure.clear()
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(figure)
+
+
+_figure_pool = FigurePool()
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
+
+def render_plot(timestamps, values, filtered, weather_attribute, granularity):
+    """Draws one plot on a pooled figure and returns PNG bytes; safe to call from several threads."""
+    import matplotlib.dates as mdates
+
+    figure = _figure_pool.acquire()
+    try:
+        axes = figure.add_subplot()
+        axes.plot(timestamps, values, label=weather_attribute, marker='o')
+        axes.plot(timestamps, filtered, label=f'{weather_attribute} (low-pass)')
+        axes.legend()
+        axes.set_xlabel('Timestamp')
+        axes.set_ylabel(weather_attribute.capitalize())
+        axes.set_title(f'{weather_attribute.capitalize()} Over Time (Granularity: {granularity.capitalize()})')
+
+        # Let matplotlib choose how many ticks fit instead of labelling every point
+        axes.xaxis.set_major_locator(mdates.AutoDateLocator())
+        axes.xaxis.set_major_formatter(mdates.DateFormatter(TICK_FORMATS.get(granularity, '%Y-%m-%d %H:%M:%S')))
+        axes.tick_params(axis='x', labelrotation=45)
+
+        axes.grid(True)
+
+        img_stream = io.BytesIO()
+        figure.savefig(img_stream, format='png')
+        return img_stream.getvalue()
+    finally:
+        _figure_pool.release(figure)
+
+
+# Create plot for a given weather attribute and return it as PNG bytes
+@PLOT_RENDER_SECONDS.timed(renderer='matplotlib')
+def create_plot(df, weather_attribute, granularity):
+    args = (df.index.values, df[weather_attribute].to_numpy(), df['filtered'].to_numpy(), weather_attribute, granularity)
+    if RENDER_PROCESSES > 0:
+        return _render_processes().submit(render_plot, *args).result()
+    return render_plot(*args)
+
+
+def _render_processes():
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            # Spawned rather than forked, the web server already runs threads
+            _process_pool = ProcessPoolExecutor(RENDER_PROCESSES, mp_context=multiprocessing.get_context('spawn'))
+    return _process_pool
+
+
+class PlotCache:
+    """Size-bounded LRU cache of rendered plots for the current data version.
+
+    Entries rendered from an older snapshot are dropped as soon as a newer
+    version is requested, so the cache never serves a plot of stale data.
+    """
+
+    def __init__(self, max_bytes=PLOT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.version = None
+        self._size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, version, render):
+        """Returns the cached PNG for key, calling render() to produce it on a miss."""
+        with self._lock:
+            if self.version is None or version > self.version:
+                self._entries.clear()
+                self._size = 0
+                self.version = version
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+
+        png = render()
+        with self._lock:
+            if version == self.version and key not in self._entries:
+                self._entries[key] = png
+                self._size += len(png)
+                while self._size > self.max_bytes and self._entries:
+                    _, evicted = self._entries.popitem(last=False)
+                    self._size -= len(evicted)
+        return png
+
+
+def png_response(plot_cache, key, snapshot, render, max_age):
+    """Serves a cached plot as image/png, answering If-None-Match with 304 before rendering anything."""
+    # The tag depends on the data itself, so it survives a restart that resets snapshot versions
+    tag = repr((key, len(snapshot), snapshot.latest_timestamp))
+    etag = hashlib.sha1(tag.encode('utf-8')).hexdigest()
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(plot_cache.get(key, snapshot.version, render), mimetype='image/png')
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    return response
@@ -0,0 +1,127 @@
+import json
+import os
+import random
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+from metrics import S3_OBJECTS_FETCHED, S3_REQUEST_SECONDS
+
+# Number of concurrent downloads; the client's connection pool is sized to match
+MAX_WORKERS = int(os.environ.get('S3_INGEST_WORKERS', 16))
+MAX_ATTEMPTS = 5
+BACKOFF_SECONDS = 0.2
+
+# Errors that will not go away by asking again
+PERMANENT_ERRORS = {'NoSuchKey', 'NoSuchBucket', 'AccessDenied', 'InvalidAccessKeyId', '403', '404'}
+
+
+def make_client(aws_access_key_id, aws_secret_access_key, max_workers=MAX_WORKERS, **kwargs):
+    """Creates an S3 client whose connection pool is large enough for max_workers downloads."""
+    # Imported here so that starting an app does not pay for boto3 until S3 is used
+    import boto3
+    from botocore.config import Config
+
+    config = Config(max_pool_connections=max_workers, retries={'max_attempts': 3, 'mode': 'standard'})
+    return boto3.client(
+        's3',
+        aws_access_key_id=aws_access_key_id,
+        aws_secret_access_key=aws_secret_access_key,
+        config=config,
+        **kwargs
+    )
+
+
+def list_keys(s3, bucket, start_after=None, prefix=None):
+    """Yields every key in the bucket after start_after, following pagination."""
+    list_args = {'Bucket': bucket}
+    if start_after:
+        list_args['StartAfter'] = start_after
+    if prefix:
+        list_args['Prefix'] = prefix
+    pages = iter(s3.get_paginator('list_objects_v2').paginate(**list_args))
+    while True:
+        # Each page is one ListObjectsV2 call
+        with S3_REQUEST_SECONDS.time(operation='list'):
+            page = next(pages, None)
+        if page is None:
+            return
+        for obj in page.get('Contents', []):
+            yield obj['Key']
+
+
+@S3_REQUEST_SECONDS.timed(operation='get')
+def get_object_body(s3, bucket, key, attempts=MAX_ATTEMPTS):
+    """Downloads one object, retrying transient failures with exponential backoff and jitter."""
+    for attempt in range(attempts):
+        try:
+            return s3.get_object(Bucket=bucket, Key=key)['Body'].read()
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in PERMANENT_ERRORS or attempt == attempts - 1:
+                raise
+        except BotoCoreError:
+            if attempt == attempts - 1:
+                raise
+        time.sleep(BACKOFF_SECONDS * 2 ** attempt * random.uniform(0.5, 1.5))
+
+
+def fetch_objects(s3, bucket, keys, max_workers=MAX_WORKERS, errors=None):
+    """Downloads keys through a bounded thread pool and yields (key, body) in the order given.
+
+    At most twice max_workers downloads are in flight, so memory stays flat
+    however many keys the listing produces. A key that still fails after
+    its retries raises, unless an errors list is given: then it is added to
+    it as (key, exception) and skipped.
+    """
+    pool = ThreadPoolExecutor(max_workers=max_workers)
+    pending = deque()
+
+    def ready(drain):
+        while pending and (drain or len(pending) >= max_workers * 2):
+            key, future = pending.popleft()
+            try:
+                yield key, future.result()
+            except (BotoCoreError, ClientError) as e:
+                if errors is None:
+                    raise
+                errors.append((key, e))
+
+    try:
+        for key in keys:
+            pending.append((key, pool.submit(get_object_body, s3, bucket, key)))
+            yield from ready(False)
+        yield from ready(True)
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+def ingest(storage, bucket, start_after=None, key_filter=None, parse=json.loads, max_workers=MAX_WORKERS,
+           quarantine=None):
+    """Streams (key, record) for every object in a storage backend after start_after that passes key_filter.
+
+    Objects that cannot be parsed are yielded with a record of None, so
+    callers can still move their watermark past them. They are added to the
+    quarantine list as (key, reason) if one is given, otherwise reported.
+    An object that cannot be downloaded raises instead, so the watermark
+    stays before it and the next ingest tries it again.
+    """
+    keys = storage.list(bucket, start_after)
+    if key_filter:
+        keys = (key for key in keys if key_filter(key))
+    fetched = 0
+    try:
+        for key, body in storage.batch_get(bucket, keys, max_workers):
+            fetched += 1
+            try:
+                record = parse(body)
+            except ValueError as e:
+                if quarantine is None:
+                    print(f"Error processing {key}: {e}")
+                else:
+                    quarantine.append((key, str(e)))
+                record = None
+            yield key, record
+    finally:
+        S3_OBJECTS_FETCHED.observe(fetched)
@@ -0,0 +1,41 @@
+"""Which routes and background services a process runs when an app is split across serving roles.
+
+gunicorn.conf.py runs API.py and flask_server/app.py twice behind one
+reverse proxy. The 'api' role serves the request/response routes and runs
+the ingest worker that syncs and compacts the weather data. The 'stream'
+role owns the cameras: /video_feed, captures and their upload queue, plus
+the /api/weather/stream Server-Sent Events, which it feeds by following
+the weather cache the api role writes. Without a role, as under the
+development server, one process runs everything.
+"""
+import os
+
+ROLES = ('api', 'stream')
+
+
+def serve_role(role=None):
+    """The role this process serves: role, else SERVE_ROLE, else None for every role."""
+    role = role or os.environ.get('SERVE_ROLE') or None
+    if role is not None and role not in ROLES:
+        raise ValueError(f"SERVE_ROLE must be one of {', '.join(ROLES)}, not {role!r}")
+    return role
+
+
+def serves(role, wanted):
+    return role is None or role == wanted
+
+
+def role_route(target, role, route_role):
+    """Returns a decorator like target.route that only serves the route when this process serves route_role.
+
+    In the other role the rule is kept for building URLs only, so url_for
+    still links pages to the path the proxy sends to the role serving it.
+    """
+    def route(rule, **options):
+        def decorator(view):
+            if serves(role, route_role):
+                return target.route(rule, **options)(view)
+            target.add_url_rule(rule, options.pop('endpoint', view.__name__), build_only=True, **options)
+            return view
+        return decorator
+    return route
@@ -0,0 +1,355 @@
+"""Where the apps read and write their objects: S3, an S3-compatible server or a local directory.
+
+Every backend has the same methods: list, get, batch_get, put and put_file.
+CachedStorage puts a size-bounded, on-disk read-through cache in front of
+a remote backend, so repeated reads are served locally.
+
+Usage: python storage.py prefetch weather-data-iot --start-after weather_data_2024-01-01 --end-before weather_data_2024-02-01
+"""
+import argparse
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from functools import lru_cache
+from itertools import islice, takewhile
+
+from botocore.exceptions import ClientError
+
+import s3_ingest
+from metrics import S3_REQUEST_SECONDS
+
+# 's3' for AWS, 's3+http://host:port' or 's3+https://host:port' for an S3-compatible server such as MinIO,
+# or 'file:///path' for a local directory holding one subdirectory per bucket
+STORAGE_URL = os.environ.get('STORAGE_URL', 's3')
+
+# Buckets of each kind of data, shared by every app
+WEATHER_BUCKET = os.environ.get('WEATHER_BUCKET', 'weather-data-iot')
+LABEL_BUCKETS = {
+    'sitting_down': os.environ.get('SITTING_BUCKET', 'sitting-down-data'),
+    'standing_up': os.environ.get('STANDING_BUCKET', 'standing-up-data'),
+}
+
+# Read-through cache of remote objects; it lives next to the code unless STORAGE_CACHE_PATH says otherwise,
+# and STORAGE_CACHE_BYTES=0 turns it off
+CACHE_PATH = os.environ.get(
+    'STORAGE_CACHE_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'storage_cache.db')
+)
+CACHE_BYTES = int(os.environ.get('STORAGE_CACHE_BYTES', 512 * 1024 * 1024))
+
+# Eviction goes this far below the bound, so a full cache does not evict on every insert
+EVICT_TO = 0.9
+
+# Keys looked up in the cache with one query
+CACHE_BATCH = 500
+
+# Large files go up as concurrent multipart uploads, captures fit in a single put
+MULTIPART_THRESHOLD = 8 * 1024 * 1024
+MULTIPART_CONCURRENCY = 4
+
+
+@lru_cache(maxsize=None)
+def default_transfer_config():
+    # Built by the first upload, so that starting an app does not import boto3
+    from boto3.s3.transfer import TransferConfig
+
+    return TransferConfig(multipart_threshold=MULTIPART_THRESHOLD, max_concurrency=MULTIPART_CONCURRENCY)
+
+
+class S3Storage:
+    """Buckets in S3, or in an S3-compatible server when the client was made with an endpoint_url.
+
+    get raises KeyError for a missing object; other failures are retried
+    by s3_ingest and then raised as they are.
+    """
+
+    def __init__(self, client, max_workers=s3_ingest.MAX_WORKERS, transfer_config=None):
+        self.client = client
+        self.max_workers = max_workers
+        self.transfer_config = transfer_config
+
+    def list(self, bucket, start_after=None, prefix=None):
+        return s3_ingest.list_keys(self.client, bucket, start_after, prefix)
+
+    def get(self, bucket, key):
+        try:
+            return s3_ingest.get_object_body(self.client, bucket, key)
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('NoSuchKey', '404'):
+                raise KeyError(key) from e
+            raise
+
+    def batch_get(self, bucket, keys, max_workers=None, errors=None):
+        return s3_ingest.fetch_objects(self.client, bucket, keys, max_workers or self.max_workers, errors)
+
+    def put(self, bucket, key, data):
+        with S3_REQUEST_SECONDS.time(operation='put'):
+            self.client.put_object(Bucket=bucket, Key=key, Body=data)
+
+    def put_file(self, bucket, key, path):
+        with S3_REQUEST_SECONDS.time(operation='put'):
+            self.client.upload_file(path, bucket, key, Config=self.transfer_config or default_transfer_config())
+
+
+class LocalStorage:
+    """Buckets as subdirectories of root and keys as paths below them, for running offline.
+
+    Keys are listed in sorted order, as S3 lists them, so watermarks work
+    the same way.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, bucket, key):
+        parts = key.split('/')
+        if not bucket or bucket.startswith('.') or '/' in bucket or '' in parts or '.' in parts or '..' in parts:
+            raise ValueError(f"Cannot store {bucket}/{key} in a directory")
+        return os.path.join(self.root, bucket, *parts)
+
+    def list(self, bucket, start_after=None, prefix=None):
+        bucket_dir = os.path.join(self.root, bucket)
+        keys = []
+        for root, _, files in os.walk(bucket_dir):
+            for name in files:
+                # Left behind by a write that never finished
+                if name.endswith('.part'):
+                    continue
+                keys.append(os.path.relpath(os.path.join(root, name), bucket_dir).replace(os.sep, '/'))
+        for key in sorted(keys):
+            if (not start_after or key > start_after) and (not prefix or key.startswith(prefix)):
+                yield key
+
+    def get(self, bucket, key):
+        try:
+            with open(self._path(bucket, key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            raise KeyError(key) from None
+
+    def batch_get(self, bucket, keys, max_workers=None, errors=None):
+        for key in keys:
+            try:
+                yield key, self.get(bucket, key)
+            except (KeyError, OSError) as e:
+                if errors is None:
+                    raise
+                errors.append((key, e))
+
+    def put(self, bucket, key, data):
+        path = self._path(bucket, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename, so readers never see a truncated object
+        with open(path + '.part', 'wb') as f:
+            f.write(data)
+        os.replace(path + '.part', path)
+
+    def put_file(self, bucket, key, path):
+        target = self._path(bucket, key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.copyfile(path, target + '.part')
+        os.replace(target + '.part', target)
+
+
+class CachedStorage:
+    """Read-through cache of another backend's objects in a local SQLite file, bounded to max_bytes.
+
+    get and batch_get serve cached objects from disk and fetch only the
+    misses; the least recently used objects are evicted once the cache
+    outgrows its bound. Listing always asks the backend, so new objects are
+    seen. Objects are assumed not to change once written, as with the
+    timestamped weather readings and captures.
+
+    Several processes can share the file. Triggers keep the total size in
+    a cache_size row, in the same transaction as every insert and delete,
+    so each process evicts against what is actually stored.
+    """
+
+    def __init__(self, backend, path=CACHE_PATH, max_bytes=CACHE_BYTES):
+        self.backend = backend
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        with self._lock, self._conn:
+            # Immediate, so a cache created before cache_size existed is totalled while nobody else writes
+            self._conn.execute('BEGIN IMMEDIATE')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS objects '
+                               '(bucket TEXT, key TEXT, body BLOB, size INTEGER, used REAL, PRIMARY KEY (bucket, key))')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS objects_used ON objects (used)')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS cache_size (id INTEGER PRIMARY KEY CHECK (id = 0), bytes INTEGER)')
+            self._conn.execute('INSERT OR IGNORE INTO cache_size SELECT 0, COALESCE(SUM(size), 0) FROM objects')
+            self._conn.execute('CREATE TRIGGER IF NOT EXISTS objects_inserted AFTER INSERT ON objects '
+                               'BEGIN UPDATE cache_size SET bytes = bytes + new.size; END')
+            self._conn.execute('CREATE TRIGGER IF NOT EXISTS objects_resized AFTER UPDATE OF size ON objects '
+                               'BEGIN UPDATE cache_size SET bytes = bytes - old.size + new.size; END')
+            self._conn.execute('CREATE TRIGGER IF NOT EXISTS objects_deleted AFTER DELETE ON objects '
+                               'BEGIN UPDATE cache_size SET bytes = bytes - old.size; END')
+
+    def list(self, bucket, start_after=None, prefix=None):
+        return self.backend.list(bucket, start_after, prefix)
+
+    def _lookup(self, bucket, keys):
+        """Returns {key: body} for the cached keys and marks them as just used."""
+        if not keys:
+            return {}
+        placeholders = ', '.join('?' * len(keys))
+        with self._lock, self._conn:
+            found = dict(self._conn.execute(
+                f'SELECT key, body FROM objects WHERE bucket = ? AND key IN ({placeholders})', (bucket, *keys)))
+            if found:
+                self._conn.execute(f"UPDATE objects SET used = ? WHERE bucket = ? AND key IN ({', '.join('?' * len(found))})",
+                                   (time.time(), bucket, *found))
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def _size(self):
+        return self._conn.execute('SELECT bytes FROM cache_size').fetchone()[0]
+
+    def _store(self, bucket, objects):
+        objects = [(key, body) for key, body in objects if len(body) <= self.max_bytes]
+        if not objects:
+            return
+        now = time.time()
+        with self._lock, self._conn:
+            # An upsert rather than INSERT OR REPLACE, whose implicit delete would not fire the trigger
+            self._conn.executemany('INSERT INTO objects VALUES (?, ?, ?, ?, ?) ON CONFLICT (bucket, key) '
+                                   'DO UPDATE SET body = excluded.body, size = excluded.size, used = excluded.used',
+                                   [(bucket, key, body, len(body), now) for key, body in objects])
+            # The insert holds the write lock, so the total includes every other process's writes
+            size = self._size()
+            if size > self.max_bytes:
+                self._evict(size)
+
+    def _evict(self, size):
+        # Called with the lock held, inside the inserting transaction
+        target = self.max_bytes * EVICT_TO
+        while size > target:
+            rows = self._conn.execute('SELECT rowid, size FROM objects ORDER BY used LIMIT ?', (CACHE_BATCH,)).fetchall()
+            if not rows:
+                break
+            doomed = []
+            for rowid, object_size in rows:
+                doomed.append((rowid,))
+                size -= object_size
+                if size <= target:
+                    break
+            self._conn.executemany('DELETE FROM objects WHERE rowid = ?', doomed)
+            self.evicted += len(doomed)
+
+    def get(self, bucket, key):
+        body = self._lookup(bucket, [key]).get(key)
+        if body is None:
+            body = self.backend.get(bucket, key)
+            self._store(bucket, [(key, body)])
+        return body
+
+    def batch_get(self, bucket, keys, max_workers=None, errors=None):
+        """Yields (key, body) in the order given, fetching the keys that are not cached concurrently.
+
+        Keys the backend fails to fetch raise, or with an errors list are
+        added to it as (key, exception) and skipped.
+        """
+        keys = iter(keys)
+        while True:
+            chunk = list(islice(keys, CACHE_BATCH))
+            if not chunk:
+                return
+            cached = self._lookup(bucket, chunk)
+            misses = [key for key in chunk if key not in cached]
+            fetched = self.backend.batch_get(bucket, misses, max_workers, errors) if misses else iter(())
+            stored = []
+            try:
+                # The backend yields the misses in the order they were asked for, less the ones that failed
+                upcoming = next(fetched, None)
+                for key in chunk:
+                    if key in cached:
+                        yield key, cached[key]
+                    elif upcoming is not None and upcoming[0] == key:
+                        stored.append(upcoming)
+                        yield upcoming
+                        upcoming = next(fetched, None)
+            finally:
+                # Stops the backend's downloads if the caller stopped early
+                if misses:
+                    fetched.close()
+                self._store(bucket, stored)
+
+    def prefetch(self, bucket, start_after=None, end_before=None, prefix=None, max_workers=None):
+        """Downloads every uncached key after start_after and before end_before into the cache; returns how many."""
+        keys = self.backend.list(bucket, start_after, prefix)
+        if end_before:
+            keys = takewhile(lambda key: key < end_before, keys)
+        fetched = 0
+        while True:
+            chunk = list(islice(keys, CACHE_BATCH))
+            if not chunk:
+                return fetched
+            placeholders = ', '.join('?' * len(chunk))
+            with self._lock:
+                cached = {key for key, in self._conn.execute(
+                    f'SELECT key FROM objects WHERE bucket = ? AND key IN ({placeholders})', (bucket, *chunk))}
+            misses = [key for key in chunk if key not in cached]
+            if misses:
+                self._store(bucket, self.backend.batch_get(bucket, misses, max_workers))
+                fetched += len(misses)
+
+    def put(self, bucket, key, data):
+        self.backend.put(bucket, key, data)
+        self._store(bucket, [(key, data)])
+
+    def put_file(self, bucket, key, path):
+        # Uploads such as captures are not read back by the apps, so they are not cached
+        self.backend.put_file(bucket, key, path)
+
+    def status(self):
+        with self._lock:
+            objects = self._conn.execute('SELECT COUNT(*) FROM objects').fetchone()[0]
+            size = self._size()
+        return {'objects': objects, 'bytes': size, 'max_bytes': self.max_bytes, 'hits': self.hits,
+                'misses': self.misses, 'evicted': self.evicted}
+
+
+def open_storage(aws_access_key_id=None, aws_secret_access_key=None, url=None, cache_path=CACHE_PATH,
+                 cache_bytes=CACHE_BYTES):
+    """Opens the backend url names (STORAGE_URL by default), behind the read-through cache if it is remote."""
+    url = url or STORAGE_URL
+    if url.startswith('file://'):
+        # Already on local disk, so there is nothing to cache
+        return LocalStorage(url[len('file://'):])
+    if url == 's3':
+        client = s3_ingest.make_client(aws_access_key_id, aws_secret_access_key)
+    elif url.startswith(('s3+http://', 's3+https://')):
+        client = s3_ingest.make_client(aws_access_key_id, aws_secret_access_key, endpoint_url=url[len('s3+'):])
+    else:
+        raise ValueError(f"Unknown storage {url!r}; expected s3, s3+http(s)://host:port or file:///path")
+    backend = S3Storage(client)
+    return CachedStorage(backend, cache_path, cache_bytes) if cache_bytes else backend
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fills the read-through cache with a range of keys.')
+    parser.add_argument('command', choices=['prefetch'])
+    parser.add_argument('bucket')
+    parser.add_argument('--start-after', help='only keys sorting after this one')
+    parser.add_argument('--end-before', help='only keys sorting before this one')
+    parser.add_argument('--prefix')
+    args = parser.parse_args()
+
+    storage = open_storage(os.environ.get('AWS_ACCESS_KEY_ID'), os.environ.get('AWS_SECRET_ACCESS_KEY'))
+    if not isinstance(storage, CachedStorage):
+        parser.error('prefetch needs a remote STORAGE_URL and a cache (STORAGE_CACHE_BYTES > 0)')
+    started = time.time()
+    fetched = storage.prefetch(args.bucket, args.start_after, args.end_before, args.prefix)
+    print(f"Prefetched {fetched} objects in {time.time() - started:.1f} s; cache: {storage.status()}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+import math
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+import numpy as np
+
+from weather_store import ATTRIBUTES
+
+# Smoothed series kept per (attribute, alpha, data version)
+SMOOTHING_CACHE_ENTRIES = 64
+
+# Point budget for plots and API responses when the client does not ask for one
+DEFAULT_MAX_POINTS = 1000
+MAX_POINTS_LIMIT = 10000
+
+# Largest power of 1 / (1 - alpha) the NumPy fallback lets a block reach before renormalising
+_MAX_BLOCK_GROWTH = 1e100
+
+
+@lru_cache(maxsize=None)
+def _lfilter():
+    # SciPy takes about a second to import, so it is loaded by the first smoothing call
+    try:
+        from scipy.signal import lfilter
+    except ImportError:
+        return None
+    return lfilter
+
+
+def low_pass_filter(data, cloud_cover):
+    """Exponentially smooths data, giving each new point a weight of cloud_cover percent."""
+    values = np.asarray(data, dtype=float)
+    return smooth_columns(values.reshape(-1, 1), cloud_cover / 100)[:, 0]
+
+
+def smooth_columns(values, alpha):
+    """Applies y[n] = alpha * x[n] + (1 - alpha) * y[n - 1] down every column of a 2-D array at once.
+
+    The first row is passed through unchanged, matching the original loop.
+    A missing (NaN) reading holds the previous smoothed value instead of
+    poisoning the rest of the column; rows before a column's first reading
+    stay NaN.
+    """
+    values = np.asarray(values, dtype=float)
+    if not len(values):
+        return values.copy()
+    missing = np.isnan(values)
+    if not missing.any():
+        return _smooth(values, alpha)
+    smoothed = np.empty_like(values)
+    for index in range(values.shape[1]):
+        valid = ~missing[:, index]
+        run = _smooth(values[valid, index:index + 1], alpha)[:, 0]
+        # Each row takes the result for the latest reading at or before it; index -1 picks the NaN
+        smoothed[:, index] = np.append(run, np.nan)[np.cumsum(valid) - 1]
+    return smoothed
+
+
+def _smooth(values, alpha):
+    if not len(values):
+        return values.copy()
+    lfilter = _lfilter()
+    if lfilter is not None:
+        # Initial state makes the first output equal the first input
+        zi = (1 - alpha) * values[:1]
+        smoothed, _ = lfilter([alpha], [1, alpha - 1], values, axis=0, zi=zi)
+        return smoothed
+    return _smooth_numpy(values, alpha)
+
+
+def _smooth_numpy(values, alpha):
+    """Closed-form NumPy version of smooth_columns, used when SciPy is not installed.
+
+    Inside a block y[s + k] = d^(k+1) * y[s - 1] + alpha * d^k * cumsum(x[s + j] / d^j),
+    with d = 1 - alpha. Blocks are kept short enough that d^-k cannot overflow.
+    """
+    decay = 1 - alpha
+    if decay <= 0:
+        return values.copy()
+    if decay >= 1:
+        return np.broadcast_to(values[:1], values.shape).copy()
+
+    block = max(1, int(math.log(_MAX_BLOCK_GROWTH) / -math.log(decay)))
+    powers = decay ** np.arange(min(block, len(values)))[:, None]
+    smoothed = np.empty_like(values)
+    previous = values[0]
+    for start in range(0, len(values), block):
+        chunk = values[start:start + block]
+        scale = powers[:len(chunk)]
+        smoothed[start:start + len(chunk)] = (
+            decay * scale * previous + alpha * scale * np.cumsum(chunk / scale, axis=0)
+        )
+        previous = smoothed[start + len(chunk) - 1]
+    return smoothed
+
+
+class SmoothingCache:
+    """LRU cache of smoothed snapshot columns keyed by (attribute, alpha, data version).
+
+    A miss smooths every attribute in one pass, so switching attribute at the
+    same alpha is served from the cache.
+    """
+
+    def __init__(self, max_entries=SMOOTHING_CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, snapshot, attribute, alpha):
+        key = (attribute, alpha, snapshot.version)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+
+        smoothed = smooth_columns(snapshot.values, alpha)
+        smoothed.flags.writeable = False
+        with self._lock:
+            for index, name in enumerate(ATTRIBUTES):
+                self._entries[(name, alpha, snapshot.version)] = smoothed[:, index]
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return smoothed[:, ATTRIBUTES.index(attribute)]
+
+
+def to_json_values(values):
+    """Converts a float array to a list with None in place of NaN and infinities, which JSON cannot represent."""
+    return [value if math.isfinite(value) else None for value in np.asarray(values, dtype=float).tolist()]
+
+
+def parse_time(value):
+    """Parses an ISO date or date-time query parameter into a datetime64, raising ValueError if malformed."""
+    return np.datetime64(value.replace(' ', 'T'), 's')
+
+
+def time_range(timestamps, start=None, end=None):
+    """Returns the (lo, hi) slice bounds of sorted timestamps falling inside [start, end]."""
+    lo = np.searchsorted(timestamps, start, side='left') if start is not None else 0
+    hi = np.searchsorted(timestamps, end, side='right') if end is not None else len(timestamps)
+    return lo, max(lo, hi)
+
+
+def clamp_max_points(max_points):
+    return min(max(max_points or DEFAULT_MAX_POINTS, 3), MAX_POINTS_LIMIT)
+
+
+def downsample(timestamps, values, max_points, method='lttb'):
+    """Returns the indices of at most max_points points that preserve the shape of the series.
+
+    NaN values are dropped first. 'lttb' keeps the Largest-Triangle-Three-Buckets
+    points; 'minmax' keeps the minimum and maximum of each bucket.
+    """
+    valid = np.flatnonzero(~np.isnan(values))
+    if len(valid) <= max_points:
+        return valid
+    x = timestamps[valid].astype('int64').astype(float)
+    y = values[valid]
+    if method == 'minmax':
+        return valid[_minmax(y, max_points)]
+    return valid[_lttb(x, y, max_points)]
+
+
+def _minmax(y, max_points):
+    buckets = max_points // 2
+    edges = np.linspace(0, len(y), buckets + 1).astype(int)
+    keep = []
+    for lo, hi in zip(edges[:-1], edges[1:]):
+        chunk = y[lo:hi]
+        keep.extend(sorted({lo + int(np.argmin(chunk)), lo + int(np.argmax(chunk))}))
+    return np.array(keep)
+
+
+def _lttb(x, y, max_points):
+    # First and last points are always kept; the rest are split into equal buckets
+    edges = np.linspace(1, len(y) - 1, max_points - 1).astype(int)
+    keep = np.empty(max_points, dtype=int)
+    keep[0] = 0
+    keep[-1] = len(y) - 1
+    previous = 0
+    for bucket in range(max_points - 2):
+        lo, hi = edges[bucket], edges[bucket + 1]
+        next_lo, next_hi = hi, edges[bucket + 2] if bucket + 2 < len(edges) else len(y)
+        # Average of the next bucket is the third corner of the triangle
+        next_x = x[next_lo:next_hi].mean()
+        next_y = y[next_lo:next_hi].mean()
+        areas = np.abs(
+            (x[previous] - next_x) * (y[lo:hi] - y[previous])
+            - (x[previous] - x[lo:hi]) * (next_y - y[previous])
+        )
+        previous = lo + int(np.argmax(areas))
+        keep[bucket + 1] = previous
+    return keep
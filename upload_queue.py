@@ -0,0 +1,191 @@
+import os
+import queue
+import random
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+from metrics import UPLOAD_LATENCY_SECONDS
+from s3_ingest import PERMANENT_ERRORS
+
+# Files are written here before upload and removed once storage has them
+SPOOL_DIR = os.environ.get('UPLOAD_SPOOL_DIR',
+                           os.path.join(os.path.dirname(os.path.abspath(__file__)), 'upload_spool'))
+
+# Number of background uploader threads
+UPLOAD_WORKERS = int(os.environ.get('UPLOAD_WORKERS', 4))
+
+# Retry delay doubles after every failed attempt, up to the maximum
+BACKOFF_SECONDS = 0.5
+MAX_BACKOFF_SECONDS = 60
+
+# Spool subdirectory for files storage refused outright, kept for inspection instead of retried
+FAILED_DIR = '_failed'
+
+
+def _error_code(error):
+    # upload_file wraps the ClientError it caught in an S3UploadFailedError
+    while error is not None:
+        if isinstance(error, ClientError):
+            return error.response.get('Error', {}).get('Code')
+        error = error.__context__
+    return None
+
+
+class UploadQueue:
+    """Durable spool of files waiting to go to storage, drained by background uploader threads.
+
+    put() returns as soon as the file is safely on disk. Anything still in the
+    spool when the process stops is picked up again on the next start. A
+    spool file that disappears was handled by another queue sharing the
+    spool and counts as done.
+    """
+
+    def __init__(self, storage, spool_dir=SPOOL_DIR, workers=UPLOAD_WORKERS):
+        self.storage = storage
+        self.spool_dir = spool_dir
+        self.uploaded = 0
+        self.failed = 0
+        self.retrying = 0
+        self.last_error = None
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._threads = [threading.Thread(target=self._run, name=f's3-upload-{i}', daemon=True)
+                         for i in range(workers)]
+        self._recover()
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        """Stops the uploaders; files not yet uploaded stay in the spool."""
+        self._stop.set()
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def put(self, data, bucket, key):
+        """Writes data to the spool and queues it for upload to bucket/key."""
+        path = os.path.join(self.spool_dir, bucket, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename, so a crash never leaves a truncated file in the spool
+        temporary = path + '.part'
+        with open(temporary, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, path)
+        self._queue.put((bucket, key))
+        return path
+
+    def depth(self):
+        """Number of files waiting for or in the middle of an upload."""
+        return self._queue.unfinished_tasks
+
+    def join(self):
+        """Blocks until every queued file has been uploaded or set aside."""
+        self._queue.join()
+
+    def status(self):
+        return {
+            'depth': self.depth(),
+            'retrying': self.retrying,
+            'uploaded': self.uploaded,
+            'failed': self.failed,
+            'last_error': self.last_error,
+        }
+
+    def _recover(self):
+        if not os.path.isdir(self.spool_dir):
+            return
+        pending = []
+        for bucket in sorted(os.listdir(self.spool_dir)):
+            bucket_dir = os.path.join(self.spool_dir, bucket)
+            if bucket == FAILED_DIR or not os.path.isdir(bucket_dir):
+                continue
+            for root, _, files in os.walk(bucket_dir):
+                for name in files:
+                    path = os.path.join(root, name)
+                    try:
+                        if name.endswith('.part'):
+                            # Left behind by a write that never finished
+                            os.remove(path)
+                            continue
+                        pending.append((os.path.getmtime(path), bucket,
+                                        os.path.relpath(path, bucket_dir).replace(os.sep, '/')))
+                    except FileNotFoundError:
+                        # Uploaded by another queue sharing the spool since it was listed
+                        continue
+        # Oldest captures go first
+        for _, bucket, key in sorted(pending):
+            self._queue.put((bucket, key))
+        if pending:
+            print(f"Resuming upload of {len(pending)} spooled files")
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                self._upload(*item)
+            except Exception as e:
+                # Leave the file in the spool for the next start rather than lose the uploader thread
+                self.last_error = f"{item[0]}/{item[1]}: {e}"
+                print(f"Error uploading {item[0]}/{item[1]}: {e}")
+            finally:
+                self._queue.task_done()
+
+    def _upload(self, bucket, key):
+        path = os.path.join(self.spool_dir, bucket, key)
+        attempt = 0
+        try:
+            while not self._stop.is_set():
+                try:
+                    self.storage.put_file(bucket, key, path)
+                except Exception as e:
+                    if not os.path.exists(path):
+                        # Another queue sharing the spool uploaded it and removed the file
+                        return
+                    self.last_error = f"{bucket}/{key}: {e}"
+                    # A key a local directory cannot hold will not become valid either
+                    if isinstance(e, ValueError) or _error_code(e) in PERMANENT_ERRORS:
+                        self._set_aside(path, bucket, key)
+                        return
+                else:
+                    try:
+                        # The spool file's mtime is when it was queued, even across a restart
+                        UPLOAD_LATENCY_SECONDS.observe(time.time() - os.path.getmtime(path))
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+                    with self._lock:
+                        self.uploaded += 1
+                    return
+
+                if attempt == 0:
+                    with self._lock:
+                        self.retrying += 1
+                delay = min(MAX_BACKOFF_SECONDS, BACKOFF_SECONDS * 2 ** attempt) * random.uniform(0.5, 1.5)
+                attempt += 1
+                self._stop.wait(delay)
+        finally:
+            if attempt:
+                with self._lock:
+                    self.retrying -= 1
+
+    def _set_aside(self, path, bucket, key):
+        print(f"Upload of {bucket}/{key} refused, moved to {FAILED_DIR}: {self.last_error}")
+        failed_path = os.path.join(self.spool_dir, FAILED_DIR, bucket, key)
+        os.makedirs(os.path.dirname(failed_path), exist_ok=True)
+        try:
+            os.replace(path, failed_path)
+        except FileNotFoundError:
+            return
+        with self._lock:
+            self.failed += 1
@@ -0,0 +1,335 @@
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from metrics import DATAFRAME_SECONDS
+from timeseries import clamp_max_points, downsample, time_range, to_json_values
+from weather_store import ATTRIBUTES
+
+# Unit of the temperature readings, 'C' or 'F'; dew point and heat index come out in the same unit
+TEMPERATURE_UNIT = os.environ.get('TEMPERATURE_UNIT', 'C').upper()
+
+# Quantities computed from the readings, served alongside the measured attributes
+DERIVED = ['dew_point', 'heat_index']
+ANALYTIC_ATTRIBUTES = ATTRIBUTES + DERIVED
+
+# Each reading is compared with the readings in the window before it
+DEFAULT_WINDOW_MINUTES = 60
+MAX_WINDOW_MINUTES = 7 * 24 * 60
+
+# Readings needed in a window before its statistics are reported
+MIN_WINDOW_READINGS = 5
+
+# Default anomaly thresholds: standard deviations from the window mean, or IQRs beyond the quartiles
+Z_THRESHOLD = 3.0
+IQR_FACTOR = 1.5
+ANOMALY_METHODS = ('zscore', 'iqr')
+
+# Total size of the rolling statistics kept per (attribute, window); each is extended, not recomputed,
+# when readings arrive
+ANALYTICS_CACHE_BYTES = int(os.environ.get('ANALYTICS_CACHE_BYTES', 64 * 1024 * 1024))
+
+# Holt-Winters runs on hourly means with a daily season, fitted to the most recent weeks
+SEASON_HOURS = 24
+FORECAST_HISTORY_HOURS = 14 * 24
+DEFAULT_HORIZON_HOURS = 24
+MAX_HORIZON_HOURS = 7 * 24
+
+# Smoothing parameters tried when fitting; every combination is run at once as one vector
+ALPHAS = (0.1, 0.3, 0.5, 0.8)
+BETAS = (0.01, 0.05, 0.2)
+GAMMAS = (0.05, 0.2, 0.5)
+
+# Width of the forecast band in standard deviations of the one-step errors, about 95%
+BAND_Z = 1.96
+
+STAT_COLUMNS = ('mean', 'std', 'min', 'max', 'q1', 'q3')
+
+# Magnus formula coefficients, over water, for temperatures in Celsius
+MAGNUS_A = 17.625
+MAGNUS_B = 243.04
+
+
+def _to_celsius(temperature):
+    return (temperature - 32) * 5 / 9 if TEMPERATURE_UNIT == 'F' else temperature
+
+
+def _from_celsius(temperature):
+    return temperature * 9 / 5 + 32 if TEMPERATURE_UNIT == 'F' else temperature
+
+
+def dew_point(temperature, humidity):
+    """Dew point from temperature and relative humidity in percent, by the Magnus formula; NaN where humidity is 0."""
+    celsius = _to_celsius(np.asarray(temperature, dtype=float))
+    humidity = np.asarray(humidity, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        gamma = np.log(np.where(humidity > 0, humidity, np.nan) / 100) + MAGNUS_A * celsius / (MAGNUS_B + celsius)
+        return _from_celsius(MAGNUS_B * gamma / (MAGNUS_A - gamma))
+
+
+def heat_index(temperature, humidity):
+    """Apparent temperature from the US National Weather Service heat index equations.
+
+    Below about 80 F the simple formula is used, above it the Rothfusz
+    regression with the NWS adjustments for very dry and very humid air.
+    """
+    t = np.asarray(temperature, dtype=float)
+    t = t * 9 / 5 + 32 if TEMPERATURE_UNIT == 'C' else t
+    rh = np.asarray(humidity, dtype=float)
+    simple = 0.5 * (t + 61 + (t - 68) * 1.2 + rh * 0.094)
+    full = (-42.379 + 2.04901523 * t + 10.14333127 * rh - 0.22475541 * t * rh - 6.83783e-3 * t * t
+            - 5.481717e-2 * rh * rh + 1.22874e-3 * t * t * rh + 8.5282e-4 * t * rh * rh - 1.99e-6 * t * t * rh * rh)
+    with np.errstate(invalid='ignore'):
+        dry = (rh < 13) & (t >= 80) & (t <= 112)
+        full = np.where(dry, full - (13 - rh) / 4 * np.sqrt(np.abs(17 - np.abs(t - 95)) / 17), full)
+        humid = (rh > 85) & (t >= 80) & (t <= 87)
+        full = np.where(humid, full + (rh - 85) / 10 * (87 - t) / 5, full)
+        fahrenheit = np.where((simple + t) / 2 >= 80, full, simple)
+    return (fahrenheit - 32) * 5 / 9 if TEMPERATURE_UNIT == 'C' else fahrenheit
+
+
+def attribute_values(snapshot, attribute, lo=0):
+    """A measured or derived attribute's values from reading lo onwards."""
+    if attribute == 'dew_point':
+        return dew_point(snapshot.column('temperature')[lo:], snapshot.column('humidity')[lo:])
+    if attribute == 'heat_index':
+        return heat_index(snapshot.column('temperature')[lo:], snapshot.column('humidity')[lo:])
+    return snapshot.column(attribute)[lo:]
+
+
+def rolling_stats(timestamps, values, window_minutes):
+    """Mean, std, min, max and quartiles of the readings in the window before each reading.
+
+    The reading itself is left out of its own window, so a spike is compared
+    with what came before it. Timestamps must be sorted, as snapshots are.
+    """
+    import pandas as pd
+
+    series = pd.Series(values, index=pd.DatetimeIndex(timestamps))
+    rolling = series.rolling(f'{window_minutes}min', closed='left', min_periods=MIN_WINDOW_READINGS)
+    return {
+        'mean': rolling.mean().to_numpy(),
+        'std': rolling.std().to_numpy(),
+        'min': rolling.min().to_numpy(),
+        'max': rolling.max().to_numpy(),
+        'q1': rolling.quantile(0.25).to_numpy(),
+        'q3': rolling.quantile(0.75).to_numpy(),
+    }
+
+
+def anomaly_scores(values, stats, method='zscore'):
+    """How unusual each value is against its window: standard scores, or distance beyond the quartiles in IQRs.
+
+    NaN where the window had too few readings or no spread.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if method == 'iqr':
+            spread = stats['q3'] - stats['q1']
+            beyond = np.maximum(stats['q1'] - values, values - stats['q3'])
+            scores = np.where(beyond > 0, beyond, 0) / spread * np.sign(values - (stats['q1'] + stats['q3']) / 2)
+        else:
+            scores = (values - stats['mean']) / stats['std']
+    scores[~np.isfinite(scores)] = np.nan
+    return scores
+
+
+class Analysis:
+    """Rolling statistics of one attribute for one snapshot version; arrays line up with the snapshot's readings."""
+
+    __slots__ = ('attribute', 'window_minutes', 'version', 'length', 'last_timestamp', 'values', 'stats')
+
+    def __init__(self, attribute, window_minutes, version, length, last_timestamp, values, stats):
+        self.attribute = attribute
+        self.window_minutes = window_minutes
+        self.version = version
+        self.length = length
+        self.last_timestamp = last_timestamp
+        self.values = values
+        self.stats = stats
+
+    def extends_to(self, snapshot):
+        """Whether snapshot holds these readings followed by new ones, so only the new ones need computing."""
+        return (self.length and len(snapshot) >= self.length
+                and snapshot.timestamps[self.length - 1] == self.last_timestamp)
+
+    @property
+    def nbytes(self):
+        return self.values.nbytes + sum(array.nbytes for array in self.stats.values())
+
+
+class AnalyticsCache:
+    """Size-bounded LRU cache of rolling statistics per (attribute, window), brought up to date with each new snapshot.
+
+    When a snapshot only appends readings, just the new readings and the
+    window of history before them are computed and added to the previous
+    arrays; anything else, such as a reload after a restart, starts over.
+    Every entry is a handful of arrays the length of the snapshot, so the
+    cache is bounded by their total size rather than by the number of
+    windows clients ask for.
+    """
+
+    def __init__(self, max_bytes=ANALYTICS_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self._size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, snapshot, attribute, window_minutes=DEFAULT_WINDOW_MINUTES):
+        key = (attribute, window_minutes)
+        with self._lock:
+            previous = self._entries.get(key)
+            if previous is not None:
+                self._entries.move_to_end(key)
+                if previous.version == snapshot.version:
+                    return previous
+
+        analysis = self._compute(snapshot, attribute, window_minutes, previous)
+        with self._lock:
+            current = self._entries.get(key)
+            if current is None or current.version < analysis.version:
+                self._size += analysis.nbytes - (current.nbytes if current is not None else 0)
+                self._entries[key] = analysis
+                self._entries.move_to_end(key)
+            while self._size > self.max_bytes and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= evicted.nbytes
+        return analysis
+
+    @DATAFRAME_SECONDS.timed(stage='analytics')
+    def _compute(self, snapshot, attribute, window_minutes, previous):
+        timestamps = snapshot.timestamps
+        last = timestamps[-1] if len(timestamps) else None
+        if previous is not None and previous.extends_to(snapshot):
+            if len(snapshot) == previous.length:
+                return Analysis(attribute, window_minutes, snapshot.version, previous.length, last, previous.values,
+                                previous.stats)
+            # The new readings' windows reach back into readings already analysed
+            start = previous.length
+            lo = int(np.searchsorted(timestamps, timestamps[start] - np.timedelta64(window_minutes, 'm'), 'left'))
+            tail = rolling_stats(timestamps[lo:], attribute_values(snapshot, attribute, lo), window_minutes)
+            values = np.concatenate([previous.values, attribute_values(snapshot, attribute, start)])
+            stats = {name: np.concatenate([previous.stats[name], tail[name][start - lo:]]) for name in STAT_COLUMNS}
+        else:
+            values = np.asarray(attribute_values(snapshot, attribute), dtype=float)
+            stats = rolling_stats(timestamps, values, window_minutes)
+        for array in [values, *stats.values()]:
+            array.flags.writeable = False
+        return Analysis(attribute, window_minutes, snapshot.version, len(snapshot), last, values, stats)
+
+
+def analytics_summary(snapshot, analysis, method='zscore', threshold=None, start=None, end=None, max_points=None):
+    """Rolling statistics between start and end, downsampled to max_points, and the anomalies among them.
+
+    Scores are computed from the cached statistics on every call, which is
+    cheap, so changing the method or threshold needs no recomputation.
+    Anomalies are always among the points sent, and listed on their own,
+    the newest max_points of them.
+    """
+    if threshold is None:
+        threshold = Z_THRESHOLD if method == 'zscore' else IQR_FACTOR
+    max_points = clamp_max_points(max_points)
+    lo, hi = time_range(snapshot.timestamps, start, end)
+    timestamps = snapshot.timestamps[lo:hi]
+    values = analysis.values[lo:hi]
+    stats = {name: column[lo:hi] for name, column in analysis.stats.items()}
+    scores = anomaly_scores(values, stats, method)
+    flagged = np.flatnonzero(np.abs(np.nan_to_num(scores)) > threshold)[-max_points:]
+    keep = np.union1d(downsample(timestamps, values, max_points), flagged)
+    return {
+        'attribute': analysis.attribute,
+        'window_minutes': analysis.window_minutes,
+        'method': method,
+        'threshold': threshold,
+        'timestamps': np.datetime_as_string(timestamps[keep], unit='s').tolist(),
+        'values': to_json_values(values[keep]),
+        **{name: to_json_values(column[keep]) for name, column in stats.items()},
+        'anomalies': {
+            'timestamps': np.datetime_as_string(timestamps[flagged], unit='s').tolist(),
+            'values': to_json_values(values[flagged]),
+            'scores': to_json_values(scores[flagged]),
+        },
+    }
+
+
+def hourly_series(snapshot, attribute, hours=FORECAST_HISTORY_HOURS):
+    """The attribute's hourly means over the last hours, on a regular grid with gaps interpolated."""
+    rollup = snapshot.rollups.get('hour')
+    if rollup is None or not len(rollup):
+        return np.array([], dtype='datetime64[h]'), np.array([])
+    timestamps = rollup.index.values.astype('datetime64[h]')
+    values = rollup[attribute].to_numpy(dtype=float)
+    present = ~np.isnan(values)
+    timestamps, values = timestamps[present], values[present]
+    if not len(values):
+        return timestamps, values
+    grid = np.arange(max(timestamps[0], timestamps[-1] - np.timedelta64(hours - 1, 'h')),
+                     timestamps[-1] + np.timedelta64(1, 'h'))
+    return grid, np.interp(grid.astype(float), timestamps.astype(float), values)
+
+
+def holt_winters(values, season):
+    """Fits additive Holt-Winters by one-step squared error over the ALPHAS x BETAS x GAMMAS grid.
+
+    Every parameter combination is smoothed at the same time as one row of
+    NumPy arrays, so the fit costs one pass over the series. Returns the
+    best (alpha, beta, gamma), the final level, trend and seasonal state,
+    and the root mean square of its one-step errors.
+    """
+    grid = np.array([(a, b, g) for a in ALPHAS for b in BETAS for g in (GAMMAS if season > 1 else (0.0,))])
+    alpha, beta, gamma = grid[:, 0], grid[:, 1], grid[:, 2]
+    if season > 1:
+        level = np.full(len(grid), values[:season].mean())
+        trend = np.full(len(grid), (values[season:2 * season].mean() - values[:season].mean()) / season)
+        seasonal = np.tile(values[:season] - values[:season].mean(), (len(grid), 1))
+    else:
+        level = np.full(len(grid), values[0])
+        trend = np.full(len(grid), values[1] - values[0])
+        seasonal = np.zeros((len(grid), 1))
+    errors = np.zeros((len(grid), len(values)))
+    for t in range(1, len(values)):
+        s = seasonal[:, t % season]
+        errors[:, t] = values[t] - (level + trend + s)
+        previous_level = level
+        level = alpha * (values[t] - s) + (1 - alpha) * (level + trend)
+        trend = beta * (level - previous_level) + (1 - beta) * trend
+        seasonal[:, t % season] = gamma * (values[t] - level) + (1 - gamma) * s
+    # The first season only initialises the state
+    scored = errors[:, min(season, len(values) - 1):]
+    best = int(np.argmin((scored ** 2).mean(axis=1)))
+    return {
+        'alpha': float(alpha[best]), 'beta': float(beta[best]), 'gamma': float(gamma[best]),
+        'level': level[best], 'trend': trend[best], 'seasonal': seasonal[best], 'next': len(values),
+        'rmse': float(np.sqrt((scored[best] ** 2).mean())),
+    }
+
+
+@DATAFRAME_SECONDS.timed(stage='forecast')
+def forecast(snapshot, attribute, horizon=DEFAULT_HORIZON_HOURS):
+    """Hourly forecast of the attribute for the next horizon hours, or None with fewer than three hours of data.
+
+    A daily season is used once there are two days of history; before that
+    the trend alone (Holt's linear method) is extrapolated.
+    """
+    timestamps, values = hourly_series(snapshot, attribute)
+    if len(values) < 3:
+        return None
+    season = SEASON_HOURS if len(values) >= 2 * SEASON_HOURS else 1
+    fit = holt_winters(values, season)
+    steps = np.arange(1, horizon + 1)
+    predicted = fit['level'] + steps * fit['trend'] + fit['seasonal'][(fit['next'] + steps - 1) % season]
+    # The band widens as errors compound further ahead
+    band = BAND_Z * fit['rmse'] * np.sqrt(steps)
+    return {
+        'attribute': attribute,
+        'method': 'holt-winters' if season > 1 else 'holt',
+        'season_hours': season,
+        'history_hours': len(values),
+        'params': {name: fit[name] for name in ('alpha', 'beta', 'gamma')},
+        'rmse': fit['rmse'],
+        'timestamps': np.datetime_as_string(timestamps[-1] + steps.astype('timedelta64[h]'), unit='s').tolist(),
+        'forecast': predicted.tolist(),
+        'lower': (predicted - band).tolist(),
+        'upper': (predicted + band).tolist(),
+    }
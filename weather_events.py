@@ -0,0 +1,83 @@
+import json
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from timeseries import parse_time, to_json_values
+from weather_store import ATTRIBUTES
+
+# A comment line is sent when nothing new arrived for this long, so proxies keep the stream open
+HEARTBEAT_SECONDS = 15
+
+# How long a browser waits before reconnecting a dropped stream
+RETRY_MILLISECONDS = 5000
+
+# Most readings in one delta, for clients that have been away a long time
+MAX_DELTA_READINGS = 1000
+
+# Encoded deltas kept for clients at different points in the history
+DELTA_CACHE_ENTRIES = 64
+
+
+def parse_since(value):
+    """Parses a since parameter or Last-Event-ID header, returning None when it is missing or malformed."""
+    try:
+        return parse_time(value) if value else None
+    except ValueError:
+        return None
+
+
+class WeatherEvents:
+    """Pushes newly ingested readings to live clients from the ingest worker's snapshots.
+
+    Every stream waits on the worker for the next snapshot rather than asking
+    S3 itself, and a delta is encoded once for all the clients that need it.
+    """
+
+    def __init__(self, ingest_worker, heartbeat=HEARTBEAT_SECONDS):
+        self.ingest_worker = ingest_worker
+        self.heartbeat = heartbeat
+        self._deltas = OrderedDict()
+        self._lock = threading.Lock()
+
+    def delta(self, snapshot, since=None, limit=MAX_DELTA_READINGS):
+        """Returns the readings after since, at most the newest limit, as compact columnar JSON bytes."""
+        start = np.searchsorted(snapshot.timestamps, since, side='right') if since is not None else 0
+        start = int(max(start, len(snapshot) - limit))
+        key = (snapshot.version, start)
+        with self._lock:
+            if key in self._deltas:
+                self._deltas.move_to_end(key)
+                return self._deltas[key]
+
+        payload = {'timestamps': np.datetime_as_string(snapshot.timestamps[start:], unit='s').tolist()}
+        for index, name in enumerate(ATTRIBUTES):
+            payload[name] = to_json_values(snapshot.values[start:, index])
+        body = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+        with self._lock:
+            self._deltas[key] = body
+            while len(self._deltas) > DELTA_CACHE_ENTRIES:
+                self._deltas.popitem(last=False)
+        return body
+
+    def stream(self, since=None):
+        """Yields Server-Sent Events: readings after since (or none, if not given), then each new batch.
+
+        Every event's id is its newest timestamp, which a reconnecting
+        browser sends back as Last-Event-ID.
+        """
+        yield f'retry: {RETRY_MILLISECONDS}\n\n'.encode('utf-8')
+        snapshot = self.ingest_worker.snapshot()
+        if since is None and len(snapshot):
+            since = snapshot.timestamps[-1]
+        while True:
+            if len(snapshot) and (since is None or snapshot.timestamps[-1] > since):
+                body = self.delta(snapshot, since)
+                since = snapshot.timestamps[-1]
+                yield b'id: ' + str(since).encode('utf-8') + b'\nevent: readings\ndata: ' + body + b'\n\n'
+            newer = self.ingest_worker.wait_for_snapshot(snapshot.version, self.heartbeat)
+            if newer is None:
+                yield b': keep-alive\n\n'
+            else:
+                snapshot = newer
@@ -0,0 +1,216 @@
+import fcntl
+import json
+import os
+import shutil
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+
+from timeseries import time_range
+from weather_store import ATTRIBUTES, TIMESTAMP_FORMAT, WeatherStore
+
+# Compacted history lives next to the code unless WEATHER_PARTITION_DIR says otherwise
+PARTITION_DIR = os.environ.get(
+    'WEATHER_PARTITION_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'weather_partitions')
+)
+
+# Seconds between compactions run by the ingest worker
+COMPACT_SECONDS = float(os.environ.get('WEATHER_COMPACT_SECONDS', 3600))
+
+MANIFEST = 'manifest.json'
+
+# Held exclusively while compacting and shared while reading, by every process using the directory
+LOCK = '.lock'
+
+# Readings are stored as float32, which holds about 7 significant digits
+SIGNIFICANT_DIGITS = 7
+
+
+def _widen(values, out):
+    """Writes float32 readings into the float64 out, rounded so that 21.3 reads back as 21.3 and not 21.299999."""
+    out[:] = values
+    with np.errstate(divide='ignore', invalid='ignore'):
+        magnitude = np.floor(np.log10(np.abs(out)))
+    scale = 10.0 ** (SIGNIFICANT_DIGITS - 1 - np.nan_to_num(magnitude, nan=0, posinf=0, neginf=0))
+    np.multiply(out, scale, out=out)
+    np.round(out, out=out)
+    np.divide(out, scale, out=out)
+
+
+def _gather(selected, attributes):
+    """Copies the (timestamps, columns) month slices read from the maps into one float64 result."""
+    timestamps = np.empty(sum(len(month_timestamps) for month_timestamps, _ in selected), dtype='datetime64[s]')
+    values = np.empty((len(timestamps), len(attributes)))
+    offset = 0
+    for month_timestamps, columns in selected:
+        rows = slice(offset, offset + len(month_timestamps))
+        timestamps[rows] = month_timestamps
+        for index, column in enumerate(columns):
+            _widen(column, values[rows, index])
+        offset = rows.stop
+    return timestamps, values
+
+
+def _to_datetime64(timestamp):
+    return np.datetime64(timestamp.replace(' ', 'T'), 's')
+
+
+class WeatherPartitions:
+    """Weather history compacted into one directory of .npy columns per month.
+
+    Each partition holds a datetime64 timestamp column and a float32 column
+    per attribute. A manifest names the current directory of every month and
+    is replaced atomically, so readers never see a half-written partition.
+    Reads memory-map only the partitions their time range touches. The
+    ingest worker loads only a recent window into memory and reads older
+    ranges from here on demand, and compaction prunes the compacted days
+    from SQLite, so neither holds the whole history.
+
+    Compactions lock the directory, so the web server's worker, a cron run
+    and other processes can share it: each compacts from the manifest on
+    disk, and no directory is removed while a reader is opening it.
+    """
+
+    def __init__(self, directory=PARTITION_DIR):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._manifest = self._read_manifest()
+
+    @contextmanager
+    def _locked(self, operation):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, LOCK), 'a') as f:
+            fcntl.flock(f, operation)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _read_manifest(self):
+        try:
+            with open(os.path.join(self.directory, MANIFEST)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {'generation': 0, 'last': None, 'partitions': {}}
+
+    def __len__(self):
+        return sum(partition['rows'] for partition in self._manifest['partitions'].values())
+
+    @property
+    def last_timestamp(self):
+        """Newest compacted reading as a TIMESTAMP_FORMAT string, or None before the first compaction."""
+        return self._manifest['last']
+
+    def _column(self, partition, name):
+        return np.load(os.path.join(self.directory, partition['path'], f'{name}.npy'), mmap_mode='r')
+
+    def read(self, start=None, end=None, attributes=ATTRIBUTES):
+        """Returns (timestamps, values) for readings between start and end; values are float64, one column per attribute.
+
+        The result is a copy in memory: the maps only spare reading the
+        months outside the range. Each column is widened straight into the
+        result, one month at a time, so loading needs no full-size temporaries.
+        """
+        # Another process may have compacted since; once mapped, the files outlive their removal
+        with self._locked(fcntl.LOCK_SH):
+            self._manifest = self._read_manifest()
+            selected = self._select(start, end, attributes)
+        return _gather(selected, attributes)
+
+    def load(self, store, window):
+        """Returns (timestamps, values, rows): the compacted readings of the last window, then the store's newer rows.
+
+        Both are read under the shared lock, so a compaction cannot prune
+        rows from the store between the two reads.
+        """
+        with self._locked(fcntl.LOCK_SH):
+            self._manifest = self._read_manifest()
+            last = self._manifest['last']
+            selected = self._select(_to_datetime64(last) - window if last else None, None, ATTRIBUTES)
+            rows = store.rows(last)
+        return _gather(selected, ATTRIBUTES) + (rows,)
+
+    def _select(self, start, end, attributes):
+        selected = []
+        for month, partition in sorted(self._manifest['partitions'].items()):
+            if start is not None and _to_datetime64(partition['last']) < start:
+                continue
+            if end is not None and _to_datetime64(partition['first']) > end:
+                continue
+            column = self._column(partition, 'timestamp')
+            lo, hi = time_range(column, start, end)
+            selected.append((column[lo:hi], [self._column(partition, name)[lo:hi] for name in attributes]))
+        return selected
+
+    def compact(self, store):
+        """Appends readings stored since the last compaction to their month partitions; returns how many.
+
+        The store then drops the compacted readings of every day before the
+        newest compacted one. The newest day is kept whole, since new readings
+        recompute its rollups from the store.
+        """
+        with self._lock, self._locked(fcntl.LOCK_EX):
+            # Rows are chosen by the manifest on disk, which another process may have moved on
+            manifest = self._read_manifest()
+            self._manifest = manifest
+            rows = store.rows(manifest['last'])
+            if not rows:
+                return 0
+            timestamps = np.array([row[0] for row in rows], dtype='datetime64[s]')
+            values = np.array([row[1:] for row in rows], dtype=float).reshape(len(rows), len(ATTRIBUTES))
+            months = timestamps.astype('datetime64[M]')
+
+            manifest = dict(manifest, partitions=dict(manifest['partitions']))
+            manifest['generation'] += 1
+            superseded = []
+            for month in np.unique(months):
+                selected = months == month
+                month_timestamps = timestamps[selected]
+                month_values = values[selected].astype(np.float32)
+                previous = manifest['partitions'].get(str(month))
+                if previous:
+                    # Syncs arrive in key order, so new readings always follow the compacted ones
+                    month_timestamps = np.concatenate([self._column(previous, 'timestamp'), month_timestamps])
+                    month_values = np.concatenate([
+                        np.column_stack([self._column(previous, name) for name in ATTRIBUTES]), month_values
+                    ])
+                    superseded.append(previous['path'])
+                path = f"{month}.{manifest['generation']}"
+                self._write(path, month_timestamps, month_values)
+                manifest['partitions'][str(month)] = {
+                    'path': path,
+                    'rows': len(month_timestamps),
+                    'first': month_timestamps[0].astype(object).strftime(TIMESTAMP_FORMAT),
+                    'last': month_timestamps[-1].astype(object).strftime(TIMESTAMP_FORMAT),
+                }
+            manifest['last'] = rows[-1][0]
+
+            temporary = os.path.join(self.directory, MANIFEST + '.tmp')
+            with open(temporary, 'w') as f:
+                json.dump(manifest, f, indent=1)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temporary, os.path.join(self.directory, MANIFEST))
+            self._manifest = manifest
+
+            # Open memory maps keep their pages, the files just lose their names; readers opening
+            # them hold the shared lock, so none is between reading the old manifest and mapping its files
+            for path in superseded:
+                shutil.rmtree(os.path.join(self.directory, path), ignore_errors=True)
+            store.prune(manifest['last'][:10] + ' 00:00:00')
+            return len(rows)
+
+    def _write(self, path, timestamps, values):
+        directory = os.path.join(self.directory, path)
+        os.makedirs(directory, exist_ok=True)
+        np.save(os.path.join(directory, 'timestamp.npy'), timestamps)
+        for index, name in enumerate(ATTRIBUTES):
+            np.save(os.path.join(directory, f'{name}.npy'), np.ascontiguousarray(values[:, index]))
+
+
+if __name__ == '__main__':
+    # Run from cron to compact without a web server, e.g. python weather_partitions.py
+    partitions = WeatherPartitions()
+    print(f"Compacted {partitions.compact(WeatherStore())} readings into {partitions.directory}")
@@ -0,0 +1,68 @@
+import json
+from functools import lru_cache
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Numeric attributes reported by the weather station
+ATTRIBUTES = ['temperature', 'humidity', 'wind_gust', 'precipitation', 'cloud_cover']
+
+# Shape of one weather object in S3: at least one measured attribute. Readings are timed by their object key,
+# so the body's timestamp and any other keys are ignored
+RECORD_SCHEMA = {
+    'type': 'object',
+    'properties': {name: {'type': ['number', 'null']} for name in ATTRIBUTES},
+    'anyOf': [{'required': [name], 'properties': {name: {'type': 'number'}}} for name in ATTRIBUTES],
+}
+
+# Python types of each JSON Schema type; a bool is not a number in JSON Schema, so types are matched exactly
+JSON_TYPES = {'object': (dict,), 'string': (str,), 'number': (int, float), 'null': (type(None),)}
+
+
+def _python_types(schema):
+    names = [schema['type']] if isinstance(schema['type'], str) else schema['type']
+    return tuple(python_type for name in names for python_type in JSON_TYPES[name])
+
+
+# Allowed Python types per property, so the common valid record skips jsonschema
+PROPERTY_TYPES = {name: _python_types(schema) for name, schema in RECORD_SCHEMA['properties'].items()}
+
+
+def loads(body):
+    """Parses JSON straight from the response bytes, with orjson when it is installed."""
+    if orjson is not None:
+        return orjson.loads(body)
+    return json.loads(body)
+
+
+@lru_cache(maxsize=None)
+def _validator():
+    # jsonschema takes a tenth of a second to import, so it is loaded with the first record
+    from jsonschema import Draft7Validator
+
+    return Draft7Validator(RECORD_SCHEMA)
+
+
+def _conforms(data):
+    # The same rules as RECORD_SCHEMA, so a record passing here is one jsonschema would accept
+    return (type(data) is dict
+            and all(type(data[name]) in types for name, types in PROPERTY_TYPES.items() if name in data)
+            and any(type(data.get(name)) in JSON_TYPES['number'] for name in ATTRIBUTES))
+
+
+def parse_reading(body):
+    """Parses and validates one S3 object, returning its attributes in ATTRIBUTES order with None for missing ones.
+
+    Raises ValueError, with the reason, for anything that is not a valid reading.
+    """
+    data = loads(body)
+    # jsonschema is 50 times slower than the parse itself; it only judges records the type check does not pass
+    error = None if _conforms(data) else next(_validator().iter_errors(data), None)
+    if error is not None:
+        if error.validator == 'anyOf':
+            raise ValueError(f"record: has none of {', '.join(ATTRIBUTES)} as a number")
+        location = '.'.join(str(part) for part in error.absolute_path) or 'record'
+        raise ValueError(f'{location}: {error.message}')
+    return tuple(None if data.get(name) is None else float(data[name]) for name in ATTRIBUTES)
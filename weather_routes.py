@@ -0,0 +1,211 @@
+import json
+
+import numpy as np
+import pandas as pd
+from flask import Blueprint, Response, jsonify, request
+
+from metrics import DATAFRAME_SECONDS
+from plotting import PlotCache, create_plot, png_response
+from serving import role_route
+from timeseries import (SmoothingCache, clamp_max_points, downsample, low_pass_filter, parse_time, time_range,
+                        to_json_values)
+from weather_analytics import (ANALYTIC_ATTRIBUTES, ANOMALY_METHODS, DEFAULT_HORIZON_HOURS, DEFAULT_WINDOW_MINUTES,
+                               MAX_HORIZON_HOURS, MAX_WINDOW_MINUTES, AnalyticsCache, analytics_summary, forecast)
+from weather_events import WeatherEvents, parse_since
+from weather_store import ATTRIBUTES
+
+# Smoothing used when a request does not give cloud_cover, and the most it may ask for, in percent
+DEFAULT_CLOUD_COVER = 50
+MAX_CLOUD_COVER = 100
+
+
+# Aggregate data based on granularity (minute, hour, day, week, month)
+def aggregate_data(snapshot, granularity):
+    # Hour, day, week and month views come from the precomputed rollups
+    if granularity in snapshot.rollups:
+        return snapshot.rollups[granularity]
+    return snapshot.frame
+
+
+# Low-pass filtered attribute; smoothing runs over the whole series so range queries agree
+def filter_data(smoothing_cache, snapshot, weather_attribute, cloud_cover, granularity):
+    if granularity in snapshot.rollups:
+        return low_pass_filter(snapshot.rollups[granularity][weather_attribute], cloud_cover)
+    return smoothing_cache.get(snapshot, weather_attribute, cloud_cover / 100)
+
+
+# Attribute and its filtered values between start and end, downsampled to at most max_points
+@DATAFRAME_SECONDS.timed(stage='query')
+def query_data(smoothing_cache, snapshot, weather_attribute, granularity, cloud_cover, start=None, end=None,
+               max_points=None):
+    if granularity not in snapshot.rollups and snapshot.reaches_history(start):
+        # Minutes older than the in-memory window come from the partitions, smoothed from the start of the range
+        timestamps, values = snapshot.range(start, end, [weather_attribute])
+        values = values[:, 0]
+        filtered = low_pass_filter(values, cloud_cover)
+    else:
+        df = aggregate_data(snapshot, granularity)
+        lo, hi = time_range(df.index.values, start, end)
+        timestamps = df.index.values[lo:hi]
+        values = df[weather_attribute].to_numpy()[lo:hi]
+        filtered = filter_data(smoothing_cache, snapshot, weather_attribute, cloud_cover, granularity)[lo:hi]
+    keep = downsample(timestamps, values, clamp_max_points(max_points))
+    return pd.DataFrame(
+        {weather_attribute: values[keep], 'filtered': filtered[keep]},
+        index=pd.DatetimeIndex(timestamps[keep], name='timestamp')
+    )
+
+
+def clamp_cloud_cover(cloud_cover):
+    return min(max(cloud_cover, 0), MAX_CLOUD_COVER)
+
+
+# Read the range and point budget shared by /plot, /api/weather and /api/analytics;
+# a malformed start or end raises ValueError naming it rather than widening the range
+def query_args():
+    args = {'max_points': request.args.get('max_points', type=int)}
+    for name in ('start', 'end'):
+        value = request.args.get(name)
+        try:
+            args[name] = parse_time(value) if value else None
+        except ValueError:
+            raise ValueError(f'{name} must be an ISO date or date-time, not {value!r}') from None
+    return args
+
+
+def weather_blueprint(ingest_worker, follow_cloud_cover=False, role=None):
+    """Plot, JSON, streaming and analytics routes over the ingest worker's snapshots, shared by the apps.
+
+    Without a cloud_cover argument the smoothing is DEFAULT_CLOUD_COVER, or
+    with follow_cloud_cover the latest cloud cover reading. Under a serving
+    role only its routes are served; see serving.py.
+    """
+    weather = Blueprint('weather', __name__)
+    api_route = role_route(weather, role, 'api')
+    stream_route = role_route(weather, role, 'stream')
+
+    # Live clients share the worker's snapshots instead of each scanning S3
+    weather_events = WeatherEvents(ingest_worker)
+
+    # Low-pass filtered columns and rendered plots, cached per data version
+    smoothing_cache = SmoothingCache()
+    plot_cache = PlotCache()
+
+    # Rolling statistics extended as readings arrive, and forecasts fitted once per data version
+    analytics_cache = AnalyticsCache()
+    forecast_cache = PlotCache()
+
+    # Smoothing weight in percent, or None when the request asks for one outside 0-100
+    def cloud_cover_arg(snapshot):
+        default = DEFAULT_CLOUD_COVER
+        if follow_cloud_cover:
+            default = clamp_cloud_cover(snapshot.latest('cloud_cover', DEFAULT_CLOUD_COVER))
+        cloud_cover = request.args.get('cloud_cover', default, type=int)
+        return cloud_cover if 0 <= cloud_cover <= MAX_CLOUD_COVER else None
+
+    # Plot of one attribute, rendered once per data version, then served from the cache or answered with 304
+    @api_route('/plot/<attribute>')
+    def plot(attribute):
+        if attribute not in ATTRIBUTES:
+            return jsonify({'error': 'Invalid attribute'}), 400
+        granularity = request.args.get('granularity', 'minute')
+        snapshot = ingest_worker.snapshot()
+        cloud_cover = cloud_cover_arg(snapshot)
+        if cloud_cover is None:
+            return jsonify({'error': f'cloud_cover must be 0-{MAX_CLOUD_COVER}'}), 400
+        try:
+            args = query_args()
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        def render():
+            df = query_data(smoothing_cache, snapshot, attribute, granularity, cloud_cover, **args)
+            return create_plot(df, attribute, granularity)
+
+        key = (attribute, granularity, cloud_cover, str(args['start']), str(args['end']), args['max_points'])
+        return png_response(plot_cache, key, snapshot, render, int(ingest_worker.interval))
+
+    # Weather readings as JSON for a time range, downsampled to the requested point budget
+    @api_route('/api/weather')
+    def weather_api():
+        attribute = request.args.get('attribute', 'temperature')
+        if attribute not in ATTRIBUTES:
+            return jsonify({'error': 'Invalid attribute'}), 400
+        granularity = request.args.get('granularity', 'minute')
+        snapshot = ingest_worker.snapshot()
+        cloud_cover = cloud_cover_arg(snapshot)
+        if cloud_cover is None:
+            return jsonify({'error': f'cloud_cover must be 0-{MAX_CLOUD_COVER}'}), 400
+        try:
+            args = query_args()
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        df = query_data(smoothing_cache, snapshot, attribute, granularity, cloud_cover, **args)
+        return jsonify({
+            'attribute': attribute,
+            'granularity': granularity,
+            'timestamps': np.datetime_as_string(df.index.values, unit='s').tolist(),
+            'values': to_json_values(df[attribute]),
+            'filtered': to_json_values(df['filtered']),
+        })
+
+    # New readings pushed as Server-Sent Events; a reconnecting browser resumes from Last-Event-ID
+    @stream_route('/api/weather/stream')
+    def weather_stream():
+        since = parse_since(request.headers.get('Last-Event-ID') or request.args.get('since'))
+        response = Response(weather_events.stream(since), mimetype='text/event-stream')
+        response.headers['Cache-Control'] = 'no-cache'
+        # Stop nginx from buffering the stream
+        response.headers['X-Accel-Buffering'] = 'no'
+        return response
+
+    # Readings after ?since= for clients that poll, served from memory like the stream
+    @api_route('/api/weather/latest')
+    def weather_latest():
+        since = parse_since(request.args.get('since'))
+        limit = clamp_max_points(request.args.get('limit', type=int))
+        return Response(weather_events.delta(ingest_worker.snapshot(), since, limit), mimetype='application/json')
+
+    # Rolling window statistics and anomalies; ?window=<minutes>&method=zscore|iqr&threshold=<score>
+    @api_route('/api/analytics/<attribute>')
+    def analytics_api(attribute):
+        if attribute not in ANALYTIC_ATTRIBUTES:
+            return jsonify({'error': 'Invalid attribute'}), 400
+        window = request.args.get('window', DEFAULT_WINDOW_MINUTES, type=int)
+        method = request.args.get('method', 'zscore')
+        if not 1 <= window <= MAX_WINDOW_MINUTES or method not in ANOMALY_METHODS:
+            return jsonify({'error': f"window must be 1-{MAX_WINDOW_MINUTES} minutes and method one of {', '.join(ANOMALY_METHODS)}"}), 400
+        try:
+            args = query_args()
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        snapshot = ingest_worker.snapshot()
+        analysis = analytics_cache.get(snapshot, attribute, window)
+        return jsonify(analytics_summary(snapshot, analysis, method, request.args.get('threshold', type=float), **args))
+
+    # Hourly Holt-Winters forecast for the next ?horizon=<hours>, fitted once per data version
+    @api_route('/api/forecast/<attribute>')
+    def forecast_api(attribute):
+        if attribute not in ATTRIBUTES:
+            return jsonify({'error': 'Invalid attribute'}), 400
+        horizon = request.args.get('horizon', DEFAULT_HORIZON_HOURS, type=int)
+        if not 1 <= horizon <= MAX_HORIZON_HOURS:
+            return jsonify({'error': f'horizon must be 1-{MAX_HORIZON_HOURS} hours'}), 400
+        snapshot = ingest_worker.snapshot()
+
+        def render():
+            result = forecast(snapshot, attribute, horizon)
+            return json.dumps(result).encode('utf-8') if result else b''
+
+        body = forecast_cache.get((attribute, horizon), snapshot.version, render)
+        if not body:
+            return jsonify({'error': 'Not enough hourly data to forecast yet'}), 404
+        return Response(body, mimetype='application/json')
+
+    # Freshness of the weather data, for health checks and alerting
+    @api_route('/ingest_status')
+    def ingest_status():
+        status = ingest_worker.status()
+        return jsonify(status), 503 if status['stale'] else 200
+
+    return weather
@@ -0,0 +1,163 @@
+import os
+import re
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+
+from s3_ingest import ingest
+from weather_records import ATTRIBUTES, parse_reading
+
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Readings committed per transaction while syncing
+SYNC_BATCH_SIZE = 1000
+
+# Materialized rollups: SQLite strftime format of each bucket and the bucket length
+ROLLUPS = {
+    'hour': ('%Y-%m-%d %H:00:00', timedelta(hours=1)),
+    'day': ('%Y-%m-%d 00:00:00', timedelta(days=1)),
+}
+
+# Coarser granularities are folded from the daily rollup at query time
+DAY_ROLLUP_GROUPS = {
+    'week': "date(bucket, '-' || ((strftime('%w', bucket) + 6) % 7) || ' days') || ' 00:00:00'",
+    'month': "strftime('%Y-%m-01 00:00:00', bucket)",
+}
+
+GRANULARITIES = list(ROLLUPS) + list(DAY_ROLLUP_GROUPS)
+
+# Local cache lives next to the code unless WEATHER_DB_PATH says otherwise
+DB_PATH = os.environ.get(
+    'WEATHER_DB_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'weather_cache.db')
+)
+
+
+# Extract timestamp from S3 file name
+def extract_timestamp_from_filename(filename):
+    match = re.match(r"weather_data_(\d{4})-(\d{2})-(\d{2})_(\d{2})-(\d{2})-(\d{2})\.json", filename)
+    if match:
+        year, month, day, hour, minute, second = match.groups()
+        return datetime(int(year), int(month), int(day), int(hour), int(minute), int(second))
+    return None
+
+
+class WeatherStore:
+    """SQLite cache of weather readings, keyed by the timestamp in the S3 object name.
+
+    The last S3 key seen for each bucket is kept as a watermark so that a sync
+    only lists and downloads objects newer than it.
+    """
+
+    def __init__(self, path=DB_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        # (key, reason) for every object that was not a valid reading
+        self.quarantine = []
+        self._create_tables()
+
+    def _create_tables(self):
+        columns = ', '.join(f'{name} REAL' for name in ATTRIBUTES)
+        with self._lock, self._conn:
+            self._conn.execute(f'CREATE TABLE IF NOT EXISTS readings (timestamp TEXT PRIMARY KEY, {columns})')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS sync_state (bucket TEXT PRIMARY KEY, last_key TEXT)')
+            stats = ', '.join(f'{name}_{stat} REAL' for name in ATTRIBUTES for stat in ('sum', 'min', 'max', 'count'))
+            for granularity in ROLLUPS:
+                self._conn.execute(f'CREATE TABLE IF NOT EXISTS rollup_{granularity} (bucket TEXT PRIMARY KEY, {stats})')
+            # Build the rollups for readings cached before they existed
+            first, last = self._conn.execute('SELECT MIN(timestamp), MAX(timestamp) FROM readings').fetchone()
+            if first and not self._conn.execute('SELECT 1 FROM rollup_hour LIMIT 1').fetchone():
+                self._update_rollups(first, last)
+
+    def watermark(self, bucket):
+        """Returns the last S3 key stored for the bucket, or None before the first sync."""
+        with self._lock:
+            row = self._conn.execute('SELECT last_key FROM sync_state WHERE bucket = ?', (bucket,)).fetchone()
+        return row[0] if row else None
+
+    def sync(self, storage, bucket):
+        """Downloads the objects listed after the watermark from storage and returns how many readings were added."""
+        added = 0
+        rows = []
+        last_key = None
+        for last_key, reading in ingest(storage, bucket, self.watermark(bucket), extract_timestamp_from_filename,
+                                        parse=parse_reading, quarantine=self.quarantine):
+            if reading is not None:
+                # The key gives the time; missing values are stored as NULL
+                timestamp = extract_timestamp_from_filename(last_key)
+                rows.append([timestamp.strftime(TIMESTAMP_FORMAT), *reading])
+            if len(rows) >= SYNC_BATCH_SIZE:
+                # Rows and watermark are committed together, one batch at a time
+                self.insert(rows, bucket, last_key)
+                added += len(rows)
+                rows = []
+        if last_key:
+            self.insert(rows, bucket, last_key)
+            added += len(rows)
+        return added
+
+    def insert(self, rows, bucket, last_key):
+        """Stores (timestamp, *attributes) rows and moves the bucket's watermark to last_key in one transaction."""
+        placeholders = ', '.join('?' * (len(ATTRIBUTES) + 1))
+        with self._lock, self._conn:
+            self._conn.executemany(f'INSERT OR REPLACE INTO readings VALUES ({placeholders})', rows)
+            if rows:
+                self._update_rollups(min(row[0] for row in rows), max(row[0] for row in rows))
+            self._conn.execute('INSERT OR REPLACE INTO sync_state VALUES (?, ?)', (bucket, last_key))
+
+    def _update_rollups(self, first, last):
+        """Recomputes only the rollup buckets that contain readings between first and last."""
+        first = datetime.strptime(first, TIMESTAMP_FORMAT)
+        last = datetime.strptime(last, TIMESTAMP_FORMAT)
+        stats = ', '.join(
+            f'SUM({name}), MIN({name}), MAX({name}), COUNT({name})' for name in ATTRIBUTES
+        )
+        for granularity, (bucket_format, length) in ROLLUPS.items():
+            start = first.strftime(bucket_format)
+            end = (datetime.strptime(last.strftime(bucket_format), TIMESTAMP_FORMAT) + length).strftime(TIMESTAMP_FORMAT)
+            self._conn.execute(
+                f"INSERT OR REPLACE INTO rollup_{granularity} "
+                f"SELECT strftime('{bucket_format}', timestamp) AS bucket, {stats} FROM readings "
+                f"WHERE timestamp >= ? AND timestamp < ? GROUP BY bucket",
+                (start, end)
+            )
+
+    def readings(self, since=None):
+        """Returns cached readings newer than since (all of them by default) as dicts, oldest first."""
+        names = ['timestamp'] + ATTRIBUTES
+        return [dict(zip(names, row)) for row in self.rows(since)]
+
+    def rows(self, since=None):
+        """Returns cached readings newer than since as (timestamp, *attributes) tuples, oldest first."""
+        columns = ', '.join(ATTRIBUTES)
+        query = f'SELECT timestamp, {columns} FROM readings'
+        params = ()
+        if since:
+            query += ' WHERE timestamp > ?'
+            params = (since,)
+        with self._lock:
+            return self._conn.execute(query + ' ORDER BY timestamp', params).fetchall()
+
+    def prune(self, before):
+        """Deletes cached readings older than before, a TIMESTAMP_FORMAT string; the rollups keep their totals."""
+        with self._lock, self._conn:
+            return self._conn.execute('DELETE FROM readings WHERE timestamp < ?', (before,)).rowcount
+
+    def rollup(self, granularity):
+        """Returns (bucket, then mean, min, max, count per attribute) rows for an hour, day, week or month rollup."""
+        if granularity in ROLLUPS:
+            stats = ', '.join(
+                f'{name}_sum / {name}_count, {name}_min, {name}_max, {name}_count' for name in ATTRIBUTES
+            )
+            query = f'SELECT bucket, {stats} FROM rollup_{granularity} ORDER BY bucket'
+        else:
+            stats = ', '.join(
+                f'SUM({name}_sum) / SUM({name}_count), MIN({name}_min), MAX({name}_max), SUM({name}_count)'
+                for name in ATTRIBUTES
+            )
+            query = (f'SELECT {DAY_ROLLUP_GROUPS[granularity]} AS period, {stats} '
+                     f'FROM rollup_day GROUP BY period ORDER BY period')
+        with self._lock:
+            return self._conn.execute(query).fetchall()
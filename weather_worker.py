@@ -0,0 +1,256 @@
+import os
+import threading
+import time
+from datetime import datetime
+from functools import cached_property
+
+import numpy as np
+
+from metrics import DATAFRAME_SECONDS
+from timeseries import parse_time, time_range
+from weather_partitions import COMPACT_SECONDS
+from weather_store import ATTRIBUTES, GRANULARITIES, TIMESTAMP_FORMAT
+
+# Seconds between polls of the weather bucket
+REFRESH_SECONDS = float(os.environ.get('WEATHER_REFRESH_SECONDS', 60))
+
+# Seconds between reads of the local cache by a worker that follows another process's syncs
+FOLLOW_SECONDS = float(os.environ.get('WEATHER_FOLLOW_SECONDS', 5))
+
+# A refresh older than this many intervals is reported as stale
+STALE_INTERVALS = 3
+
+# Days of readings kept in memory when older ones can be read back from compacted partitions
+SNAPSHOT_DAYS = float(os.environ.get('WEATHER_SNAPSHOT_DAYS', 30))
+
+
+# Column names of a rollup frame: the mean keeps the attribute name
+ROLLUP_COLUMNS = [f'{name}{suffix}' for name in ATTRIBUTES for suffix in ('', '_min', '_max', '_count')]
+
+
+def _readonly(array):
+    array.flags.writeable = False
+    return array
+
+
+@DATAFRAME_SECONDS.timed(stage='rollup')
+def rollup_frame(rows):
+    """Builds a timestamp-indexed DataFrame from WeatherStore.rollup() rows."""
+    # pandas is imported on first use, by the ingest thread rather than at app startup
+    import pandas as pd
+
+    index = pd.DatetimeIndex(np.array([row[0] for row in rows], dtype='datetime64[s]'), name='timestamp')
+    values = np.array([row[1:] for row in rows], dtype=float).reshape(len(rows), len(ROLLUP_COLUMNS))
+    return pd.DataFrame(values, index=index, columns=ROLLUP_COLUMNS)
+
+
+class WeatherSnapshot:
+    """Immutable view of the cached weather readings as NumPy columns.
+
+    The ingest worker never changes a published snapshot; it builds a new
+    one and swaps the reference, so request handlers can read without locks.
+    With history partitions, the columns hold only a recent window and
+    range() reads anything older from the partitions.
+    """
+
+    def __init__(self, timestamps, values, version, rollups=None, history=None):
+        self.timestamps = _readonly(timestamps)
+        self.values = _readonly(values)
+        self.version = version
+        # Granularity -> rollup frame with mean, min, max and count per attribute
+        self.rollups = rollups or {}
+        # WeatherPartitions holding every reading before the first timestamp, or None
+        self.history = history
+
+    @classmethod
+    def empty(cls):
+        return cls(np.array([], dtype='datetime64[s]'), np.empty((0, len(ATTRIBUTES))), 0)
+
+    @DATAFRAME_SECONDS.timed(stage='snapshot')
+    def extend(self, rows, rollups, since=None):
+        """Returns a new snapshot with rows from WeatherStore.rows() appended and the given rollups.
+
+        Readings before since, a datetime64, are left out of the new snapshot.
+        """
+        timestamps = np.array([row[0] for row in rows], dtype='datetime64[s]')
+        values = np.array([row[1:] for row in rows], dtype=float).reshape(len(rows), len(ATTRIBUTES))
+        lo = np.searchsorted(self.timestamps, since) if since is not None else 0
+        return WeatherSnapshot(
+            np.concatenate([self.timestamps[lo:], timestamps]),
+            np.concatenate([self.values[lo:], values]),
+            self.version + 1,
+            rollups,
+            self.history
+        )
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def column(self, attribute):
+        return self.values[:, ATTRIBUTES.index(attribute)]
+
+    def latest(self, attribute, default=None):
+        if not len(self):
+            return default
+        value = self.column(attribute)[-1]
+        return default if np.isnan(value) else value
+
+    @property
+    def latest_timestamp(self):
+        return self.timestamps[-1].astype(datetime) if len(self) else None
+
+    def reaches_history(self, start=None):
+        """True when readings from start on include some older than the in-memory columns."""
+        return self.history is not None and len(self) > 0 and (start is None or start < self.timestamps[0])
+
+    def range(self, start=None, end=None, attributes=ATTRIBUTES):
+        """Returns (timestamps, values) of the attributes between start and end.
+
+        Readings older than the in-memory columns are read from the history
+        partitions, which only map the months the range touches.
+        """
+        lo, hi = time_range(self.timestamps, start, end)
+        timestamps = self.timestamps[lo:hi]
+        values = self.values[lo:hi]
+        if list(attributes) != ATTRIBUTES:
+            values = values[:, [ATTRIBUTES.index(name) for name in attributes]]
+        if not self.reaches_history(start):
+            return timestamps, values
+        before = self.timestamps[0] - np.timedelta64(1, 's')
+        older_timestamps, older_values = self.history.read(start, before if end is None else min(end, before),
+                                                           attributes)
+        return np.concatenate([older_timestamps, timestamps]), np.concatenate([older_values, values])
+
+    @cached_property
+    @DATAFRAME_SECONDS.timed(stage='frame')
+    def frame(self):
+        """DataFrame indexed by timestamp; shares memory with the snapshot, so do not modify it."""
+        import pandas as pd
+
+        index = pd.DatetimeIndex(self.timestamps, name='timestamp')
+        return pd.DataFrame(self.values, index=index, columns=ATTRIBUTES, copy=False)
+
+
+class IngestWorker:
+    """Keeps the weather dataset warm by syncing the bucket on a background thread.
+
+    With sync=False the worker only follows the local cache that another
+    process syncs and compacts, reading the readings it added every
+    FOLLOW_SECONDS, so two processes serving one app never both sync.
+    With partitions, the snapshot keeps only the last snapshot_days of
+    readings in memory and older ones are read back from the partitions.
+    """
+
+    def __init__(self, store, storage, bucket, interval=None, partitions=None,
+                 compact_interval=COMPACT_SECONDS, sync=True, snapshot_days=SNAPSHOT_DAYS):
+        self.store = store
+        self.storage = storage
+        self.bucket = bucket
+        self.sync = sync
+        self.interval = interval or (REFRESH_SECONDS if sync else FOLLOW_SECONDS)
+        # Optional WeatherPartitions the history is loaded from and periodically compacted into
+        self.partitions = partitions
+        self.compact_interval = compact_interval
+        self.window = np.timedelta64(int(snapshot_days * 24 * 3600), 's')
+        # Compact on the first refresh, then every compact_interval seconds
+        self.last_compaction = 0
+        self.last_refresh = None
+        self.last_error = None
+        # Empty until the worker thread has loaded the local cache, so creating the worker stays cheap
+        self._snapshot = WeatherSnapshot.empty()
+        self._loaded = False
+        # Notified whenever a new snapshot is published
+        self._published = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='weather-ingest', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def snapshot(self):
+        return self._snapshot
+
+    def wait_for_snapshot(self, after_version, timeout=None):
+        """Blocks until a snapshot newer than after_version is published and returns it, or None on timeout."""
+        with self._published:
+            if self._published.wait_for(lambda: self._snapshot.version > after_version, timeout):
+                return self._snapshot
+        return None
+
+    def _publish(self, snapshot):
+        # Replacing the reference is atomic, readers see either the old or the new snapshot
+        with self._published:
+            self._snapshot = snapshot
+            self._published.notify_all()
+
+    def _load_snapshot(self):
+        if self.partitions is None:
+            return WeatherSnapshot.empty().extend(self.store.rows(), self._load_rollups())
+        # The window loads from the compacted columns; only the tail comes from SQLite row by row
+        timestamps, values, rows = self.partitions.load(self.store, self.window)
+        snapshot = WeatherSnapshot(timestamps, values, 0, history=self.partitions)
+        return snapshot.extend(rows, self._load_rollups())
+
+    def _window_start(self, newest):
+        # Readings older than the window are dropped from memory once the partitions hold them
+        if self.partitions is None or self.partitions.last_timestamp is None:
+            return None
+        return min(parse_time(newest) - self.window, parse_time(self.partitions.last_timestamp))
+
+    def refresh(self):
+        """Syncs new objects from storage and publishes a new snapshot if any arrived."""
+        if not self._loaded:
+            # Whatever is already cached locally is served until the first sync finishes
+            self._publish(self._load_snapshot())
+            self._loaded = True
+        if self.sync:
+            self.store.sync(self.storage, self.bucket)
+        snapshot = self._snapshot
+        since = snapshot.latest_timestamp
+        rows = self.store.rows(since.strftime(TIMESTAMP_FORMAT) if since else None)
+        if rows:
+            self._publish(snapshot.extend(rows, self._load_rollups(), self._window_start(rows[-1][0])))
+        self.last_refresh = time.time()
+        if (self.sync and self.partitions is not None
+                and self.last_refresh - self.last_compaction >= self.compact_interval):
+            self.partitions.compact(self.store)
+            self.last_compaction = self.last_refresh
+
+    def _load_rollups(self):
+        # Rollups are a few hundred to a few thousand rows, cheap to reread after each sync
+        return {granularity: rollup_frame(self.store.rollup(granularity)) for granularity in GRANULARITIES}
+
+    def _run(self):
+        while True:
+            try:
+                self.refresh()
+                self.last_error = None
+            except Exception as e:
+                self.last_error = str(e)
+                print(f"Error refreshing weather data: {e}")
+            if self._stop.wait(self.interval):
+                return
+
+    def status(self):
+        """Returns refresh age and ingest lag in seconds, for health checks and alerting."""
+        snapshot = self._snapshot
+        now = time.time()
+        refresh_age = now - self.last_refresh if self.last_refresh else None
+        latest = snapshot.latest_timestamp
+        return {
+            'loaded': self._loaded,
+            'version': snapshot.version,
+            'readings': len(snapshot),
+            'latest_reading': latest.strftime(TIMESTAMP_FORMAT) if latest else None,
+            'last_refresh_age_seconds': refresh_age,
+            'ingest_lag_seconds': (datetime.now() - latest).total_seconds() if latest else None,
+            'stale': refresh_age is None or refresh_age > self.interval * STALE_INTERVALS,
+            'last_error': self.last_error,
+            # Objects skipped because they were not valid readings
+            'quarantined': len(self.store.quarantine),
+        }